@@ -1,189 +1,98 @@
-from dataclasses import dataclass
-import ctypes
+import argparse
 import asyncio
-from bleak import BleakScanner, BleakClient
-from typing import Dict, List, Optional
+import time
+
+from ble_link import BleLink
+from ble_packet import PacketBatcher
+from latency_trace import LatencyTracer, install_dump_handler
+from metrics_http import link_collector, log_collector, start_metrics, tracer_collector
+from rate_control import AdaptiveRate
+from RCreadSticks import JoyValues, get_joysticks
+from calibration import load_profile
+from scheduler import RateScheduler
+from stick_log import FrameLog, add_logging_arguments, setup_logging
+from stick_sampler import start_sampler
 
 # Bluetooth-related constants
 DEVICE_NAME = "DJI_REMOTE_TRPY"  # The advertised BLE name
 SERVICE_UUID = "1fbcdfb1-8e73-4296-9057-a6ee3133902a"
 CHAR_UUID = "d97e4ec1-d3c4-4952-a421-884719fe35f7"
 
-# Joystick handling code
-try:
-    winmmdll = ctypes.WinDLL('winmm.dll')
+# Written by `python calibration.py calibration.json`; the caps ranges are used if missing
+CALIBRATION_FILE = "calibration.json"
 
-    _joyGetNumDevs_proto = ctypes.WINFUNCTYPE(ctypes.c_uint)
-    _joyGetNumDevs_func = _joyGetNumDevs_proto(("joyGetNumDevs", winmmdll))
+SEND_RATE_HZ = 10  # Stick samples written to the BLE device per second
 
-    _joyGetDevCaps_proto = ctypes.WINFUNCTYPE(ctypes.c_uint, ctypes.c_uint, ctypes.c_void_p, ctypes.c_uint)
-    _joyGetDevCaps_param = (1, "uJoyID", 0), (1, "pjc", None), (1, "cbjc", 0)
-    _joyGetDevCaps_func = _joyGetDevCaps_proto(("joyGetDevCapsW", winmmdll), _joyGetDevCaps_param)
+TRACER = LatencyTracer("rc_to_ble")
 
-    _joyGetPosEx_proto = ctypes.WINFUNCTYPE(ctypes.c_uint, ctypes.c_uint, ctypes.c_void_p)
-    _joyGetPosEx_param = (1, "uJoyID", 0), (1, "pji", None)
-    _joyGetPosEx_func = _joyGetPosEx_proto(("joyGetPosEx", winmmdll), _joyGetPosEx_param)
-except:
-    winmmdll = None
+# One line per second with the latest values, rather than one per sample
+SAMPLES = FrameLog("rc_to_ble", "Joystick values", ("X", "Y", "Z", "RZ"))
 
-JOYERR_NOERROR = 0
-JOY_RETURNY = 0x00000002
-_CAPS_SIZE_W = 728
-_CAPS_OFFSET_V = 4 + 32 * 2
+async def stream(joystick, link, rate_hz=SEND_RATE_HZ, rate=None, batcher=None):
+    """ Samples the joystick `rate_hz` times per second, forever, and writes the samples
+    to the BLE link. Samples taken while a write is in flight go out together in the next one.
+    Writes are paced by `rate` (an AdaptiveRate), which slows them down while they take long. """
+    # Reuses one snapshot for every sample
+    values = JoyValues(n_buttons=joystick.buttons)
+    if batcher is None:
+        batcher = PacketBatcher()
+    if rate is None:
+        rate = AdaptiveRate(rate_hz, name="rc_to_ble")
+    sampled = asyncio.Event()
+    sampled_at = 0.0
+    scheduler = RateScheduler(rate_hz, "rc_to_ble")
 
-def _joyGetNumDevs():
-    try:
-        num = _joyGetNumDevs_func()
-    except:
-        num = 0
-    return num
-
-def _joyGetDevCaps(uJoyID):
+    async def write_packets():
+        while True:
+            await sampled.wait()
+            await rate.wait()  # Samples keep piling into the batcher meanwhile
+            sampled.clear()
+            newest = sampled_at
+            # Send data to the Bluetooth device; while it is reconnecting only the latest state is kept
+            started = time.perf_counter()
+            if await link.write(batcher.take(link.max_write_size)):
+                done = time.perf_counter()
+                rate.observe(done - started, done)
+                TRACER.record("get->write", done - newest)
+
+    writer = asyncio.create_task(write_packets())
     try:
-        buffer = (ctypes.c_ubyte * _CAPS_SIZE_W)()
-        p1 = ctypes.c_uint(uJoyID)
-        p2 = ctypes.cast(buffer, ctypes.c_void_p)
-        p3 = ctypes.c_uint(_CAPS_SIZE_W)
-        ret_val = _joyGetDevCaps_func(p1, p2, p3)
-        ret = None if ret_val != JOYERR_NOERROR else buffer
-    except:
-        ret = None
-    return ret
-
-def _joyGetPosEx(uJoyID):
+        while True:
+            if writer.done():
+                writer.result()  # Raises whatever stopped the writer
+            started = time.perf_counter()
+            if joystick.get(values):
+                sampled_at = started
+                # Extract axis values for X, Y, Z, RZ (roll, pitch, yaw, throttle)
+                x_axis_value = values.axis("X")
+                y_axis_value = values.axis("Y")
+                z_axis_value = values.axis("Z")
+                rz_axis_value = values.axis("RZ")
+
+                # Log the joystick values for debugging
+                SAMPLES.add(x_axis_value, y_axis_value, z_axis_value, rz_axis_value)
+
+                batcher.add(x_axis_value, y_axis_value, z_axis_value, rz_axis_value)
+                sampled.set()
+
+            await scheduler.wait_async()  # Paces the loop at rate_hz
+    finally:
+        writer.cancel()
+        print(f"BLE packets: {batcher.stats()}")
+        print(f"Send rate: {rate.stats()}")
+
+async def main(sampler_rate=0, metrics_address=None):
+    # Connects straight to the last known address, scanning only if needed
+    link = BleLink(DEVICE_NAME, CHAR_UUID, max_replay_age=2 / SEND_RATE_HZ)
+    if not await link.start():
+        print(f"Device '{DEVICE_NAME}' not found yet. Retrying in the background...")
+
+    sampler = None
+    rate = AdaptiveRate(SEND_RATE_HZ, name="rc_to_ble")
+    batcher = PacketBatcher()
+    metrics = await start_metrics(metrics_address, link_collector(link, rate, batcher), tracer_collector(TRACER),
+                                  log_collector)
     try:
-        buffer = (ctypes.c_uint32 * (_JOYINFO_SIZE // 4))()
-        buffer[0] = _JOYINFO_SIZE
-        buffer[1] = JOY_RETURNY
-        p1 = ctypes.c_uint(uJoyID)
-        p2 = ctypes.cast(buffer, ctypes.c_void_p)
-        ret_val = _joyGetPosEx_func(p1, p2)
-        ret = None if ret_val != JOYERR_NOERROR else buffer
-    except:
-        ret = None
-    return ret
-
-_JOYINFO_SIZE = 52
-
-@dataclass
-class JoyValues:
-    axes: Dict[str, int]
-    buttons: List[int]
-
-    def __init__(self, buffer, n_buttons):
-        uint_array = (ctypes.c_uint32 * (_JOYINFO_SIZE // 4)).from_buffer(buffer)
-        self.dwSize, self.dwFlags, \
-            self.dwXpos, self.dwYpos, self.dwZpos, self.dwRpos, self.dwUpos, self.dwVpos, \
-            self.dwButtons, self.dwButtonNumber, self.dwPOV, self.dwReserved1, self.dwReserved2 = uint_array
-
-        self.axes = {
-            "X": self._map_axis(self.dwXpos),
-            "Y": self._map_axis(self.dwYpos),
-            "Z": self._map_axis(self.dwZpos),
-            "RX": self._map_axis(self.dwRpos),
-            "RY": self._map_axis(self.dwUpos),
-            "RZ": self._map_axis(self.dwVpos),
-        }
-        self.buttons = [self.dwButtons & 2 ** b != 0 for b in range(n_buttons)]
-
-    def _map_axis(self, raw_value):
-        neutral_value = 32767  # Neutral position, the center value
-        max_value = 65535  # Maximum possible joystick value (for 16-bit input)
-        
-        # Normalize to -127 to +127
-        normalized_value = ((raw_value - neutral_value) * 127) // (max_value // 2)
-        
-        # Clamp the value to the range -127 to +127
-        mapped_value = max(min(normalized_value, 127), -127)
-        
-        # Treat values between -2 and +2 as 0
-        if -2 <= mapped_value <= 2:
-            mapped_value = 0
-            
-        return mapped_value
-
-
-@dataclass
-class ChannelCaps:
-    min: int
-    max: int
-
-@dataclass
-class Joystick:
-    id: int
-    axes: Dict[str, ChannelCaps]
-    buttons: int
-
-    def __init__(self, uJoyID):
-        self.id = uJoyID
-        self.loaded = False
-
-    def _load(self, buffer):
-        ushort_array = (ctypes.c_uint16 * 2).from_buffer(buffer)
-        self.wMid, self.wPid = ushort_array
-
-        wchar_array = (ctypes.c_wchar * 32).from_buffer(buffer, 4)
-        self.szPname = ctypes.cast(wchar_array, ctypes.c_wchar_p).value
-
-        uint_array = (ctypes.c_uint32 * 19).from_buffer(buffer, _CAPS_OFFSET_V)
-        self.wXmin, self.wXmax, self.wYmin, self.wYmax, self.wZmin, self.wZmax, \
-            self.wNumButtons, self.wPeriodMin, self.wPeriodMax, \
-            self.wRmin, self.wRmax, self.wUmin, self.wUmax, self.wVmin, self.wVmax, \
-            self.wCaps, self.wMaxAxes, self.wNumAxes, self.wMaxButtons = uint_array
-
-        self.axes = {
-            "X": ChannelCaps(self.wXmin, self.wXmax),
-            "Y": ChannelCaps(self.wYmin, self.wYmax),
-            "Z": ChannelCaps(self.wZmin, self.wZmax),
-            "RX": ChannelCaps(self.wRmin, self.wRmax),
-            "RY": ChannelCaps(self.wUmin, self.wUmax),
-            "RZ": ChannelCaps(self.wVmin, self.wVmax),
-        }
-        self.buttons = self.wNumButtons
-
-    def get(self) -> Optional["JoyValues"]:
-        if not self.loaded:
-            self._load(_joyGetDevCaps(self.id))
-        buf = _joyGetPosEx(self.id)
-        if buf is None:
-            return None
-        return JoyValues(buf, self.buttons)
-
-def get_joysticks() -> List[Joystick]:
-    ret = []
-    for i in range(_joyGetNumDevs()):
-        caps_buf = _joyGetDevCaps(i)
-        if caps_buf is not None:
-            joy = Joystick(i)
-            joy._load(caps_buf)
-            ret.append(joy)
-    return ret
-
-async def main():
-    # Scan for Bluetooth devices
-    print("Scanning for BLE devices...")
-    devices = await BleakScanner.discover(timeout=5.0)
-    target_device = None
-
-    # Look for the device by name
-    for d in devices:
-        if d.name == DEVICE_NAME:
-            target_device = d
-            break
-
-    if not target_device:
-        print(f"Device '{DEVICE_NAME}' not found. Check your device is advertising.")
-        return
-    else:
-        print(f"Found {DEVICE_NAME} at address {target_device.address}. Connecting...")
-
-    async with BleakClient(target_device.address) as client:
-        if client.is_connected:
-            print(f"Connected to {DEVICE_NAME}!")
-        else:
-            print(f"Failed to connect to {DEVICE_NAME}.")
-            return
-
         # Get the first joystick
         joysticks = get_joysticks()
         if len(joysticks) == 0:
@@ -192,30 +101,32 @@ async def main():
         joystick = joysticks[0]
         print(f"Joystick connected: ID {joystick.id}, Name {joystick.szPname}")
 
-        # Send joystick values to BLE device
-        while True:
-            values = joystick.get()
-            if values:
-                # Extract axis values for X, Y, Z, RZ
-                x_axis_value = values.axes["X"]
-                y_axis_value = values.axes["Y"]
-                z_axis_value = values.axes["Z"]
-                rz_axis_value = values.axes["RZ"]
-
-                # Print the joystick values for debugging
-                print(f"Joystick values - X: {x_axis_value}, Y: {y_axis_value}, Z: {z_axis_value}, RZ: {rz_axis_value}")
+        # Optionally poll the device in its own process, so a slow BLE write cannot delay sampling
+        if sampler_rate > 0:
+            sampler = await asyncio.to_thread(start_sampler, joystick, sampler_rate)
+        if sampler is not None:
+            joystick = sampler.joystick()
+        joystick.set_calibration(load_profile(CALIBRATION_FILE))
 
-                # Package the values into a 16-byte buffer to send
-                joystick_data = bytearray(16)
-                joystick_data[0] = x_axis_value + 128
-                joystick_data[1] = y_axis_value + 128
-                joystick_data[2] = z_axis_value + 128
-                joystick_data[3] = rz_axis_value + 128
-
-                # Send data to the connected Bluetooth device
-                await client.write_gatt_char(CHAR_UUID, joystick_data)
-
-            await asyncio.sleep(0.1)  # Adjust the sleep time as needed
+        # Send joystick values to BLE device
+        install_dump_handler(TRACER, "latency_rc_to_ble.json")
+        await stream(joystick, link, SEND_RATE_HZ, rate, batcher)
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        print(f"BLE link: {link.stats()}")
+        TRACER.dump("latency_rc_to_ble.json")
+        if metrics is not None:
+            await metrics.close()
+        await link.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Send joystick values to the BLE device")
+    parser.add_argument("-s", "--sampler-rate", type=float, default=0,
+                        help="Poll the joystick at this rate in a separate process (0 polls in the send loop)")
+    parser.add_argument("--metrics", metavar="[HOST:]PORT", help="Serve /metrics and /profile over HTTP")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    setup_logging(args.log_level, args.log_json)
+
+    asyncio.run(main(args.sampler_rate, args.metrics))
@@ -3,10 +3,15 @@
  * (Roll, Pitch, Yaw, Throttle = R-P-Y-T order)
  * 
  * 1. This code creates a BLE server with a single service and characteristic.
- * 2. A BLE client can connect, discover the service & characteristic, and write 6 bytes:
- *    [roll, pitch, yaw, throttle, extra1, extra2] (each 0..255).
- * 3. We map the first 4 bytes (R, P, Y, T) into 12-bit values (0..4095)
- *    and update the MCP4728 channels in the same R-P-Y-T order.
+ * 2. A BLE client can connect, discover the service & characteristic, and write
+ *    stick packets (see ble_packet.py, which RC_to_BLE.py and ws_to_bluetooth.py use):
+ *      byte 0      version (high nibble) and sample count n (low nibble, 1..15)
+ *      byte 1      sequence number of the first sample (wraps at 256)
+ *      4 * n       [roll, pitch, yaw, throttle] per sample, oldest first (each 0..255)
+ *      last byte   CRC-8 (poly 0x07, init 0) of all the bytes before it
+ * 3. We check the packet, map the newest sample (R, P, Y, T) into 12-bit values
+ *    (0..4095) and update the MCP4728 channels in the same R-P-Y-T order.
+ *    Gaps in the sequence numbers are counted as lost samples.
  * 4. If we haven’t received new data for 2 seconds, we read analog pins (A0..A3)
  *    in R-P-Y-T order and update the MCP4728 from those values.
  * 
@@ -49,6 +54,17 @@ static bool gotRecentWrite = false;
 static unsigned long lastWriteMillis = 0;
 static const unsigned long TIMEOUT_MS = 2000; // fallback if no BLE write for 2 sec
 
+// Stick packet format (must match ble_packet.py)
+static const uint8_t PACKET_VERSION = 1;
+static const size_t PACKET_HEADER = 2;
+static const size_t SAMPLE_SIZE = 4;
+
+static bool haveSeq = false;
+static uint8_t nextSeq = 0;
+static unsigned long packetsOk = 0;
+static unsigned long packetsBad = 0;
+static unsigned long samplesLost = 0;
+
 // Store previous BLE values to detect changes
 static uint8_t prevRol = 255;
 static uint8_t prevPit = 255;
@@ -82,21 +98,59 @@ void readAnalogAndSetDAC() {
   Serial.println(thrVal);
 }
 
+/***********************************************************************
+ * crc8()
+ * CRC-8 with polynomial 0x07 and initial value 0, as in ble_packet.py.
+ ***********************************************************************/
+uint8_t crc8(const uint8_t* data, size_t length) {
+  uint8_t crc = 0;
+  for (size_t i = 0; i < length; i++) {
+    crc ^= data[i];
+    for (int bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x80) ? (uint8_t)((crc << 1) ^ 0x07) : (uint8_t)(crc << 1);
+    }
+  }
+  return crc;
+}
+
 /***********************************************************************
  * handleNewBLEData()
- * Extract the first 4 bytes as R, P, Y, T, map them to 0-4095, and set DAC.
+ * Check the stick packet, take the newest sample as R, P, Y, T,
+ * map it to 0-4095, and set DAC.
  ***********************************************************************/
 void handleNewBLEData(const uint8_t* data, size_t length) {
-  if (length < 4) return; // not enough data
+  if (length < PACKET_HEADER + SAMPLE_SIZE + 1) return; // not enough data
+
+  uint8_t version = data[0] >> 4;
+  uint8_t count = data[0] & 0x0F;
+  if (version != PACKET_VERSION || count == 0 ||
+      length != PACKET_HEADER + count * SAMPLE_SIZE + 1 ||
+      crc8(data, length - 1) != data[length - 1]) {
+    packetsBad++;
+    Serial.println("BLE => invalid packet ignored");
+    return;
+  }
+  packetsOk++;
+
+  // Every sample is numbered; a gap means samples were lost on the way
+  uint8_t seq = data[1];
+  if (haveSeq && seq != nextSeq) {
+    samplesLost += (uint8_t)(seq - nextSeq);
+    Serial.print("BLE => lost samples: ");
+    Serial.println(samplesLost);
+  }
+  nextSeq = seq + count;
+  haveSeq = true;
 
   gotRecentWrite = true;
   lastWriteMillis = millis();
 
-  // Extract 8-bit R, P, Y, T
-  uint8_t rol_raw = data[0];
-  uint8_t pit_raw = data[1];
-  uint8_t yaw_raw = data[2];
-  uint8_t thr_raw = data[3];
+  // Extract 8-bit R, P, Y, T of the newest sample
+  const uint8_t* sample = data + PACKET_HEADER + (count - 1) * SAMPLE_SIZE;
+  uint8_t rol_raw = sample[0];
+  uint8_t pit_raw = sample[1];
+  uint8_t yaw_raw = sample[2];
+  uint8_t thr_raw = sample[3];
 
   // If data is same as last time, skip
   if (rol_raw == prevRol &&
@@ -141,11 +195,9 @@ void handleNewBLEData(const uint8_t* data, size_t length) {
 class MyCallbacks : public BLECharacteristicCallbacks {
   void onWrite(BLECharacteristic* pCharacteristic) {
     String rxData = pCharacteristic->getValue();
-    if (rxData.length() >= 6) {
-      const uint8_t* data = (const uint8_t*) rxData.c_str();
-      size_t length = rxData.length();
-      handleNewBLEData(data, length);
-    }
+    const uint8_t* data = (const uint8_t*) rxData.c_str();
+    size_t length = rxData.length();
+    handleNewBLEData(data, length);
   }
 };
 
@@ -179,6 +231,7 @@ void setup() {
 
   // Initialize BLE
   BLEDevice::init("XIAO_S3_MCP4728_RPYT"); // or your board name
+  BLEDevice::setMTU(66); // Lets a central send the largest packet (15 samples, 63 bytes) in one write
 
   BLEServer* pServer = BLEDevice::createServer();
   // If you want to handle connection events, you can set server callbacks
@@ -190,7 +243,8 @@ void setup() {
   // Create the BLE Characteristic: READ/WRITE
   BLECharacteristic* pCharacteristic = pService->createCharacteristic(
       CHARACTERISTIC_UUID,
-      BLECharacteristic::PROPERTY_READ | BLECharacteristic::PROPERTY_WRITE
+      BLECharacteristic::PROPERTY_READ | BLECharacteristic::PROPERTY_WRITE |
+      BLECharacteristic::PROPERTY_WRITE_NR
   );
 
   // Set our custom callback
@@ -1,7 +1,10 @@
 import ctypes
+import time
 from dataclasses import dataclass
 from typing import Dict, List, Optional
 
+from calibration import CalibrationProfile, build_tables
+
 try:
     winmmdll = ctypes.WinDLL('winmm.dll')
 
@@ -42,14 +45,13 @@ def _joyGetDevCaps(uJoyID):
         ret = None
     return ret
 
-def _joyGetPosEx(uJoyID):
+def _joyGetPosEx(uJoyID, buffer=None):
     try:
-        buffer = (ctypes.c_uint32 * (_JOYINFO_SIZE // 4))()
+        if buffer is None:
+            buffer = (ctypes.c_uint32 * _JOYINFO_WORDS)()
         buffer[0] = _JOYINFO_SIZE
         buffer[1] = JOY_RETURNY
-        p1 = ctypes.c_uint(uJoyID)
-        p2 = ctypes.cast(buffer, ctypes.c_void_p)
-        ret_val = _joyGetPosEx_func(p1, p2)
+        ret_val = _joyGetPosEx_func(uJoyID, ctypes.addressof(buffer))
         ret = None if ret_val != JOYERR_NOERROR else buffer
     except:
         ret = None
@@ -66,9 +68,17 @@ class Joystick:
     axes: Dict[str, ChannelCaps]
     buttons: int
 
+    # True for devices that report changes as they happen (evdev_sticks) and offer
+    # `async wait_report(timeout)`; winmm devices can only be polled
+    event_driven = False
+
     def __init__(self, uJoyID):
         self.id = uJoyID
         self.loaded = False
+        self.registry = None
+        self.calibration: Optional[CalibrationProfile] = None
+        self._tables = None
+        self._pos_buffer = (ctypes.c_uint32 * _JOYINFO_WORDS)()
 
     def _load(self, buffer):
         ushort_array = (ctypes.c_uint16 * 2).from_buffer(buffer)
@@ -83,7 +93,7 @@ class Joystick:
             self.wRmin, self.wRmax, self.wUmin, self.wUmax, self.wVmin, self.wVmax, \
             self.wCaps, self.wMaxAxes, self.wNumAxes, self.wMaxButtons = uint_array
 
-        self.axes = {
+        axes = {
             "X": ChannelCaps(self.wXmin, self.wXmax),
             "Y": ChannelCaps(self.wYmin, self.wYmax),
             "Z": ChannelCaps(self.wZmin, self.wZmax),
@@ -91,40 +101,123 @@ class Joystick:
             "RY": ChannelCaps(self.wUmin, self.wUmax),
             "RZ": ChannelCaps(self.wVmin, self.wVmax),
         }
+        if getattr(self, "axes", None) != axes:
+            self._tables = None
+        self.axes = axes
         self.buttons = self.wNumButtons
+        self.loaded = True
+
+    def set_calibration(self, profile: Optional[CalibrationProfile]):
+        """ Maps axes through `profile` from now on; None restores the caps-only mapping """
+        self.calibration = profile
+        self._tables = None
 
-    def get(self) -> Optional["JoyValues"]:
+    @property
+    def tables(self):
+        """ Per-axis lookup tables (raw position -> -127..127), built on first use """
+        if self._tables is None:
+            self._tables = build_tables(self.axes, self.calibration)
+        return self._tables
+
+    def get(self, out: Optional["JoyValues"] = None) -> Optional["JoyValues"]:
+        """ Reads the current position into the joystick's own JOYINFOEX buffer.
+        Pass `out` to refill an existing snapshot instead of allocating a new one. """
         if not self.loaded:
-            self._load(_joyGetDevCaps(self.id))
-        buf = _joyGetPosEx(self.id)
+            caps_buf = _joyGetDevCaps(self.id)
+            if caps_buf is None:
+                return None
+            self._load(caps_buf)
+        buf = _joyGetPosEx(self.id, self._pos_buffer)
         if buf is None:
+            # Unplugged or re-enumerated: reload caps on the next successful read
+            self.loaded = False
+            if self.registry is not None:
+                self.registry.invalidate()
             return None
-        return JoyValues(buf, self.buttons)
+        if out is None:
+            return JoyValues(buf, self.buttons, self.tables)
+        return out.fill(buf, self.buttons, self.tables)
 
 _JOYINFO_SIZE = 52
+_JOYINFO_WORDS = _JOYINFO_SIZE // 4
+
+# Index of each axis position inside JOYINFOEX
+_AXIS_INDEX = {"X": 2, "Y": 3, "Z": 4, "RX": 5, "RY": 6, "RZ": 7}
+
 
-@dataclass
 class JoyValues:
-    axes: Dict[str, int]
-    buttons: List[int]
-
-    def __init__(self, buffer, n_buttons):
-        uint_array = (ctypes.c_uint32 * (_JOYINFO_SIZE // 4)).from_buffer(buffer)
-        self.dwSize, self.dwFlags, \
-            self.dwXpos, self.dwYpos, self.dwZpos, self.dwRpos, self.dwUpos, self.dwVpos, \
-            self.dwButtons, self.dwButtonNumber, self.dwPOV, self.dwReserved1, self.dwReserved2 = uint_array
-
-        self.axes = {
-            "X": self._map_axis(self.dwXpos),
-            "Y": self._map_axis(self.dwYpos),
-            "Z": self._map_axis(self.dwZpos),
-            "RX": self._map_axis(self.dwRpos),
-            "RY": self._map_axis(self.dwUpos),
-            "RZ": self._map_axis(self.dwVpos),
-        }
-        self.buttons = [self.dwButtons & 2 ** b != 0 for b in range(n_buttons)]
+    """ Snapshot of one JOYINFOEX read, backed by a fixed 52-byte array.
+    The `axes`, `raw_axes` and `buttons` views are only built when accessed.
+    Axes are mapped through the joystick's calibration tables when it has them. """
+    __slots__ = ("raw", "n_buttons", "tables", "_axes", "_raw_axes", "_buttons")
 
-    def _map_axis(self, raw_value):
+    def __init__(self, buffer=None, n_buttons=0, tables=None):
+        self.raw = (ctypes.c_uint32 * _JOYINFO_WORDS)()
+        self.n_buttons = n_buttons
+        self.tables = tables
+        self._axes = None
+        self._raw_axes = None
+        self._buttons = None
+        if buffer is not None:
+            self.fill(buffer, n_buttons, tables)
+
+    def fill(self, buffer, n_buttons=None, tables=None) -> "JoyValues":
+        """ Copies a JOYINFOEX buffer into this snapshot and drops the cached views """
+        ctypes.memmove(self.raw, buffer, _JOYINFO_SIZE)
+        if n_buttons is not None:
+            self.n_buttons = n_buttons
+        if tables is not None:
+            self.tables = tables
+        self._axes = None
+        self._raw_axes = None
+        self._buttons = None
+        return self
+
+    dwXpos = property(lambda self: self.raw[2])
+    dwYpos = property(lambda self: self.raw[3])
+    dwZpos = property(lambda self: self.raw[4])
+    dwRpos = property(lambda self: self.raw[5])
+    dwUpos = property(lambda self: self.raw[6])
+    dwVpos = property(lambda self: self.raw[7])
+    dwButtons = property(lambda self: self.raw[8])
+    dwButtonNumber = property(lambda self: self.raw[9])
+    dwPOV = property(lambda self: self.raw[10])
+
+    def axis(self, name: str) -> int:
+        """ Mapped value of a single axis, without building the `axes` dict """
+        raw_value = self.raw[_AXIS_INDEX[name]]
+        if self.tables is None:
+            return self._map_axis(raw_value)
+        table = self.tables[name]
+        try:
+            return table[raw_value]
+        except IndexError:
+            return table[-1]
+
+    @property
+    def axes(self) -> Dict[str, int]:
+        if self._axes is None:
+            self._axes = {name: self.axis(name) for name in _AXIS_INDEX}
+        return self._axes
+
+    @property
+    def raw_axes(self) -> Dict[str, int]:
+        if self._raw_axes is None:
+            raw = self.raw
+            self._raw_axes = {name: raw[i] for name, i in _AXIS_INDEX.items()}
+        return self._raw_axes
+
+    @property
+    def buttons(self) -> List[bool]:
+        """ Per-button list; dwButtons is the same state as one bitmask, and
+        button_events.ButtonEdges turns it into press/release events """
+        if self._buttons is None:
+            bits = self.raw[8]
+            self._buttons = [(bits >> b) & 1 == 1 for b in range(self.n_buttons)]
+        return self._buttons
+
+    @staticmethod
+    def _map_axis(raw_value):
         # Assuming raw_value is from 0 to 65535 for most joysticks
         neutral_value = 32767  # Neutral position, the center value
         max_value = 65535  # Maximum possible joystick value (for 16-bit input)
@@ -142,16 +235,120 @@ class JoyValues:
             
         return mapped_value
 
+    def __repr__(self):
+        return f"JoyValues(axes={self.axes}, buttons={self.buttons})"
 
-def get_joysticks() -> List[Joystick]:
-    ret = []
-    for i in range(_joyGetNumDevs()):
-        caps_buf = _joyGetDevCaps(i)
-        if caps_buf is not None:
-            joy = Joystick(i)
-            joy._load(caps_buf)
-            ret.append(joy)
-    return ret
+
+class JoystickRegistry:
+    """ Caches the caps and name of every attached joystick.
+    The device list is only re-read on `refresh()`, when a read error was reported,
+    or when `poll()` finds the rescan interval elapsed. `generation` is bumped
+    whenever the set of devices or their caps changes. """
+
+    def __init__(self, rescan_interval: float = 2.0):
+        self.rescan_interval = rescan_interval
+        self.generation = 0
+        self._devices: Dict[int, Joystick] = {}
+        self._caps: Dict[int, bytes] = {}
+        self._stale = True
+        self._next_rescan = 0.0
+
+    def joysticks(self) -> List[Joystick]:
+        if self._stale:
+            self.refresh()
+        return list(self._devices.values())
+
+    def get(self, uJoyID: int) -> Optional[Joystick]:
+        if self._stale:
+            self.refresh()
+        return self._devices.get(uJoyID)
+
+    def invalidate(self):
+        """ Forces a rescan on the next access, e.g. after a failed read """
+        self._stale = True
+
+    def changed(self, since_generation: int) -> bool:
+        return self.generation != since_generation
+
+    def poll(self, now: Optional[float] = None) -> bool:
+        """ Cheap hot-plug check meant for the sampling loop; returns True if the devices changed """
+        if now is None:
+            now = time.monotonic()
+        if not self._stale and now < self._next_rescan:
+            return False
+        return self.refresh(now)
+
+    def refresh(self, now: Optional[float] = None) -> bool:
+        if now is None:
+            now = time.monotonic()
+        self._stale = False
+        self._next_rescan = now + self.rescan_interval
+
+        devices = {}
+        caps = {}
+        for i in range(_joyGetNumDevs()):
+            caps_buf = _joyGetDevCaps(i)
+            if caps_buf is None:
+                continue
+            raw = bytes(caps_buf)
+            joy = self._devices.get(i)
+            if joy is None or self._caps.get(i) != raw:
+                joy = Joystick(i)
+                joy._load(caps_buf)
+            joy.registry = self
+            devices[i] = joy
+            caps[i] = raw
+
+        changed = caps != self._caps
+        self._devices = devices
+        self._caps = caps
+        if changed:
+            self.generation += 1
+        return changed
+
+
+_registry: Optional[JoystickRegistry] = None
+
+
+def _default_registry() -> JoystickRegistry:
+    """ winmm where it exists; elsewhere evdev devices, if python-evdev is installed """
+    if winmmdll is None:
+        try:
+            from evdev_sticks import EvdevRegistry
+        except ImportError as e:
+            if e.name != "evdev":
+                raise
+        else:
+            return EvdevRegistry()
+    return JoystickRegistry()
+
+
+def set_registry(registry: Optional[JoystickRegistry]) -> Optional[JoystickRegistry]:
+    """ Replaces the registry behind get_joysticks() (e.g. with simulated devices); returns the old one """
+    global _registry
+    previous, _registry = _registry, registry
+    return previous
+
+
+def get_joysticks(refresh: bool = False) -> List[Joystick]:
+    global _registry
+    if _registry is None:
+        _registry = _default_registry()
+    if refresh:
+        _registry.refresh()
+    return _registry.joysticks()
+
+
+async def wait_sample(joystick: Joystick, scheduler, idle_timeout: Optional[float] = None) -> int:
+    """ Paces a sampling loop: waits for the scheduler's next tick and, for an event-driven
+    joystick, then until it has reported a change (or `idle_timeout` seconds passed), so
+    an idle loop sleeps instead of reading the same state. Returns the missed ticks. """
+    missed = await scheduler.wait_async()
+    if joystick.event_driven:
+        await joystick.wait_report(idle_timeout)
+        # The next tick is a period after this one, and the idle time is not counted as missed ticks
+        scheduler.restart()
+    return missed
 
 if __name__ == '__main__':
     import sys
@@ -164,9 +361,9 @@ if __name__ == '__main__':
     joystick = joysticks[0]
     print(f"Joystick connected: ID {joystick.id}, Name {joystick.szPname}")
 
+    values = JoyValues(n_buttons=joystick.buttons)
     while True:
-        values = joystick.get()
-        if values:
+        if joystick.get(values):
             # Read the left stick (X, Y) and right stick (Z, RZ)
             x_axis_value = values.axes["X"]
             y_axis_value = values.axes["Y"]
@@ -35,6 +35,11 @@ import kotlin.math.abs
 
 class VirtualStickFragment : DJIFragment() {
 
+    companion object {
+        // Must match PRIORITY_COMMANDS in stick_mailbox.py
+        private val PRIORITY_COMMANDS = setOf("takeoff", "land", "s")
+    }
+
     private val basicAircraftControlVM: BasicAircraftControlVM by activityViewModels()
     private val virtualStickVM: VirtualStickVM by activityViewModels()
     private val simulatorVM: SimulatorVM by activityViewModels()
@@ -107,8 +112,14 @@ class VirtualStickFragment : DJIFragment() {
             override fun onMessage(webSocket: WebSocket, text: String) {
                 super.onMessage(webSocket, text)
                 println("Received message: $text")
-                mainHandler.post {
-                    handleServerMessage(text) // Process commands from the server
+                val command = text.trim().lowercase(Locale.getDefault())
+                if (command in PRIORITY_COMMANDS) {
+                    // Safety commands must not wait behind queued stick updates
+                    mainHandler.postAtFrontOfQueue { handleServerMessage(text) }
+                } else {
+                    mainHandler.post {
+                        handleServerMessage(text) // Process commands from the server
+                    }
                 }
             }
             override fun onFailure(webSocket: WebSocket, t: Throwable, response: Response?) {
@@ -1,51 +1,97 @@
+import argparse
 import asyncio
+import logging
 import websockets
 
+from fleet import Fleet, FleetOperatorChannel, run
+from flight_recorder import FlightRecorder
+from metrics_http import fleet_collector, hub_collector, log_collector, start_metrics
+from operator_channel import DEFAULT_ADDRESS, OperatorChannel, console, console_wanted
+from stick_frames import SUBPROTOCOLS, decode_frame, select_subprotocol
+from stick_hub import WRITE_LIMIT, StickHub
+from stick_log import FrameLog, add_logging_arguments, setup_logging
+
+HOST = "192.168.54.197"
+PORT = 5000
+
+# Every client gets the operator's messages through its own send buffer, so a slow
+# client never holds up the others; takeoff/land/stop skip ahead of other messages
+hub = StickHub()
+
+# What the clients send, logged as one summary per second (every message with --log-level debug)
+RECEIVED = FrameLog("server", "Received from client", ("client", "message"))
+INVALID = FrameLog("server", "Invalid binary message from client", ("client", "payload"), level=logging.WARNING)
+
+# Task to handle receiving messages from a client
+async def receive_messages(websocket, client):
+    async for message in websocket:
+        client.received(message)
+        if isinstance(message, bytes):
+            try:
+                message = decode_frame(message)
+            except ValueError:
+                # Not a stick frame; logged rather than letting it end the connection
+                INVALID.add(client.name, message)
+                continue
+        RECEIVED.add(client.name, message)
+        # You can process incoming messages here (parse and act accordingly)
+
 # Define the WebSocket handler
-async def echo(websocket, path):
+async def echo(websocket, path=None):  # Newer websockets call handlers without the path
     print("Client connected")
-
-    # Queue for messages to send to the client
-    message_queue = asyncio.Queue()
-
-    # Background task to handle sending messages to the client
-    async def send_messages():
-        while True:
-            server_message = await message_queue.get()
-            if server_message is None:  # Exit signal
-                print("Closing connection...")
-                await websocket.close()
-                break
-            await websocket.send(server_message)
-
-    # Task to get user input asynchronouslyc
-    async def get_user_input():
-        while True:
-            user_input = await asyncio.to_thread(input, "Enter a message to send to the client (or 'exit' to quit): ")
-            if user_input.lower() == "exit":
-                await message_queue.put(None)  # Signal to stop
-                break
-            if user_input.lower() == "takeoff":
-                # Send takeoff command to the client
-                command_message = "takeoff"
-                await message_queue.put(command_message)
-            else:
-                await message_queue.put(user_input)
-
-    # Task to handle receiving messages from the client
-    async def receive_messages():
-        async for message in websocket:
-            print(f"Received from client: {message}")
-            # You can process incoming messages here (parse and act accordingly)
-
-    # Run all tasks concurrently
-    await asyncio.gather(send_messages(), get_user_input(), receive_messages())
+    await hub.serve(websocket, receive_messages)
 
 # Start the server
-async def main():
-    async with websockets.serve(echo, "192.168.54.197", 5000):
-        print("WebSocket server listening on ws://192.168.54.197:5000")
-        await asyncio.Future()  # Run forever
+async def main(operator_address=DEFAULT_ADDRESS, use_console=None, metrics_address=None, host=HOST, port=PORT,
+               fleet=None):
+    # Operator commands (takeoff, land, exit, any message) for one or all clients come in
+    # over a local socket, so the server can also run headless
+    if fleet is not None:
+        # Many drones: connections are routed by their path (see fleet.py)
+        operator = FleetOperatorChannel(fleet, operator_address)
+        collectors = [hub_collector(fleet), fleet_collector(fleet), log_collector]
+        handler = fleet.handler
+    else:
+        operator = OperatorChannel(hub, operator_address)
+        collectors = [hub_collector(hub), log_collector]
+        handler = echo
+    await operator.start()
+    metrics = await start_metrics(metrics_address, *collectors)
+    try:
+        # Clients that offer no subprotocol (the Android app) get text messages
+        async with websockets.serve(handler, host, port, subprotocols=SUBPROTOCOLS,
+                                    select_subprotocol=select_subprotocol, write_limit=WRITE_LIMIT):
+            print(f"WebSocket server listening on ws://{host}:{port}" + (" (fleet mode)" if fleet is not None else ""))
+            if console_wanted(use_console):
+                await console(operator)
+            await asyncio.Future()  # Run forever
+    finally:
+        await operator.close()
+        if metrics is not None:
+            await metrics.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="WebSocket server")
+    parser.add_argument("--record", help="Record all traffic into this flight recording file")
+    parser.add_argument("-o", "--operator", default=DEFAULT_ADDRESS,
+                        help="Socket for operator commands: a Unix socket path or host:port")
+    parser.add_argument("--console", action=argparse.BooleanOptionalAction, default=None,
+                        help="Read operator commands from the terminal too (default: when there is one)")
+    parser.add_argument("--metrics", metavar="[HOST:]PORT", help="Serve /metrics and /profile over HTTP")
+    parser.add_argument("--host", default=HOST, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=PORT, help="Port to listen on")
+    add_logging_arguments(parser)
+    parser.add_argument("--fleet", action="store_true",
+                        help="Serve many drones: /drone/ID for bridges and apps, /control/NAME for controllers")
+    parser.add_argument("--uvloop", action="store_true", help="Run on uvloop, if it is installed")
+    args = parser.parse_args()
+    setup_logging(args.log_level, args.log_json)
+    if args.record:
+        hub.recorder = FlightRecorder(args.record)
+
+    try:
+        run(main(args.operator, args.console, args.metrics, args.host, args.port,
+                 Fleet(recorder=hub.recorder) if args.fleet else None), args.uvloop)
+    finally:
+        if hub.recorder is not None:
+            hub.recorder.close()
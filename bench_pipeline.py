@@ -0,0 +1,292 @@
+""" Benchmarks the stick pipelines without hardware.
+
+A SimJoystick replays a stick trace through the real JOYINFOEX path, a SimPeripheral
+stands in for the BLE device and WebSocket peers run on localhost, so this works on
+any machine. Every pipeline is run at each rate and the results are written as JSON;
+pass --compare with an older results file to see what changed between versions.
+
+    python bench_pipeline.py -o bench_results.json
+    python bench_pipeline.py --compare bench_results.json -o new.json
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import websockets
+
+import RC_to_BLE
+import ws_to_bluetooth
+from ble_link import BleLink
+from ble_packet import PacketBatcher
+from flight_recorder import stick_trace
+from latency_trace import LATENCY_BOUNDS_US, LatencyTracer
+from RCreadSticks import JoyValues, set_registry
+from scheduler import Histogram, RateScheduler
+from sim_ble import SimPeripheral
+from sim_joystick import SimJoystick, install, load_trace, sine_trace
+from stick_frames import (SUBPROTOCOL_BINARY, SUBPROTOCOLS, FrameEncoder, decode_frame, select_subprotocol,
+                          timestamp_us)
+from stick_mailbox import StickMailbox
+
+RATES_HZ = (20, 50, 100, 500)
+# Joystick axis behind roll, pitch, yaw and throttle, as in RC_to_BLE and readRCstickValues+WSServer
+STICK_AXES = ("X", "Y", "Z", "RZ")
+RESULTS_FILE = "bench_results.json"
+
+
+def _load_ws_server():
+    """ readRCstickValues+WSServer.py cannot be imported by name """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "readRCstickValues+WSServer.py")
+    spec = importlib.util.spec_from_file_location("readRCstickValues_WSServer", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _serve(handler):
+    """ Serves the legacy `handler(websocket, path)` on a free localhost port """
+    async def compat(ws, path=None):
+        if path is None:
+            request = getattr(ws, "request", None)
+            path = request.path if request is not None else getattr(ws, "path", "/")
+        await handler(ws, path)
+    return websockets.serve(compat, "127.0.0.1", 0, subprotocols=SUBPROTOCOLS,
+                            select_subprotocol=select_subprotocol)
+
+
+def _url(server, path="/drone") -> str:
+    return f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}{path}"
+
+
+async def _link(args, name: str, char_uuid: str):
+    peripheral = SimPeripheral(char_uuid, write_delay=args.write_delay)
+    cache_file = os.path.join(args.tmp, "ble_cache.json")
+    peripheral.write_cache(cache_file, name)
+    link = BleLink(name, char_uuid, cache_file=cache_file, client_factory=peripheral.client)
+    await link.start()
+    return peripheral, link
+
+
+async def _run_for(duration: float, *tasks) -> float:
+    """ Lets the tasks run for `duration` seconds, then cancels them; returns the CPU time used """
+    cpu = time.process_time()
+    await asyncio.sleep(duration)
+    cpu = time.process_time() - cpu
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return cpu
+
+
+def _joystick(args) -> SimJoystick:
+    if not args.trace:
+        trace = sine_trace()
+    elif args.trace.endswith(".flr"):
+        trace = stick_trace(args.trace)
+    else:
+        trace = load_trace(args.trace)
+    joystick = SimJoystick(trace=trace)
+    joystick.tables  # Builds the lookup tables now rather than inside the first timed sample
+    return joystick
+
+
+async def bench_rc_to_ble(rate_hz: float, args) -> Dict:
+    """ Joystick -> RC_to_BLE.stream -> BLE write """
+    joystick = _joystick(args)
+    peripheral, link = await _link(args, RC_to_BLE.DEVICE_NAME, RC_to_BLE.CHAR_UUID)
+    RC_to_BLE.TRACER = tracer = LatencyTracer("rc_to_ble")
+    cpu = await _run_for(args.duration, asyncio.create_task(RC_to_BLE.stream(joystick, link, rate_hz)))
+    await link.close()
+    return {
+        "samples": joystick.samples,
+        "delivered": len(peripheral.writes),
+        "cpu_s": cpu,
+        "latency_hop": "get->write",
+        "latency": tracer.hops.get("get->write", Histogram(LATENCY_BOUNDS_US)).as_dict(),
+    }
+
+
+async def bench_ws_to_bluetooth(rate_hz: float, args) -> Dict:
+    """ Joystick -> binary frames from a local server -> ws_to_bluetooth -> BLE write """
+    joystick = _joystick(args)
+
+    async def controller(ws, path):
+        encoder = FrameEncoder(ws.subprotocol)
+        values = JoyValues(n_buttons=joystick.buttons)
+        scheduler = RateScheduler(rate_hz, "controller")
+        try:
+            while True:
+                joystick.get(values)
+                stamp = timestamp_us()
+                await ws.send(encoder.encode(*(values.axis(name) for name in STICK_AXES), stamp=stamp))
+                await scheduler.wait_async()
+        except websockets.ConnectionClosed:
+            pass
+
+    async with _serve(controller) as server:
+        peripheral, link = await _link(args, ws_to_bluetooth.DEVICE_NAME, ws_to_bluetooth.CHAR_UUID)
+        ws_to_bluetooth.TRACER = tracer = LatencyTracer("ws_to_bluetooth")
+        mailbox = StickMailbox()
+        batcher = PacketBatcher()
+        cpu = await _run_for(args.duration,
+                             asyncio.create_task(ws_to_bluetooth.receive_frames(_url(server), mailbox, batcher)),
+                             asyncio.create_task(ws_to_bluetooth.write_frames(link, mailbox, rate_hz, batcher)))
+        await link.close()
+    return {
+        "samples": joystick.samples,
+        "delivered": len(peripheral.writes),
+        "cpu_s": cpu,
+        "merged": mailbox.merged,
+        "samples_per_write": batcher.stats()["samples_per_packet"],
+        "lost": tracer.lost,
+        "latency_hop": "sample->write",
+        "latency": tracer.hops.get("sample->write", Histogram(LATENCY_BOUNDS_US)).as_dict(),
+    }
+
+
+async def bench_ws_server(rate_hz: float, args) -> Dict:
+    """ Joystick -> readRCstickValues+WSServer (streaming mode) -> binary WebSocket client.
+    Every sample is sent (keepalive=0), so this measures the pipeline, not the deadband. """
+    module = args.ws_server
+    joystick = _joystick(args)
+    previous = install(joystick)
+    module.JOYSTICK_RATE_HZ = rate_hz
+    module.hub.max_rate_hz = rate_hz
+    tracer = LatencyTracer("ws_server")
+    received = 0
+    sampler = asyncio.create_task(module.joystick_input(module.STREAM, keepalive=0.0))
+    try:
+        async with _serve(module.echo) as server, \
+                websockets.connect(_url(server), subprotocols=[SUBPROTOCOL_BINARY]) as ws:
+            cpu = time.process_time()
+            deadline = time.perf_counter() + args.duration
+            while (remaining := deadline - time.perf_counter()) > 0:
+                try:
+                    message = await asyncio.wait_for(ws.recv(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                frame = decode_frame(message)
+                tracer.record_since("sample->receive", frame.timestamp_us)
+                tracer.observe_seq(frame.seq)
+                received += 1
+            cpu = time.process_time() - cpu
+    finally:
+        sampler.cancel()
+        set_registry(previous)
+    return {
+        "samples": joystick.samples,
+        "delivered": received,
+        "cpu_s": cpu,
+        "lost": tracer.lost,
+        "latency_hop": "sample->receive",
+        "latency": tracer.hops.get("sample->receive", Histogram(LATENCY_BOUNDS_US)).as_dict(),
+    }
+
+
+BENCHMARKS = {
+    "rc_to_ble": bench_rc_to_ble,
+    "ws_to_bluetooth": bench_ws_to_bluetooth,
+    "ws_server": bench_ws_server,
+}
+
+
+def run_one(pipeline: str, rate_hz: float, args) -> Dict:
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+        args.tmp = tmp
+        # Per-sample logging is off (setup_logging() is never called), as with --log-level off;
+        # the connection messages the pipelines print are kept out of the results
+        with contextlib.redirect_stdout(devnull):
+            result = asyncio.run(BENCHMARKS[pipeline](rate_hz, args))
+    return {
+        "pipeline": pipeline,
+        "rate_hz": rate_hz,
+        "duration_s": args.duration,
+        **result,
+        "throughput_hz": result["delivered"] / args.duration,
+        "cpu_percent": 100.0 * result["cpu_s"] / args.duration,
+    }
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def _line(r: Dict) -> str:
+    lat = r["latency"]
+    return (f"{r['pipeline']:<16}{r['rate_hz']:>6g} Hz  {r['throughput_hz']:8.1f}/s  "
+            f"p50={lat['p50_s'] * 1e3:6.2f}ms p99={lat['p99_s'] * 1e3:6.2f}ms max={lat['max_s'] * 1e3:6.2f}ms  "
+            f"cpu={r['cpu_percent']:5.1f}%")
+
+
+def compare(baseline_path: str, results: List[Dict]):
+    with open(baseline_path) as f:
+        baseline = {(r["pipeline"], r["rate_hz"]): r for r in json.load(f)["results"]}
+    print(f"\nCompared with {baseline_path}:")
+    for r in results:
+        old = baseline.get((r["pipeline"], r["rate_hz"]))
+        if old is None:
+            continue
+        print(f"{r['pipeline']:<16}{r['rate_hz']:>6g} Hz  "
+              f"throughput {old['throughput_hz']:8.1f} -> {r['throughput_hz']:8.1f}/s  "
+              f"p99 {old['latency']['p99_s'] * 1e3:6.2f} -> {r['latency']['p99_s'] * 1e3:6.2f}ms  "
+              f"cpu {old['cpu_percent']:5.1f} -> {r['cpu_percent']:5.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stick pipelines with simulated devices")
+    parser.add_argument("-p", "--pipeline", nargs="*", default=list(BENCHMARKS), choices=list(BENCHMARKS),
+                        help="Pipelines to run")
+    parser.add_argument("-r", "--rates", nargs="*", type=float, default=list(RATES_HZ), help="Rates in Hz")
+    parser.add_argument("-d", "--duration", type=float, default=3.0, help="Seconds per run")
+    parser.add_argument("-t", "--trace", help="Stick trace from sim_joystick.py or a flight recording (.flr); default: sine sweep")
+    parser.add_argument("--write-delay", type=float, default=0.0, help="Simulated BLE write time in seconds")
+    parser.add_argument("-o", "--output", default=RESULTS_FILE, help="Results file to write (JSON)")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    args = parser.parse_args()
+
+    if "ws_server" in args.pipeline:
+        args.ws_server = _load_ws_server()
+
+    results = []
+    for pipeline in args.pipeline:
+        for rate_hz in args.rates:
+            result = run_one(pipeline, rate_hz, args)
+            print(_line(result))
+            results.append(result)
+
+    report = {
+        "meta": {
+            "commit": _commit(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "websockets": websockets.__version__,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "duration_s": args.duration,
+            "write_delay_s": args.write_delay,
+            "trace": args.trace or "sine",
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved results to {args.output}")
+
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, Optional
+
+from ble_packet import ATT_HEADER_SIZE, DEFAULT_MTU
+from scheduler import Histogram
+from stick_log import FrameLog
+
+CACHE_FILE = "ble_cache.json"  # Last known address and characteristic handle per device name
+
+# Fails on every frame while a link is broken, so it is logged as one summary per second
+WRITE_FAILED = FrameLog("ble", "BLE write failed", ("device", "error"), level=logging.WARNING)
+
+
+def _load_cache(path: str) -> Dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_cache(path: str, cache: Dict):
+    try:
+        with open(path, "w") as f:
+            json.dump(cache, f, indent=2)
+    except OSError as e:
+        print(f"Could not save BLE cache: {e}")
+
+
+class BleLink:
+    """ Keeps a BLE connection to one device up for as long as it is running.
+
+    The first connection goes straight to the cached address and only scans if that
+    fails (and then stops at the first advertisement that matches the name). When the
+    link drops it reconnects in the background with exponential backoff. Writes made
+    meanwhile are not queued: only the latest payload is kept, and sent on reconnect if
+    it is at most `max_replay_age` seconds old (about two write periods, so stale stick
+    input never reaches the aircraft). """
+
+    def __init__(self, name: str, char_uuid: str, cache_file: str = CACHE_FILE,
+                 scan_timeout: float = 5.0, min_backoff: float = 0.1, max_backoff: float = 5.0,
+                 client_factory=None, max_replay_age: float = 0.2):
+        if client_factory is None:
+            # Imported here so the simulator (sim_ble), which brings its own client, runs without bleak
+            from bleak import BleakClient
+            client_factory = BleakClient
+        self.name = name
+        self.char_uuid = char_uuid
+        self.cache_file = cache_file
+        self.scan_timeout = scan_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.client_factory = client_factory
+        self.max_replay_age = max_replay_age
+
+        self.connects = 0
+        self.reconnects = 0
+        self.failures = 0
+        self.write_errors = 0
+        self.stale_dropped = 0  # Latest payloads too old to send on reconnect
+        self.last_connect_time = 0.0  # Seconds the last successful (re)connection took
+        self.write_time = Histogram()  # Of successful writes
+
+        self._client = None
+        self._stale_client = None  # Dropped after a failed write, disconnected before reconnecting
+        self._char = None
+        self._response = True
+        self._latest: Optional[bytes] = None
+        self._latest_at = 0.0
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._connected = asyncio.Event()
+        self._closing = False
+
+    @property
+    def connected(self) -> bool:
+        return self._client is not None and self._client.is_connected
+
+    @property
+    def max_write_size(self) -> int:
+        """ Largest payload one write can carry with the negotiated MTU """
+        mtu = getattr(self._client, "mtu_size", None) or DEFAULT_MTU
+        return max(mtu, DEFAULT_MTU) - ATT_HEADER_SIZE
+
+    @property
+    def address(self) -> Optional[str]:
+        return _load_cache(self.cache_file).get(self.name, {}).get("address")
+
+    async def _find_address(self, use_cache: bool) -> Optional[str]:
+        if use_cache:
+            address = self.address
+            if address:
+                return address
+        from bleak import BleakScanner
+
+        print(f"Scanning for {self.name}...")
+        device = await BleakScanner.find_device_by_name(self.name, timeout=self.scan_timeout)
+        return device.address if device is not None else None
+
+    async def _connect_once(self, use_cache: bool = True) -> bool:
+        started = time.perf_counter()
+        address = await self._find_address(use_cache)
+        if address is None:
+            return False
+        client = self.client_factory(address, disconnected_callback=self._on_disconnect)
+        try:
+            await client.connect()
+        except Exception as e:
+            print(f"Failed to connect to {self.name} at {address}: {e}")
+            return False
+
+        # The cached handle skips the UUID search; it is checked in case the GATT table changed
+        handle = _load_cache(self.cache_file).get(self.name, {}).get("handle")
+        char = client.services.get_characteristic(handle) if handle is not None else None
+        if char is None or char.uuid.lower() != self.char_uuid.lower():
+            char = client.services.get_characteristic(self.char_uuid)
+        if char is None:
+            print(f"{self.name} at {address} has no characteristic {self.char_uuid}")
+            await client.disconnect()
+            return False
+        self._client = client
+        self._char = char
+        self._response = "write-without-response" not in char.properties
+        self.last_connect_time = time.perf_counter() - started
+        self.connects += 1
+        self._connected.set()
+
+        cache = _load_cache(self.cache_file)
+        cached = cache.get(self.name, {})
+        if cached.get("address") != address or cached.get("handle") != char.handle:
+            cache[self.name] = {"address": address, "handle": char.handle}
+            _save_cache(self.cache_file, cache)
+        print(f"Connected to {self.name} at {address} in {self.last_connect_time * 1e3:.0f}ms")
+
+        if self._latest is not None:
+            if time.perf_counter() - self._latest_at <= self.max_replay_age:
+                await self.write(self._latest)
+            else:
+                self._latest = None
+                self.stale_dropped += 1
+        return True
+
+    async def connect(self) -> bool:
+        """ Connects directly to the cached address, falling back to a scan """
+        if self.address is not None and await self._connect_once(use_cache=True):
+            return True
+        return await self._connect_once(use_cache=False)
+
+    async def start(self) -> bool:
+        """ Connects once, and keeps reconnecting in the background if that fails """
+        if await self.connect():
+            return True
+        self._schedule_reconnect()
+        return False
+
+    def _on_disconnect(self, client):
+        if client is not self._client or self._closing:
+            return
+        print(f"Lost connection to {self.name}")
+        self._connected.clear()
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self):
+        if self._stale_client is not None:
+            client, self._stale_client = self._stale_client, None
+            try:
+                await client.disconnect()
+            except Exception:
+                pass  # It is being replaced either way
+        backoff = self.min_backoff
+        # Try the cached address first, then alternate with scanning
+        use_cache = True
+        while not self._closing and not self.connected:
+            if await self._connect_once(use_cache):
+                self.reconnects += 1
+                return
+            self.failures += 1
+            use_cache = not use_cache
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def wait_connected(self):
+        """ Lets a consumer hold its own queue while the link is down instead of writing into the void """
+        while not self.connected:
+            self._connected.clear()
+            self._schedule_reconnect()
+            await self._connected.wait()
+
+    def _keep_latest(self, data: bytes):
+        self._latest = bytes(data)
+        self._latest_at = time.perf_counter()
+
+    async def write(self, data: bytes) -> bool:
+        """ Writes `data` if connected, otherwise keeps it as the state to send on reconnect """
+        if not self.connected:
+            self._keep_latest(data)
+            return False
+        started = time.perf_counter()
+        try:
+            await self._client.write_gatt_char(self._char, data, response=self._response)
+        except Exception as e:
+            self.write_errors += 1
+            self._keep_latest(data)
+            WRITE_FAILED.add(self.name, e)
+            # The client may still report itself connected, which would end the
+            # reconnect at once; it is dropped and disconnected by _reconnect()
+            self._stale_client, self._client = self._client, None
+            self._connected.clear()
+            self._schedule_reconnect()
+            return False
+        self.write_time.add(time.perf_counter() - started)
+        self._latest = None
+        return True
+
+    async def close(self):
+        self._closing = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        for client in (self._client, self._stale_client):
+            if client is not None:
+                await client.disconnect()
+
+    def stats(self) -> Dict:
+        return {
+            "connected": self.connected,
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "failures": self.failures,
+            "write_errors": self.write_errors,
+            "stale_dropped": self.stale_dropped,
+            "last_connect_time_s": self.last_connect_time,
+            "write_p99_s": self.write_time.percentile(99),
+        }
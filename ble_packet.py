@@ -0,0 +1,141 @@
+from collections import deque
+from typing import List, Optional, Tuple
+
+from stick_frames import STICK_MAX
+
+# Stick packet written to the BLE device (RC_to_ESP-BLE.ino), shared by RC_to_BLE and ws_to_bluetooth:
+#
+#   byte 0       version (high nibble) and number of samples n (low nibble, 1..15)
+#   byte 1       sequence number of the first sample; sample i is seq + i, wrapping at 256
+#   4 bytes * n  roll, pitch, yaw, throttle of each sample, oldest first; each byte is the
+#                signed stick value (-127..127, as in stick_frames) + 128, so 128 is centred
+#   last byte    CRC-8 (polynomial 0x07, initial value 0) of everything before it
+#
+# One sample is 7 bytes. The device applies the newest sample of a packet and counts the
+# gaps in the sequence numbers as lost samples.
+PACKET_VERSION = 1
+HEADER_SIZE = 2
+SAMPLE_SIZE = 4
+CRC_SIZE = 1
+MAX_SAMPLES = 15
+
+DEFAULT_MTU = 23  # ATT MTU before any exchange; a write then carries DEFAULT_MTU - 3 bytes
+ATT_HEADER_SIZE = 3
+
+
+def _crc8_table() -> List[int]:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+
+_CRC8 = _crc8_table()
+
+
+def crc8(data) -> int:
+    crc = 0
+    for byte in data:
+        crc = _CRC8[crc ^ byte]
+    return crc
+
+
+def packet_size(n_samples: int) -> int:
+    return HEADER_SIZE + n_samples * SAMPLE_SIZE + CRC_SIZE
+
+
+def samples_per_write(max_write_size: int) -> int:
+    """ How many samples fit in one write of at most `max_write_size` bytes """
+    return max(1, min(MAX_SAMPLES, (max_write_size - HEADER_SIZE - CRC_SIZE) // SAMPLE_SIZE))
+
+
+def stick_sample(roll, pitch, yaw, throttle) -> bytes:
+    """ Packs signed stick values (-127..127) into the 4 bytes of one sample; raises
+    ValueError for anything outside that range rather than sending a clamped stick """
+    values = (int(roll), int(pitch), int(yaw), int(throttle))
+    for v in values:
+        if not -STICK_MAX <= v <= STICK_MAX:
+            raise ValueError(f"Stick value {v} outside -{STICK_MAX}..{STICK_MAX}")
+    return bytes(v + 128 for v in values)
+
+
+def encode_packet(seq: int, samples) -> bytes:
+    """ Packs 1..MAX_SAMPLES samples from stick_sample(), the first numbered `seq` """
+    if not 0 < len(samples) <= MAX_SAMPLES:
+        raise ValueError(f"A packet carries 1 to {MAX_SAMPLES} samples, not {len(samples)}")
+    packet = bytearray((PACKET_VERSION << 4 | len(samples), seq & 0xFF))
+    for sample in samples:
+        packet += sample
+    packet.append(crc8(packet))
+    return bytes(packet)
+
+
+def decode_packet(data) -> Tuple[int, List[Tuple[int, int, int, int]]]:
+    """ (seq of the first sample, [(roll, pitch, yaw, throttle), ...]); raises ValueError
+    if `data` is not an intact packet """
+    data = bytes(data)
+    if len(data) < packet_size(1) or data[0] >> 4 != PACKET_VERSION:
+        raise ValueError("Invalid stick packet")
+    n = data[0] & 0x0F
+    if len(data) != packet_size(n) or crc8(data[:-1]) != data[-1]:
+        raise ValueError("Corrupt stick packet")
+    samples = []
+    for offset in range(HEADER_SIZE, HEADER_SIZE + n * SAMPLE_SIZE, SAMPLE_SIZE):
+        samples.append(tuple(b - 128 for b in data[offset:offset + SAMPLE_SIZE]))
+    return data[1], samples
+
+
+class PacketBatcher:
+    """ Numbers stick samples and packs the ones not written yet into a single packet.
+
+    While a write is in flight new samples accumulate here, and the next write carries
+    all of them (as many as fit, newest first), so a slow link sends fewer, fuller
+    packets instead of falling behind. A fast link just gets one sample per packet. """
+
+    def __init__(self):
+        self.seq = 0  # Number of the next sample
+        self.samples = 0
+        self.packets = 0
+        self.skipped = 0  # Samples that never fit in a packet
+        self.rejected = 0  # Samples with a stick out of range, never sent
+        self._pending = deque(maxlen=MAX_SAMPLES)
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def add(self, roll, pitch, yaw, throttle):
+        """ Queues one sample; raises ValueError (and counts it) if a stick is out of range """
+        try:
+            sample = stick_sample(roll, pitch, yaw, throttle)
+        except ValueError:
+            self.rejected += 1
+            raise
+        if len(self._pending) == MAX_SAMPLES:
+            self.skipped += 1
+        self._pending.append(sample)
+        self.seq = (self.seq + 1) & 0xFF
+        self.samples += 1
+
+    def take(self, max_write_size: int = DEFAULT_MTU - ATT_HEADER_SIZE) -> Optional[bytes]:
+        """ Packet of the newest pending samples that fit in `max_write_size` bytes, or None """
+        if not self._pending:
+            return None
+        n = min(len(self._pending), samples_per_write(max_write_size))
+        self.skipped += len(self._pending) - n
+        samples = list(self._pending)[-n:]
+        self._pending.clear()
+        self.packets += 1
+        return encode_packet(self.seq - n, samples)
+
+    def stats(self):
+        return {
+            "samples": self.samples,
+            "packets": self.packets,
+            "skipped": self.skipped,
+            "rejected": self.rejected,
+            "samples_per_packet": (self.samples - self.skipped - self.pending) / self.packets if self.packets else 0.0,
+        }
@@ -0,0 +1,112 @@
+import time
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence
+
+from RCreadSticks import JoyValues
+from scheduler import RateScheduler
+
+PRESSED = "pressed"
+RELEASED = "released"
+HELD = "held"  # Still down `hold_after` seconds after it was pressed; once per press
+
+
+class ButtonEvent(NamedTuple):
+    button: int  # Bit number in dwButtons
+    kind: str
+    timestamp: float  # perf_counter seconds
+    duration: float = 0.0  # How long the button has been down (HELD, RELEASED)
+
+
+def button_mask(buttons: Sequence[bool]) -> int:
+    """ Bitmask of a list of button states, for readers that only return lists """
+    mask = 0
+    for i, down in enumerate(buttons):
+        if down:
+            mask |= 1 << i
+    return mask
+
+
+class ButtonEdges:
+    """ Turns successive dwButtons bitmasks into press/release/hold events.
+
+    A sample where no button changed and no hold is pending costs one XOR, so this
+    can run on every stick sample. `hold_after` is the default hold time in seconds
+    (None for no HELD events); `hold_times` overrides it per button.
+
+    Call update() once per sample; pressed() and released() then read what that
+    sample did, so any number of bindings can check their own button. """
+
+    def __init__(self, hold_after: Optional[float] = None, hold_times: Optional[Dict[int, float]] = None):
+        self.hold_after = hold_after
+        self.hold_times = dict(hold_times or {})
+        self.mask = 0
+        self.went_down = 0  # Buttons pressed on the last update(), as a bitmask
+        self.went_up = 0  # Buttons released on the last update()
+        self.events = 0
+        self._down_since: Dict[int, float] = {}
+        self._holding: Dict[int, float] = {}  # Button -> when its HELD event is due
+
+    def _hold_time(self, button: int) -> Optional[float]:
+        return self.hold_times.get(button, self.hold_after)
+
+    def update(self, mask: int, now: Optional[float] = None) -> List[ButtonEvent]:
+        """ Events since the previous mask, in button order """
+        changed = mask ^ self.mask
+        self.went_down = changed & mask
+        self.went_up = changed & self.mask
+        if not changed and not self._holding:
+            return []
+        if now is None:
+            now = time.perf_counter()
+        events = []
+        bit = 0
+        while changed:
+            if changed & 1:
+                if mask >> bit & 1:
+                    self._down_since[bit] = now
+                    hold = self._hold_time(bit)
+                    if hold is not None:
+                        self._holding[bit] = now + hold
+                    events.append(ButtonEvent(bit, PRESSED, now))
+                else:
+                    since = self._down_since.pop(bit, now)
+                    self._holding.pop(bit, None)
+                    events.append(ButtonEvent(bit, RELEASED, now, now - since))
+            changed >>= 1
+            bit += 1
+        for button, due in list(self._holding.items()):
+            if now >= due:
+                del self._holding[button]
+                events.append(ButtonEvent(button, HELD, now, now - self._down_since[button]))
+        self.mask = mask
+        self.events += len(events)
+        return events
+
+    def pressed(self, button: int) -> bool:
+        """ Whether `button` went down on the last update() """
+        return bool(self.went_down >> button & 1)
+
+    def released(self, button: int) -> bool:
+        """ Whether `button` went up on the last update() """
+        return bool(self.went_up >> button & 1)
+
+    def feed(self, masks: Iterable[int]) -> Iterator[ButtonEvent]:
+        """ Events of a sequence of masks, e.g. from a recording """
+        for mask in masks:
+            yield from self.update(mask)
+
+
+async def button_stream(joystick, rate_hz: float = 100, edges: Optional[ButtonEdges] = None) -> AsyncIterator[ButtonEvent]:
+    """ Polls `joystick` at `rate_hz` and yields its button events as they happen:
+
+        async for event in button_stream(joystick, edges=ButtonEdges(hold_after=1.0)):
+            if event.button == 0 and event.kind == PRESSED:
+                ...
+    """
+    edges = edges or ButtonEdges()
+    values = JoyValues(n_buttons=joystick.buttons)
+    scheduler = RateScheduler(rate_hz, "buttons")
+    while True:
+        if joystick.get(values):
+            for event in edges.update(values.dwButtons):
+                yield event
+        await scheduler.wait_async()
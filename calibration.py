@@ -0,0 +1,157 @@
+import json
+from array import array
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Optional
+
+AXIS_NAMES = ("X", "Y", "Z", "RX", "RY", "RZ")
+OUTPUT_MAX = 127  # Mapped axes span -127..+127
+_MAX_TABLE_SIZE = 0x10000  # Raw positions are 16-bit on every winmm device we have seen
+
+
+@dataclass
+class AxisCalibration:
+    """ Calibration of one axis. Unset values fall back to the device caps. """
+    center: Optional[int] = None
+    min: Optional[int] = None
+    max: Optional[int] = None
+    deadband: int = 2  # Mapped values within +-deadband are reported as 0
+    invert: bool = False
+
+
+@dataclass
+class CalibrationProfile:
+    name: str = ""
+    axes: Dict[str, AxisCalibration] = field(default_factory=dict)
+
+    def axis(self, name: str) -> AxisCalibration:
+        return self.axes.get(name) or AxisCalibration()
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(asdict(self), f, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> "CalibrationProfile":
+        with open(path) as f:
+            data = json.load(f)
+        axes = {name: AxisCalibration(**cal) for name, cal in data.get("axes", {}).items()}
+        return cls(name=data.get("name", ""), axes=axes)
+
+
+def load_profile(path: str) -> Optional[CalibrationProfile]:
+    """ Returns the stored profile, or None if there is none yet """
+    try:
+        return CalibrationProfile.load(path)
+    except FileNotFoundError:
+        return None
+
+
+def build_axis_table(caps, cal: Optional[AxisCalibration] = None) -> array:
+    """ Precomputes the mapped value for every raw position 0..caps.max, so
+    mapping a sample is a single index: table[raw]. """
+    if cal is None:
+        cal = AxisCalibration()
+    lo = caps.min if cal.min is None else cal.min
+    hi = caps.max if cal.max is None else cal.max
+    center = (lo + hi) // 2 if cal.center is None else cal.center
+    size = min(max(caps.max, hi), _MAX_TABLE_SIZE - 1) + 1
+
+    lo = min(max(lo, 0), size - 1)
+    hi = min(max(hi, lo), size - 1)
+    center = min(max(center, lo), hi)
+    low_span = max(center - lo, 1)
+    high_span = max(hi - center, 1)
+    deadband = cal.deadband
+    sign = -1 if cal.invert else 1
+
+    def mapped(offset, span):
+        value = max(min((offset * OUTPUT_MAX) // span, OUTPUT_MAX), -OUTPUT_MAX)
+        return 0 if -deadband <= value <= deadband else sign * value
+
+    # Everything outside [lo, hi] is clamped to the endpoint values
+    values = [mapped(lo - center, low_span)] * lo
+    values += [mapped(raw - center, low_span) for raw in range(lo, center)]
+    values += [mapped(raw - center, high_span) for raw in range(center, hi + 1)]
+    values += [mapped(hi - center, high_span)] * (size - hi - 1)
+    return array("b", values)
+
+
+def build_tables(axes_caps, profile: Optional[CalibrationProfile] = None) -> Dict[str, array]:
+    """ One lookup table per axis, from the device caps plus an optional profile """
+    if profile is None:
+        profile = CalibrationProfile()
+    return {name: build_axis_table(axes_caps[name], profile.axis(name)) for name in AXIS_NAMES}
+
+
+class CalibrationRecorder:
+    """ Builds a profile from raw samples: call `set_center` with the sticks released,
+    then `observe` while moving every stick to its endpoints. """
+
+    def __init__(self, name: str = ""):
+        self.name = name
+        self._center: Dict[str, int] = {}
+        self._min: Dict[str, int] = {}
+        self._max: Dict[str, int] = {}
+
+    def set_center(self, raw_axes: Dict[str, int]):
+        self._center = dict(raw_axes)
+
+    def observe(self, raw_axes: Dict[str, int]):
+        for name, raw in raw_axes.items():
+            if raw < self._min.get(name, raw + 1):
+                self._min[name] = raw
+            if raw > self._max.get(name, raw - 1):
+                self._max[name] = raw
+
+    def profile(self, deadband: int = 2, inverted=()) -> CalibrationProfile:
+        axes = {}
+        for name in AXIS_NAMES:
+            if name not in self._min:
+                continue
+            axes[name] = AxisCalibration(
+                center=self._center.get(name),
+                min=self._min[name],
+                max=self._max[name],
+                deadband=deadband,
+                invert=name in inverted,
+            )
+        return CalibrationProfile(name=self.name, axes=axes)
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    import time
+
+    from RCreadSticks import get_joysticks
+
+    parser = argparse.ArgumentParser(description="Record a joystick calibration profile")
+    parser.add_argument("output", help="Profile file to write (JSON)")
+    parser.add_argument("-t", "--time", type=float, default=10.0, help="Seconds to record stick endpoints")
+    parser.add_argument("-d", "--deadband", type=int, default=2, help="Deadband in mapped units")
+    parser.add_argument("--invert", nargs="*", default=[], choices=AXIS_NAMES, help="Axes to invert")
+    args = parser.parse_args()
+
+    joysticks = get_joysticks()
+    if len(joysticks) == 0:
+        print("No joysticks")
+        sys.exit(1)
+    joystick = joysticks[0]
+    recorder = CalibrationRecorder(joystick.szPname)
+
+    input("Release both sticks and press Enter...")
+    values = joystick.get()
+    if values is None:
+        print("Failed to read joystick")
+        sys.exit(1)
+    recorder.set_center(values.raw_axes)
+
+    print(f"Move every stick to its endpoints for {args.time:.0f} seconds...")
+    deadline = time.monotonic() + args.time
+    while time.monotonic() < deadline:
+        if joystick.get(values):
+            recorder.observe(values.raw_axes)
+        time.sleep(0.01)
+
+    recorder.profile(args.deadband, args.invert).save(args.output)
+    print(f"Saved calibration to {args.output}")
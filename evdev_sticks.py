@@ -0,0 +1,403 @@
+""" Linux joysticks through evdev (/dev/input/event*), behind the same interface as winmm.
+
+get_joysticks() uses this backend where winmm is missing and python-evdev is installed
+(pip install evdev). An EvdevJoystick fills the same JOYINFOEX buffer and caps as a
+winmm Joystick, so JoyValues, calibration and every caller work unchanged:
+
+- get() applies whatever the kernel has reported since the last call, without
+  blocking, so polling loops keep working.
+- wait_report() sleeps on the device's file descriptor (epoll, through the asyncio
+  loop) and returns as soon as the kernel completes a report, and events() yields a
+  snapshot per report; no timer is involved.
+
+Axis positions are offset to start at 0 (evdev ranges may be negative), buttons are
+numbered in key code order, and a report is only made visible once complete, so a
+snapshot never mixes two reports.
+
+A uinput device stands in for a controller where there is none (CI needs write
+access to /dev/uinput):
+
+    python evdev_sticks.py              # Prints the first joystick's reports
+    python evdev_sticks.py --virtual    # Checks this backend against a virtual device
+"""
+import asyncio
+import ctypes
+import re
+import time
+from typing import AsyncIterator, Dict, Optional
+
+import evdev
+from evdev import ecodes
+
+from RCreadSticks import _AXIS_INDEX, _JOYINFO_SIZE, _JOYINFO_WORDS, ChannelCaps, Joystick, JoystickRegistry, JoyValues
+
+# Absolute axes behind the winmm axis names
+AXIS_CODES = {
+    "X": ecodes.ABS_X,
+    "Y": ecodes.ABS_Y,
+    "Z": ecodes.ABS_Z,
+    "RX": ecodes.ABS_RX,
+    "RY": ecodes.ABS_RY,
+    "RZ": ecodes.ABS_RZ,
+}
+MAX_BUTTONS = 32  # dwButtons is 32 bits wide
+POV_CENTERED = 0xFFFF  # What winmm reports without a hat
+UNPLUGGED_RETRY = 1.0  # Seconds between attempts to reopen a device that went away
+
+# Unmapped axes read as centred
+_MISSING_AXIS = ChannelCaps(0, 65535)
+_MISSING_RAW = 32767
+
+
+def is_joystick(device) -> bool:
+    """ The devices the kernel's joydev driver takes for joysticks: an X axis and a
+    trigger, A or 1 button, and not a touchscreen or tablet """
+    caps = device.capabilities(absinfo=False)
+    keys = set(caps.get(ecodes.EV_KEY, []))
+    return ecodes.ABS_X in caps.get(ecodes.EV_ABS, []) and not keys & {ecodes.BTN_TOUCH, ecodes.BTN_DIGI} and \
+        bool(keys & {ecodes.BTN_TRIGGER, ecodes.BTN_A, ecodes.BTN_1})
+
+
+def device_number(path: str) -> int:
+    """ 7 for /dev/input/event7: the id the device gets, like a winmm joystick id """
+    match = re.search(r"(\d+)$", path)
+    return int(match.group(1)) if match else 0
+
+
+class EvdevJoystick(Joystick):
+    """ One /dev/input/event* device; see the module docstring """
+
+    event_driven = True
+
+    def __init__(self, path: str, axis_codes: Optional[Dict[str, int]] = None):
+        super().__init__(device_number(path))
+        self.path = path
+        self.axis_codes = dict(axis_codes or AXIS_CODES)
+        self.device: Optional[evdev.InputDevice] = None
+        self.reports = 0
+        self.report_time = 0.0  # perf_counter() when the last report was read
+        self.dropped = 0  # Times the kernel's buffer overflowed and the state was re-read
+        self._staged = (ctypes.c_uint32 * _JOYINFO_WORDS)()  # The report being received
+        self._index: Dict[int, int] = {}  # Axis code -> JOYINFOEX index
+        self._offset: Dict[int, int] = {}  # Axis code -> its minimum
+        self._bits: Dict[int, int] = {}  # Key code -> button bit
+        self._unread = False
+        self._syncing = False
+        self._open()
+
+    def _open(self) -> bool:
+        try:
+            device = evdev.InputDevice(self.path)
+        except OSError:
+            return False
+        self.device = device
+        self.szPname = device.name
+        self.wMid, self.wPid = device.info.vendor, device.info.product
+
+        absinfo = dict(device.capabilities().get(ecodes.EV_ABS, []))
+        axes = {}
+        self._index.clear()
+        self._offset.clear()
+        for name, code in self.axis_codes.items():
+            info = absinfo.get(code)
+            if info is None:
+                axes[name] = _MISSING_AXIS
+                continue
+            axes[name] = ChannelCaps(0, info.max - info.min)
+            self._index[code] = _AXIS_INDEX[name]
+            self._offset[code] = info.min
+        keys = sorted(k for k in device.capabilities(absinfo=False).get(ecodes.EV_KEY, []) if k >= ecodes.BTN_MISC)
+        self._bits = {key: bit for bit, key in enumerate(keys[:MAX_BUTTONS])}
+
+        if getattr(self, "axes", None) != axes:
+            self._tables = None
+        self.axes = axes
+        self.buttons = len(self._bits)
+        self.loaded = True
+        self._resync()
+        return True
+
+    def _resync(self):
+        """ Reads the whole current state, e.g. after the kernel dropped events """
+        staged = self._staged
+        for name in self.axis_codes:
+            staged[_AXIS_INDEX[name]] = _MISSING_RAW
+        for code, index in self._index.items():
+            staged[index] = self.device.absinfo(code).value - self._offset[code]
+        mask = 0
+        for key in self.device.active_keys():
+            bit = self._bits.get(key)
+            if bit is not None:
+                mask |= 1 << bit
+        staged[8] = mask
+        staged[10] = POV_CENTERED
+        self._publish()
+
+    def _publish(self):
+        staged = self._staged
+        staged[9] = bin(staged[8]).count("1")
+        ctypes.memmove(self._pos_buffer, staged, _JOYINFO_SIZE)
+        self.reports += 1
+        self.report_time = time.perf_counter()
+        self._unread = True
+
+    def _apply(self, event):
+        if event.type == ecodes.EV_ABS:
+            index = self._index.get(event.code)
+            if index is not None and not self._syncing:
+                self._staged[index] = event.value - self._offset[event.code]
+        elif event.type == ecodes.EV_KEY:
+            bit = self._bits.get(event.code)
+            if bit is not None and not self._syncing:
+                if event.value:  # 1 pressed, 2 autorepeat
+                    self._staged[8] |= 1 << bit
+                else:
+                    self._staged[8] &= ~(1 << bit) & 0xFFFFFFFF
+        elif event.type == ecodes.EV_SYN:
+            if event.code == ecodes.SYN_REPORT:
+                if self._syncing:
+                    # Whatever was lost is only known from the device's current state
+                    self._syncing = False
+                    self._resync()
+                else:
+                    self._publish()
+            elif event.code == ecodes.SYN_DROPPED:
+                self.dropped += 1
+                self._syncing = True
+
+    def _drain(self) -> bool:
+        """ Applies every pending event; False if the device is gone """
+        try:
+            for event in self.device.read():
+                self._apply(event)
+        except BlockingIOError:
+            pass
+        except OSError:
+            print(f"Lost joystick {self.szPname} ({self.path})")
+            self.close()
+            if self.registry is not None:
+                self.registry.invalidate()
+            return False
+        return True
+
+    def close(self):
+        if self.device is not None:
+            try:
+                self.device.close()
+            except OSError:
+                pass
+            self.device = None
+        self.loaded = False
+
+    def get(self, out: Optional[JoyValues] = None) -> Optional[JoyValues]:
+        """ The state as of the last complete report """
+        if self.device is None and not self._open():
+            return None
+        if not self._drain():
+            return None
+        self._unread = False
+        if out is None:
+            return JoyValues(self._pos_buffer, self.buttons, self.tables)
+        return out.fill(self._pos_buffer, self.buttons, self.tables)
+
+    async def wait_report(self, timeout: Optional[float] = None) -> bool:
+        """ Waits until the device has reported something get() has not returned yet;
+        False if `timeout` seconds passed first. Returns right away if the device is
+        gone, so the caller's get() can report it. """
+        if self._unread:
+            return True
+        if self.device is None:
+            await asyncio.sleep(UNPLUGGED_RETRY if timeout is None else min(timeout, UNPLUGGED_RETRY))
+            return False
+        loop = asyncio.get_running_loop()
+        reported = loop.create_future()
+
+        def readable():
+            if (not self._drain() or self._unread) and not reported.done():
+                reported.set_result(True)
+
+        fd = self.device.fd
+        loop.add_reader(fd, readable)
+        try:
+            return await asyncio.wait_for(reported, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(fd)
+
+    async def events(self, out: Optional[JoyValues] = None) -> AsyncIterator[JoyValues]:
+        """ Yields a snapshot (the same `out` object, if given) for every report:
+
+            async for values in joystick.events():
+                print(values.axes)
+        """
+        while True:
+            await self.wait_report()
+            values = self.get(out)
+            if values is not None:
+                yield values
+
+
+class EvdevRegistry(JoystickRegistry):
+    """ Lists the joysticks among /dev/input/event*; devices this user may not open are skipped """
+
+    def refresh(self, now: Optional[float] = None) -> bool:
+        if now is None:
+            now = time.monotonic()
+        self._stale = False
+        self._next_rescan = now + self.rescan_interval
+
+        devices = {}
+        caps = {}
+        for path in evdev.list_devices():
+            joy = next((j for j in self._devices.values() if getattr(j, "path", None) == path), None)
+            if joy is not None and joy.device is not None:
+                devices[joy.id] = joy
+                caps[joy.id] = self._caps[joy.id]
+                continue
+            try:
+                device = evdev.InputDevice(path)
+            except OSError:
+                continue
+            try:
+                if not is_joystick(device):
+                    continue
+            finally:
+                device.close()
+            joy = EvdevJoystick(path)
+            if not joy.loaded:
+                continue
+            joy.registry = self
+            devices[joy.id] = joy
+            caps[joy.id] = (joy.szPname, joy.wMid, joy.wPid, tuple(joy.axes.items()), joy.buttons)
+
+        for joy in self._devices.values():
+            if devices.get(joy.id) is not joy:
+                joy.close()
+        changed = caps != self._caps
+        self._devices = devices
+        self._caps = caps
+        if changed:
+            self.generation += 1
+        return changed
+
+
+class VirtualJoystick:
+    """ A uinput joystick with six 0..65535 axes and a few buttons, driven from code:
+
+        with VirtualJoystick() as virtual:
+            joystick = virtual.joystick()
+            virtual.move(X=65535, RZ=0)
+            virtual.press(0)
+    """
+
+    def __init__(self, name: str = "Virtual RC sticks", n_buttons: int = 4):
+        self.buttons = [ecodes.BTN_TRIGGER + i for i in range(n_buttons)]
+        absinfo = evdev.AbsInfo(value=_MISSING_RAW, min=0, max=65535, fuzz=0, flat=0, resolution=0)
+        self.uinput = evdev.UInput({
+            ecodes.EV_ABS: [(code, absinfo) for code in AXIS_CODES.values()],
+            ecodes.EV_KEY: self.buttons,
+        }, name=name)
+
+    @property
+    def path(self) -> str:
+        return self.uinput.device.path
+
+    def joystick(self, timeout: float = 2.0) -> EvdevJoystick:
+        """ This device as an EvdevJoystick, once udev has made its node readable """
+        deadline = time.monotonic() + timeout
+        while True:
+            joy = EvdevJoystick(self.path)
+            if joy.loaded or time.monotonic() > deadline:
+                return joy
+            time.sleep(0.05)
+
+    def move(self, **axes: int):
+        for name, value in axes.items():
+            self.uinput.write(ecodes.EV_ABS, AXIS_CODES[name], value)
+        self.uinput.syn()
+
+    def press(self, button: int, down: bool = True):
+        self.uinput.write(ecodes.EV_KEY, self.buttons[button], 1 if down else 0)
+        self.uinput.syn()
+
+    def close(self):
+        self.uinput.close()
+
+    def __enter__(self) -> "VirtualJoystick":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+async def check_virtual(rounds: int = 100) -> bool:
+    """ Drives a virtual device and checks that every report arrives, and how fast """
+    with VirtualJoystick() as virtual:
+        joystick = virtual.joystick()
+        if not joystick.loaded:
+            print(f"Cannot open {virtual.path}")
+            return False
+        values = JoyValues(n_buttons=joystick.buttons)
+        delays = []
+        ok = True
+        for i in range(rounds):
+            expected = (i * 6553) % 65536
+            button, down = i % joystick.buttons, i % 2 == 0
+            # Marks every report so far as read, so each wait can only end on the new one
+            joystick.get(values)
+            sent = time.perf_counter()
+            virtual.move(X=expected, RZ=65535 - expected)
+            if not await joystick.wait_report(1.0):
+                print(f"Round {i}: no report within 1s")
+                return False
+            delay = joystick.report_time - sent
+            if delay < 0:
+                print(f"Round {i}: report read {-delay * 1e3:.3f}ms before the move was written")
+                ok = False
+            delays.append(delay)
+            joystick.get(values)
+            virtual.press(button, down)
+            if not await joystick.wait_report(1.0):
+                print(f"Round {i}: no button report within 1s")
+                return False
+            joystick.get(values)
+            if values.dwXpos != expected or values.dwVpos != 65535 - expected or \
+                    bool(values.dwButtons >> button & 1) != down:
+                print(f"Round {i}: expected X={expected} RZ={65535 - expected} button {button} "
+                      f"{'down' if down else 'up'}, got {values.raw_axes} buttons={values.dwButtons:#x}")
+                ok = False
+        joystick.close()
+    delays.sort()
+    print(f"{rounds} reports, uinput write -> report read p50={delays[len(delays) // 2] * 1e3:.3f}ms "
+          f"max={delays[-1] * 1e3:.3f}ms, {'OK' if ok else 'FAILED'}")
+    return ok
+
+
+async def print_reports(joystick: EvdevJoystick):
+    async for values in joystick.events():
+        print(f"Joystick values - {values.axes} buttons={values.dwButtons:#x}")
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Read joysticks through evdev")
+    parser.add_argument("--virtual", action="store_true", help="Check the backend against a uinput device")
+    parser.add_argument("-n", "--rounds", type=int, default=100, help="Reports to check with --virtual")
+    args = parser.parse_args()
+
+    if args.virtual:
+        sys.exit(0 if asyncio.run(check_virtual(args.rounds)) else 1)
+
+    joysticks = EvdevRegistry().joysticks()
+    if not joysticks:
+        print("No joysticks (is this user in the 'input' group?)")
+        sys.exit(1)
+    joystick = joysticks[0]
+    print(f"Joystick connected: ID {joystick.id}, Name {joystick.szPname} ({joystick.path})")
+    try:
+        asyncio.run(print_reports(joystick))
+    except KeyboardInterrupt:
+        pass
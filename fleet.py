@@ -0,0 +1,264 @@
+""" Fleet mode: one server for many drones, each with its own stick stream.
+
+Connections say what they are by their request path:
+
+    ws://server:5000/drone/ID          A drone: its ws_to_bluetooth bridge or Android app
+    ws://server:5000/drone, /          The drone with id "default" (the single-drone URLs)
+    ws://server:5000/control/NAME      A controller or scripted source, e.g. Client_readSticks_toWS
+    ws://server:5000/control/NAME?drone=ID   The same, routed to drone ID when it connects
+
+A source drives the drone with its own name unless it has been routed elsewhere
+(`route NAME ID` on the operator socket, or `?drone=ID`); a route can be changed in
+flight and takes effect on the next message. Sources send what the clients already
+send: binary stick frames or stick text (see stick_frames), and command words like
+"takeoff". Anything else, like app text, is passed to the drone's apps as it is.
+
+Every drone id is a session of its own: a StickHub with its connected bridges/apps,
+each with its own mailbox and adaptive send rate. Stick state is coalesced per
+client, so a source that sends faster than a drone's link can take never builds a
+backlog, and a slow or stalled drone only ever delays itself.
+"""
+import asyncio
+import itertools
+import json
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from operator_channel import HELP, OperatorChannel
+from stick_frames import COMMAND_NAMES, COMMAND_NONE, decode, encode_app_text, encode_frame, sticks_in_range
+from stick_hub import DROP, MAX_RATE_HZ, StickHub, Subscriber, publish_to
+
+DRONE = "drone"
+CONTROL = "control"
+DEFAULT_ID = "default"
+
+FLEET_HELP = "drones | routes | route SOURCE DRONE | unroute SOURCE | " + HELP + "; TARGET may also be a drone id"
+
+
+def parse_path(path: str) -> Tuple[str, str, Optional[str]]:
+    """ (DRONE or CONTROL, id, drone id from "?drone=") of a request path; raises
+    ValueError for anything else """
+    url = urlsplit(path or "/")
+    parts = [p for p in url.path.split("/") if p]
+    role = parts[0].lower() if parts else DRONE
+    if role not in (DRONE, CONTROL) or len(parts) > 2:
+        raise ValueError(f"Unknown path: {path}")
+    drone = parse_qs(url.query).get("drone", [None])[0]
+    if len(parts) == 2:
+        name = parts[1]
+    elif role == DRONE and drone:
+        name = drone  # /drone?drone=ID
+    else:
+        name = DEFAULT_ID
+    return role, name, drone
+
+
+def request_path(websocket, path: Optional[str] = None) -> str:
+    """ The request path, from the legacy handler argument or the connection """
+    if path is not None:
+        return path
+    request = getattr(websocket, "request", None)
+    return getattr(request, "path", None) or getattr(websocket, "path", "/")
+
+
+class Source:
+    """ A controller or script sending sticks and commands under one name """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.connections = 0
+        self.messages = 0
+        self.commands = 0
+        self.unrouted = 0  # Messages for a drone that was not connected
+        self.invalid = 0  # Undecodable binary messages and out-of-range sticks
+
+    def stats(self) -> Dict:
+        return {"connections": self.connections, "messages": self.messages, "commands": self.commands,
+                "unrouted": self.unrouted, "invalid": self.invalid}
+
+
+class Fleet:
+    """ Routes the stick streams of many sources to many drones (see the module docstring).
+
+    Looks like a single StickHub to the operator channel and the metrics: select(),
+    publish_command(), stats() and len() cover the clients of every drone, and a
+    target can also be a drone id. """
+
+    def __init__(self, max_commands: int = 64, policy: str = DROP, recorder=None, max_rate_hz: float = MAX_RATE_HZ):
+        self.max_commands = max_commands
+        self.policy = policy
+        self.recorder = recorder  # Optional FlightRecorder for all traffic
+        self.max_rate_hz = max_rate_hz
+        self.hubs: Dict[str, StickHub] = {}  # Drone id -> its session, while it has clients
+        self.sources: Dict[str, Source] = {}
+        self.routes: Dict[str, str] = {}  # Source name -> drone id, where they differ
+        self.connections = 0  # Drone connections accepted
+        self._numbers = itertools.count(1)  # Client numbers, unique across drones
+
+    def __len__(self) -> int:
+        return sum(len(hub) for hub in self.hubs.values())
+
+    def route(self, source: str, drone: Optional[str]):
+        """ Sends what `source` sends to `drone` from now on; None routes it back to its own name """
+        if drone is None or drone == source:
+            self.routes.pop(source, None)
+        else:
+            self.routes[source] = drone
+
+    def drone_for(self, source: str) -> str:
+        return self.routes.get(source, source)
+
+    def hub(self, drone: str) -> StickHub:
+        hub = self.hubs.get(drone)
+        if hub is None:
+            hub = self.hubs[drone] = StickHub(self.max_commands, self.policy, self.recorder, self.max_rate_hz,
+                                              numbers=self._numbers, prefix=drone)
+        return hub
+
+    def select(self, target=None) -> List[Subscriber]:
+        """ Clients matching `target`: None or "all", a drone id, or a client number or name """
+        if target is not None and str(target) in self.hubs:
+            return self.hubs[str(target)].select()
+        subscribers = [s for hub in self.hubs.values() for s in hub.select(target)]
+        return sorted(subscribers, key=lambda s: s.number)
+
+    def publish_command(self, message, target=None, binary: Optional[bytes] = None) -> int:
+        return publish_to(self.select(target), message, binary)
+
+    def forward(self, source: Source, message):
+        """ Publishes one message of `source` to the drone it is routed to """
+        source.messages += 1
+        hub = self.hubs.get(self.drone_for(source.name))
+        if hub is None:
+            source.unrouted += 1
+            return
+        try:
+            frame = decode(message)
+        except ValueError:
+            if isinstance(message, bytes):
+                source.invalid += 1
+                return
+            # Not stick state: a command word like "takeoff", or anything else for the app
+            source.commands += 1
+            hub.publish_command(message.strip())
+            return
+        if not sticks_in_range(frame):
+            # E.g. 0..255 sticks from an old client, which would be full deflection
+            source.invalid += 1
+            return
+        roll, pitch, yaw, throttle, camera = frame[:5]
+        # Movement goes on the coalesced stick lane, without the command; the command
+        # follows on its own lane, so it is delivered exactly once (and a land also
+        # discards the movement queued before it). Text clients, like the app, get the
+        # fractions it parses whichever format the source sent
+        text = encode_app_text(roll, pitch, yaw, throttle)
+        if isinstance(message, bytes):
+            binary = message if frame.command == COMMAND_NONE else \
+                encode_frame(roll, pitch, yaw, throttle, camera, COMMAND_NONE, frame.buttons, frame.seq,
+                             frame.timestamp_us)
+        else:
+            binary = encode_frame(roll, pitch, yaw, throttle, camera)
+        hub.publish_stick(text, binary)
+        name = COMMAND_NAMES.get(frame.command)
+        if name is not None:
+            source.commands += 1
+            hub.publish_command(name, binary=message if isinstance(message, bytes) else
+                                encode_frame(roll, pitch, yaw, throttle, camera, frame.command))
+
+    async def serve_drone(self, websocket, drone: str):
+        hub = self.hub(drone)
+        self.connections += 1
+        print(f"Drone {drone} connected")
+
+        async def receive(websocket, client):
+            async for message in websocket:
+                client.received(message)
+
+        try:
+            await hub.serve(websocket, receive)
+        finally:
+            if not hub.subscribers and self.hubs.get(drone) is hub:
+                del self.hubs[drone]
+
+    async def serve_source(self, websocket, name: str):
+        source = self.sources.get(name)
+        if source is None:
+            source = self.sources[name] = Source(name)
+        source.connections += 1
+        print(f"Source {name} connected, driving drone {self.drone_for(name)}")
+        try:
+            async for message in websocket:
+                self.forward(source, message)
+        finally:
+            source.connections -= 1
+            if not source.connections:
+                del self.sources[name]
+            print(f"Source {name} disconnected: {source.stats()}")
+
+    async def handler(self, websocket, path: Optional[str] = None):
+        """ WebSocket handler for websockets.serve() """
+        try:
+            role, name, drone = parse_path(request_path(websocket, path))
+        except ValueError as e:
+            await websocket.close(1008, str(e))
+            return
+        if role == DRONE:
+            await self.serve_drone(websocket, name)
+            return
+        if drone:
+            self.route(name, drone)
+        await self.serve_source(websocket, name)
+
+    def stats(self) -> Dict:
+        return {
+            "drones": len(self.hubs),
+            "clients": len(self),
+            "connections": self.connections,
+            "routes": dict(self.routes),
+            "sources": {name: s.stats() for name, s in self.sources.items()},
+            "per_drone": {drone: hub.stats() for drone, hub in self.hubs.items()},
+        }
+
+
+class FleetOperatorChannel(OperatorChannel):
+    """ The operator commands, plus routing of sources to drones """
+
+    def execute(self, line: str) -> str:
+        words = line.split()
+        verb = words[0].lower() if words else ""
+        fleet = self.hub
+        if verb == "help":
+            self.commands += 1
+            return "ok " + FLEET_HELP
+        if verb == "drones":
+            self.commands += 1
+            return "ok " + json.dumps({drone: [s.name for s in hub.select()] for drone, hub in fleet.hubs.items()})
+        if verb == "routes":
+            self.commands += 1
+            return "ok " + json.dumps({name: fleet.drone_for(name) for name in {**fleet.sources, **fleet.routes}})
+        if verb == "route":
+            self.commands += 1
+            if len(words) != 3:
+                return "error usage: route SOURCE DRONE"
+            fleet.route(words[1], words[2])
+            print(f"Operator: source {words[1]} -> drone {words[2]}")
+            return f"ok {words[1]} drives {words[2]}"
+        if verb == "unroute":
+            self.commands += 1
+            if len(words) != 2:
+                return "error usage: unroute SOURCE"
+            fleet.route(words[1], None)
+            return f"ok {words[1]} drives {words[1]}"
+        return super().execute(line)
+
+
+def run(main, use_uvloop: bool = False):
+    """ asyncio.run(main), on uvloop if asked for and installed """
+    if use_uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            print("uvloop is not installed (pip install uvloop); using the default event loop")
+        else:
+            return uvloop.run(main)
+    return asyncio.run(main)
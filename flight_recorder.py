@@ -0,0 +1,208 @@
+import mmap
+import os
+import struct
+import time
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from RCreadSticks import _AXIS_INDEX
+
+MAGIC = b"FLTREC1\0"
+VERSION = 1
+
+# magic, version, record size, capacity, records written, wall clock and perf_counter (us) at creation
+HEADER = struct.Struct("<8sHHIQdQ")
+HEADER_SIZE = 64
+# timestamp (perf_counter us), kind, flags, channel (client number), original length, payload
+RECORD = struct.Struct("<QBBHH2x48s")
+PAYLOAD_SIZE = 48
+_COUNT_OFFSET = 16
+
+STICK = 1  # Raw joystick sample: six 16-bit axes and the button bitmask
+OUTBOUND = 2  # Message sent to a client
+INBOUND = 3  # Message received from a client
+
+TEXT = 0x01  # Payload is utf-8 text rather than bytes
+TRUNCATED = 0x02  # Only the first PAYLOAD_SIZE bytes were kept
+
+STICK_PAYLOAD = struct.Struct("<6HI")
+_STICK_WORDS = [_AXIS_INDEX[name] for name in ("X", "Y", "Z", "RX", "RY", "RZ")]
+
+DEFAULT_CAPACITY = 1 << 18  # 16 MB, about 20 minutes of 100 Hz sampling with two clients
+
+
+class Record(NamedTuple):
+    timestamp_us: int
+    kind: int
+    flags: int
+    channel: int
+    length: int
+    payload: bytes
+
+    @property
+    def truncated(self) -> bool:
+        return bool(self.flags & TRUNCATED)
+
+    def message(self):
+        """ The recorded message as it was sent: str for text, bytes otherwise """
+        data = self.payload[:min(self.length, PAYLOAD_SIZE)]
+        return data.decode(errors="replace") if self.flags & TEXT else data
+
+    def stick(self):
+        """ (X, Y, Z, RX, RY, RZ raw positions, buttons) of a STICK record """
+        values = STICK_PAYLOAD.unpack_from(self.payload)
+        return values[:6], values[6]
+
+
+class FlightRecorder:
+    """ Fixed-size binary log in a memory-mapped ring file.
+
+    Each record is 64 bytes written straight into the mapping, so recording costs
+    one struct.pack_into: no formatting, no print, no write() call. The header keeps
+    the number of records written; once the ring is full the oldest are overwritten.
+    Messages longer than 48 bytes are kept truncated (and flagged as such). """
+
+    def __init__(self, path: str, capacity: int = DEFAULT_CAPACITY):
+        size = HEADER_SIZE + capacity * RECORD.size
+        self.path = path
+        self.capacity = capacity
+        self.count = 0
+        with open(path, "w+b") as f:
+            f.truncate(size)
+            self._map = mmap.mmap(f.fileno(), size)
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, RECORD.size, capacity, 0,
+                         time.time(), time.perf_counter_ns() // 1000)
+
+    def record(self, kind: int, payload: bytes, flags: int = 0, channel: int = 0, length: Optional[int] = None,
+               stamp_us: Optional[int] = None):
+        if stamp_us is None:
+            stamp_us = time.perf_counter_ns() // 1000
+        if length is None:
+            length = len(payload)
+        if length > PAYLOAD_SIZE:
+            flags |= TRUNCATED
+        offset = HEADER_SIZE + (self.count % self.capacity) * RECORD.size
+        RECORD.pack_into(self._map, offset, stamp_us, kind, flags, channel, min(length, 0xFFFF), payload)
+        self.count += 1
+        struct.pack_into("<Q", self._map, _COUNT_OFFSET, self.count)
+
+    def stick(self, raw, stamp_us: Optional[int] = None):
+        """ Records a JOYINFOEX buffer (e.g. JoyValues.raw) """
+        self.record(STICK, STICK_PAYLOAD.pack(*(raw[i] & 0xFFFF for i in _STICK_WORDS), raw[8]),
+                    stamp_us=stamp_us)
+
+    def _message(self, kind: int, message, channel: int):
+        if isinstance(message, str):
+            data = message.encode()
+            self.record(kind, data[:PAYLOAD_SIZE], TEXT, channel, len(data))
+        else:
+            self.record(kind, bytes(message[:PAYLOAD_SIZE]), 0, channel, len(message))
+
+    def outbound(self, message, channel: int = 0):
+        self._message(OUTBOUND, message, channel)
+
+    def inbound(self, message, channel: int = 0):
+        self._message(INBOUND, message, channel)
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        if not self._map.closed:
+            self._map.flush()
+            self._map.close()
+
+
+def _read_header(data) -> Dict:
+    magic, version, record_size, capacity, count, created, created_us = HEADER.unpack_from(data)
+    if magic != MAGIC or record_size != RECORD.size:
+        raise ValueError("Not a flight recording")
+    return {"version": version, "capacity": capacity, "count": count, "created": created, "created_us": created_us}
+
+
+def read_header(path: str) -> Dict:
+    with open(path, "rb") as f:
+        return _read_header(f.read(HEADER.size))
+
+
+def read_records(path: str, kinds=None) -> Iterator[Record]:
+    """ Yields the records still in the ring, oldest first """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        header = _read_header(data)
+        capacity, count = header["capacity"], header["count"]
+        for i in range(max(count - capacity, 0), count):
+            record = Record(*RECORD.unpack_from(data, HEADER_SIZE + (i % capacity) * RECORD.size))
+            if kinds is None or record.kind in kinds:
+                yield record
+
+
+def load_session(path: str) -> Dict:
+    """ Loads a recording into NumPy arrays, oldest first:
+
+        "time_s" / "kind" / "channel" / "length" / "flags": one entry per record
+        "stick_time_s", "stick_axes" (n x 6 raw X, Y, Z, RX, RY, RZ) and "stick_buttons"
+
+    Times are seconds since the recording was created. Requires numpy. """
+    import numpy as np
+
+    dtype = np.dtype([("timestamp_us", "<u8"), ("kind", "u1"), ("flags", "u1"), ("channel", "<u2"),
+                      ("length", "<u2"), ("pad", "V2"), ("payload", "V48")])
+    header = read_header(path)
+    capacity, count = header["capacity"], header["count"]
+    records = np.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(capacity,))
+    if count > capacity:
+        records = np.roll(records, -(count % capacity))
+    else:
+        records = records[:count]
+    records = np.array(records)  # Detach from the file
+
+    time_s = (records["timestamp_us"].astype(np.int64) - header["created_us"]) / 1e6
+    sticks = records[records["kind"] == STICK]
+    payload = np.frombuffer(sticks["payload"].tobytes(), dtype=np.uint8).reshape(-1, PAYLOAD_SIZE)
+    return {
+        "header": header,
+        "time_s": time_s,
+        "kind": records["kind"],
+        "flags": records["flags"],
+        "channel": records["channel"],
+        "length": records["length"],
+        "stick_time_s": time_s[records["kind"] == STICK],
+        "stick_axes": payload[:, :12].copy().view("<u2").reshape(-1, 6),
+        "stick_buttons": payload[:, 12:16].copy().view("<u4").reshape(-1),
+    }
+
+
+def stick_trace(path: str, loop: bool = True):
+    """ The recorded stick samples as a sim_joystick trace """
+    from sim_joystick import recorded_trace
+
+    samples: List = []
+    start = None
+    for record in read_records(path, kinds=(STICK,)):
+        if start is None:
+            start = record.timestamp_us
+        axes, buttons = record.stick()
+        samples.append(((record.timestamp_us - start) / 1e6, dict(zip(_AXIS_INDEX, axes)), buttons))
+    return recorded_trace(samples, loop)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarize a flight recording")
+    parser.add_argument("recording", help="Recording file")
+    args = parser.parse_args()
+
+    header = read_header(args.recording)
+    counts: Dict[int, int] = {}
+    first = last = None
+    for record in read_records(args.recording):
+        counts[record.kind] = counts.get(record.kind, 0) + 1
+        first = record.timestamp_us if first is None else first
+        last = record.timestamp_us
+    names = {STICK: "stick samples", OUTBOUND: "outbound", INBOUND: "inbound"}
+    print(f"{args.recording}: {header['count']} records written, capacity {header['capacity']}, "
+          f"started {time.ctime(header['created'])}")
+    if first is not None:
+        print(f"Span: {(last - first) / 1e6:.1f} s ({os.path.getsize(args.recording) / 1e6:.1f} MB file)")
+    for kind, n in sorted(counts.items()):
+        print(f"  {names.get(kind, kind)}: {n}")
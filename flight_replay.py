@@ -0,0 +1,97 @@
+""" Plays a flight recording back at 1x or accelerated speed.
+
+    # Be the server for ws_to_bluetooth: send it what the server sent one client
+    python flight_replay.py flight.flr bridge --port 5000 --speed 4
+
+    # Be a client of a WebSocket server: send it what the server received
+    python flight_replay.py flight.flr server ws://127.0.0.1:5000
+
+Truncated records (messages over 48 bytes) cannot be replayed and are skipped.
+To replay the recorded stick samples through a server or RC_to_BLE instead, use
+flight_recorder.stick_trace() as the trace of a sim_joystick.SimJoystick.
+"""
+import argparse
+import asyncio
+import time
+from typing import List, Optional
+
+import websockets
+
+from flight_recorder import INBOUND, OUTBOUND, Record, read_records
+from stick_frames import SUBPROTOCOLS, select_subprotocol
+
+
+def load_messages(path: str, kind: int, channel: Optional[int] = None) -> List[Record]:
+    """ Replayable records of one kind, from `channel` or else the first channel seen """
+    records = []
+    for record in read_records(path, kinds=(kind,)):
+        if channel is None:
+            channel = record.channel
+        if record.channel == channel and not record.truncated:
+            records.append(record)
+    return records
+
+
+async def play(records: List[Record], send, speed: float = 1.0) -> int:
+    """ Calls `send(message)` for every record, keeping the recorded spacing divided
+    by `speed` (0 sends as fast as possible); returns the number sent """
+    if not records:
+        return 0
+    start = time.perf_counter()
+    first_us = records[0].timestamp_us
+    for record in records:
+        if speed > 0:
+            delay = start + (record.timestamp_us - first_us) / 1e6 / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await send(record.message())
+    return len(records)
+
+
+async def replay_to_bridge(records: List[Record], host: str, port: int, speed: float):
+    """ Serves the recorded outbound messages to every client that connects (e.g. ws_to_bluetooth) """
+    async def handler(websocket, path=None):
+        print(f"Bridge connected, replaying {len(records)} messages")
+        try:
+            sent = await play(records, websocket.send, speed)
+            print(f"Replayed {sent} messages")
+            # Stay connected, or the bridge would reconnect and get the whole replay again
+            await websocket.wait_closed()
+        except websockets.ConnectionClosed:
+            print("Bridge disconnected")
+
+    async with websockets.serve(handler, host, port, subprotocols=SUBPROTOCOLS,
+                                select_subprotocol=select_subprotocol):
+        print(f"Replay server listening on ws://{host}:{port}")
+        await asyncio.Future()  # Run forever
+
+
+async def replay_to_server(records: List[Record], url: str, speed: float):
+    """ Sends the recorded inbound messages to a server as one client """
+    async with websockets.connect(url, subprotocols=SUBPROTOCOLS) as websocket:
+        print(f"Connected to {url}, replaying {len(records)} messages")
+        sent = await play(records, websocket.send, speed)
+        print(f"Replayed {sent} messages")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a flight recording")
+    parser.add_argument("recording", help="Recording file")
+    parser.add_argument("target", choices=["bridge", "server"], help="What to feed the recording into")
+    parser.add_argument("url", nargs="?", default="ws://127.0.0.1:5000", help="Server URL (target 'server')")
+    parser.add_argument("--host", default="0.0.0.0", help="Address to listen on (target 'bridge')")
+    parser.add_argument("-p", "--port", type=int, default=5000, help="Port to listen on (target 'bridge')")
+    parser.add_argument("-s", "--speed", type=float, default=1.0, help="Playback speed, 0 for as fast as possible")
+    parser.add_argument("-c", "--channel", type=int, help="Client number to replay (default: the first one)")
+    args = parser.parse_args()
+
+    if args.target == "bridge":
+        records = load_messages(args.recording, OUTBOUND, args.channel)
+        asyncio.run(replay_to_bridge(records, args.host, args.port, args.speed))
+    else:
+        records = load_messages(args.recording, INBOUND, args.channel)
+        asyncio.run(replay_to_server(records, args.url, args.speed))
+
+
+if __name__ == "__main__":
+    main()
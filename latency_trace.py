@@ -0,0 +1,114 @@
+import json
+import signal
+import socket
+from typing import Dict, Optional
+
+from scheduler import Histogram
+from stick_frames import timestamp_us
+
+# Hop latencies are much wider than loop jitter, so they get their own buckets (microseconds)
+LATENCY_BOUNDS_US = (100, 250, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000)
+
+_WRAP = 1 << 32
+
+
+def is_local_host(host: str) -> bool:
+    """ Whether `host` is this machine (loopback or one of its own addresses), i.e.
+    shares its perf_counter clock """
+    try:
+        infos = socket.getaddrinfo(host, None, type=socket.SOCK_DGRAM)
+    except OSError:
+        return False
+    for family, kind, _, _, address in infos:
+        try:
+            with socket.socket(family, kind) as s:
+                s.bind((address[0], 0))  # Only works for an address of this host
+            return True
+        except OSError:
+            continue
+    return False
+
+
+def elapsed_us(since_us: int, until_us: Optional[int] = None) -> int:
+    """ Wrap-safe difference of two 32-bit microsecond timestamps """
+    if until_us is None:
+        until_us = timestamp_us()
+    delta = (until_us - since_us) % _WRAP
+    return delta if delta < _WRAP // 2 else delta - _WRAP
+
+
+class LatencyTracer:
+    """ Per-hop latency histograms for stick samples travelling through the pipeline.
+
+    Every sample carries its sequence number and the timestamp taken when it was read;
+    each hop records the time elapsed since then. perf_counter is system-wide, so
+    hops measured in different processes on one host are directly comparable. For
+    hops that cross machines set `same_host=False`: the clocks are then unrelated and
+    latency is reported relative to the fastest sample seen on that hop. """
+
+    def __init__(self, name: str = "", same_host: bool = True):
+        self.name = name
+        self.same_host = same_host
+        self.hops: Dict[str, Histogram] = {}
+        self.lost = 0
+        self.reordered = 0
+        self._min_delta: Dict[str, int] = {}
+        self._last_seq: Optional[int] = None
+
+    def _hist(self, hop: str) -> Histogram:
+        hist = self.hops.get(hop)
+        if hist is None:
+            hist = self.hops[hop] = Histogram(LATENCY_BOUNDS_US)
+        return hist
+
+    def record(self, hop: str, seconds: float):
+        self._hist(hop).add(seconds)
+
+    def record_since(self, hop: str, stamp_us: int, until_us: Optional[int] = None):
+        """ Records the time from a sample timestamp (possibly from another process) to now """
+        delta = elapsed_us(stamp_us, until_us)
+        if not self.same_host:
+            best = self._min_delta.get(hop)
+            if best is None or delta < best:
+                best = self._min_delta[hop] = delta
+            delta -= best
+        self._hist(hop).add(max(delta, 0) / 1e6)
+
+    def observe_seq(self, seq: int, bits: int = 16):
+        """ Counts gaps and reordering in the sequence numbers seen at a hop """
+        if self._last_seq is not None:
+            gap = (seq - self._last_seq) % (1 << bits)
+            if gap == 0 or gap > (1 << (bits - 1)):
+                self.reordered += 1
+                return
+            self.lost += gap - 1
+        self._last_seq = seq
+
+    def as_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "same_host": self.same_host,
+            "lost": self.lost,
+            "reordered": self.reordered,
+            "hops": {hop: hist.as_dict() for hop, hist in self.hops.items()},
+        }
+
+    def summary(self) -> str:
+        lines = [f"{self.name or 'latency'}: {self.lost} lost, {self.reordered} reordered"]
+        for hop, hist in self.hops.items():
+            lines.append(f"  {hop}: n={hist.count} p50={hist.percentile(50) * 1e3:.2f}ms "
+                         f"p99={hist.percentile(99) * 1e3:.2f}ms max={hist.max * 1e3:.2f}ms")
+        return "\n".join(lines)
+
+    def dump(self, path: Optional[str] = None):
+        print(self.summary())
+        if path:
+            with open(path, "w") as f:
+                json.dump(self.as_dict(), f, indent=2)
+
+
+def install_dump_handler(tracer: LatencyTracer, path: Optional[str] = None):
+    """ Dumps the histograms on SIGUSR1 (or Ctrl+Break on Windows) without stopping the process """
+    signum = getattr(signal, "SIGUSR1", None) or getattr(signal, "SIGBREAK", None)
+    if signum is not None:
+        signal.signal(signum, lambda *_: tracer.dump(path))
@@ -0,0 +1,469 @@
+""" Load test for WSServer.py: many simulated apps and controllers on localhost.
+
+The server is started as a separate process, so its CPU time and memory can be read
+on their own, and this process plays N drone apps (or bridges) and M controllers:
+
+    fleet  Each controller streams moveDrone sticks on /control/NAME to one of the
+           drones (controller j drives drone j % N), each app connects on /drone/ID
+    echo   The single-drone server: apps connect on /, controllers stream their sticks
+           to the server, and the apps are sent moveDrone messages through the operator
+           socket, the way the operator reaches them
+
+The apps connect like the Android app: they offer no subprotocol and parse the
+4-field "moveDrone:" fractions, and any fraction outside -1..1 is counted as out of
+range. With --bridges they connect like ws_to_bluetooth instead and get frames.
+Every message carries a sequence number, in its camera field and in the roll and
+yaw sticks (the app text has no camera field), so each app can look up when the
+message it received was sent. With --steps the clients are
+added in that many steps, and each step is measured on its own: connection setup
+time, delivery latency over all apps and per app, delivered rate, and the server's
+CPU and memory. The first step whose p99 latency exceeds --limit-ms (or that
+delivers less than 90% of what it should) is where latency degrades.
+
+    python load_test.py --apps 200 --controllers 200 --rate 20 --steps 4
+    python load_test.py --mode echo --apps 50 --controllers 10 -o load_results.json
+
+The clients share one process; if its own CPU use nears 100% the latencies it
+measures include its own queueing, and the numbers are a lower bound on the server.
+"""
+import argparse
+import array
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+import websockets
+
+from latency_trace import LATENCY_BOUNDS_US
+from operator_channel import open_channel
+from scheduler import Histogram, RateScheduler
+from stick_frames import SUBPROTOCOL_BINARY, SUBPROTOCOL_TEXT, STICK_MAX, decode, encode_app_text, encode_frame
+from stick_hub import MAX_RATE_HZ
+
+FLEET = "fleet"
+ECHO = "echo"
+
+SEQ_WINDOW = 4096  # Sequence numbers before they repeat: 40s at 100 Hz
+SEQ_DIGIT = 64  # The roll and yaw sticks carry a sequence number as two base-64 digits
+CONNECT_BATCH = 50  # Connections opened at once
+WARMUP_S = 0.5  # Run before each step is measured
+DELIVERY_THRESHOLD = 0.9  # Of the expected messages per second, below which a step counts as degraded
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "WSServer.py")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _raise_file_limit():
+    """ Every client is a socket here and one in the server, more than the usual 1024 """
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else 65536, hard))
+
+
+def process_usage(pid: int) -> Tuple[Optional[float], Optional[int]]:
+    """ (CPU seconds, resident bytes) of a process, from /proc; (None, None) without it """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None, None
+    # utime and stime are fields 14 and 15 of the whole line, 12 and 13 after the name
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return cpu, resident_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+class Clock:
+    """ When each sequence number was sent, per drone """
+
+    def __init__(self):
+        self.next_seq: Dict[str, int] = {}
+        self.sent: Dict[str, array.array] = {}
+
+    def stamp(self, drone: str) -> int:
+        if drone not in self.sent:
+            self.sent[drone] = array.array("d", bytes(8 * SEQ_WINDOW))
+            self.next_seq[drone] = 0
+        seq = self.next_seq[drone]
+        self.next_seq[drone] = (seq + 1) % SEQ_WINDOW
+        self.sent[drone][seq] = time.perf_counter()
+        return seq
+
+    def age(self, drone: str, seq: int) -> Optional[float]:
+        sent = self.sent.get(drone)
+        if sent is None or not 0 <= seq < SEQ_WINDOW or not sent[seq]:
+            return None
+        return time.perf_counter() - sent[seq]
+
+
+class AppStats:
+    def __init__(self, name: str, drone: str):
+        self.name = name
+        self.drone = drone
+        self.connect_s = 0.0
+        self.received = 0
+        self.out_of_range = 0  # App messages with a stick beyond full deflection
+        self.latency = Histogram(LATENCY_BOUNDS_US)
+        self.closed = False
+
+    def reset(self):
+        self.received = 0
+        self.out_of_range = 0
+        self.latency = Histogram(LATENCY_BOUNDS_US)
+
+
+def sticks(t: float, phase: float) -> Tuple[int, int, int, int]:
+    """ Slow sweeps of all four sticks, like a pilot flying figure eights """
+    return (int(100 * math.sin(0.7 * t + phase)), int(100 * math.sin(1.1 * t + phase)),
+            int(60 * math.sin(0.3 * t + phase)), int(40 * math.sin(0.5 * t + phase)))
+
+
+def stick_message(roll, pitch, yaw, throttle, seq: int, binary: bool):
+    """ The sticks with `seq` in the camera field, and in place of roll and yaw """
+    roll, yaw = seq // SEQ_DIGIT - SEQ_DIGIT // 2, seq % SEQ_DIGIT - SEQ_DIGIT // 2
+    if binary:
+        return encode_frame(roll, pitch, yaw, throttle, seq)
+    return f"moveDrone:{roll},{pitch},{yaw},{throttle},{seq},0"
+
+
+def app_message(roll, pitch, yaw, throttle, seq: int) -> str:
+    """ The app text the fleet makes of stick_message() """
+    frame = decode(stick_message(roll, pitch, yaw, throttle, seq, False))
+    return encode_app_text(*frame[:4])
+
+
+def parse_app_text(message: str) -> Tuple[int, bool]:
+    """ (seq, whether every stick is within -1..1) of the 4-field text the Android app
+    parses ("moveDrone:roll,throttle,yaw,pitch"); ValueError for anything else """
+    if not message.startswith("moveDrone:"):
+        raise ValueError("Not a moveDrone message")
+    fractions = [float(v) for v in message[len("moveDrone:"):].split(",")]
+    if len(fractions) != 4:
+        raise ValueError("The app only parses 4 sticks")
+    roll, yaw = (round(fractions[i] * STICK_MAX) + SEQ_DIGIT // 2 for i in (0, 2))
+    return roll * SEQ_DIGIT + yaw, all(-1.0 <= v <= 1.0 for v in fractions)
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.mode = args.mode
+        self.binary = not args.text
+        self.subprotocol = SUBPROTOCOL_TEXT if args.text else SUBPROTOCOL_BINARY
+        self.app_clients = not args.bridges
+        self.port = _free_port()
+        self.clock = Clock()
+        self.apps: List[AppStats] = []
+        self.controllers = 0
+        self.sent = 0
+        self.failed_connects = 0
+        self.tasks: List[asyncio.Task] = []
+        self.sockets = []
+        self.server: Optional[subprocess.Popen] = None
+        self.operator_address = ""
+
+    # Server
+
+    async def start_server(self, tmp: str):
+        if hasattr(socket, "AF_UNIX"):
+            self.operator_address = os.path.join(tmp, "operator.sock")
+        else:
+            self.operator_address = f"127.0.0.1:{_free_port()}"
+        command = [sys.executable, SERVER, "--host", "127.0.0.1", "--port", str(self.port),
+                   "-o", self.operator_address, "--no-console"]
+        if self.mode == FLEET:
+            command.append("--fleet")
+        if self.args.uvloop:
+            command.append("--uvloop")
+        self.log_path = os.path.join(tmp, "server.log")
+        with open(self.log_path, "w") as log:
+            # Its per-message log is a summary per second on stderr, kept in server.log
+            self.server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=log)
+        deadline = time.perf_counter() + 10
+        while time.perf_counter() < deadline:
+            if self.server.poll() is not None:
+                break
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", self.port)
+                writer.close()
+                return
+            except OSError:
+                await asyncio.sleep(0.1)
+        with open(self.log_path) as log:
+            raise RuntimeError(f"Server did not start:\n{log.read()[-2000:]}")
+
+    def stop_server(self):
+        if self.server is not None and self.server.poll() is None:
+            self.server.terminate()
+            try:
+                self.server.wait(5)
+            except subprocess.TimeoutExpired:
+                self.server.kill()
+
+    # Clients
+
+    def _url(self, path: str) -> str:
+        return f"ws://127.0.0.1:{self.port}{path}"
+
+    async def _connect(self, path: str, like_app: bool = False):
+        """ Like the Android app, a `like_app` client offers no subprotocol """
+        started = time.perf_counter()
+        try:
+            ws = await websockets.connect(self._url(path), subprotocols=None if like_app else [self.subprotocol],
+                                          open_timeout=30)
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException):
+            self.failed_connects += 1
+            return None, 0.0
+        self.sockets.append(ws)
+        return ws, time.perf_counter() - started
+
+    async def _app(self, ws, stats: AppStats):
+        try:
+            async for message in ws:
+                try:
+                    # Text clients get the app's fractions, binary ones frames
+                    if isinstance(message, str) and message.count(",") == 3:
+                        seq, in_range = parse_app_text(message)
+                        if not in_range:
+                            stats.out_of_range += 1
+                    else:
+                        seq = decode(message).camera
+                except ValueError:
+                    continue  # Commands like takeoff
+                age = self.clock.age(stats.drone, seq)
+                if age is not None:
+                    stats.latency.add(age)
+                stats.received += 1
+        except websockets.ConnectionClosed:
+            pass
+        stats.closed = True
+
+    async def _controller(self, ws, drone: str, phase: float):
+        scheduler = RateScheduler(self.args.rate, "controller")
+        await asyncio.sleep(random.uniform(0, 1.0 / self.args.rate))  # Spread the controllers out
+        try:
+            while True:
+                message = stick_message(*sticks(time.perf_counter(), phase), self.clock.stamp(drone), self.binary)
+                await ws.send(message)
+                self.sent += 1
+                await scheduler.wait_async()
+        except websockets.ConnectionClosed:
+            pass
+
+    async def _operator(self):
+        """ Echo mode: broadcasts one moveDrone message to every app per tick """
+        reader, writer = await open_channel(self.operator_address)
+        scheduler = RateScheduler(self.args.rate, "operator")
+        try:
+            while True:
+                stamp = self.clock.stamp(ECHO)
+                if self.app_clients:
+                    message = app_message(*sticks(time.perf_counter(), 0.0), stamp)
+                else:
+                    message = stick_message(*sticks(time.perf_counter(), 0.0), stamp, False)
+                writer.write(f"send all {message}\n".encode())
+                await writer.drain()
+                await reader.readline()
+                await scheduler.wait_async()
+        finally:
+            writer.close()
+
+    async def add_clients(self, apps: int, controllers: int) -> Histogram:
+        """ Connects clients up to `apps` apps and `controllers` controllers; returns their setup times """
+        setup = Histogram(LATENCY_BOUNDS_US)
+        n_drones = max(self.args.apps, 1)
+
+        async def app(i: int):
+            drone = str(i) if self.mode == FLEET else ECHO
+            ws, elapsed = await self._connect(f"/drone/{i}" if self.mode == FLEET else "/", self.app_clients)
+            if ws is None:
+                return
+            stats = AppStats(f"app{i}", drone)
+            stats.connect_s = elapsed
+            setup.add(elapsed)
+            self.apps.append(stats)
+            self.tasks.append(asyncio.create_task(self._app(ws, stats)))
+
+        async def controller(j: int):
+            drone = str(j % n_drones) if self.mode == FLEET else ECHO
+            path = f"/control/c{j}?drone={drone}" if self.mode == FLEET else "/"
+            ws, elapsed = await self._connect(path)
+            if ws is None:
+                return
+            setup.add(elapsed)
+            if self.mode == ECHO:
+                # The server sends every client what the operator sends; nobody reads it here
+                self.tasks.append(asyncio.create_task(self._discard(ws)))
+            self.tasks.append(asyncio.create_task(self._controller(ws, drone, random.uniform(0, 2 * math.pi))))
+
+        pending = [app(i) for i in range(len(self.apps), apps)]
+        pending += [controller(j) for j in range(self.controllers, controllers)]
+        self.controllers = max(self.controllers, controllers)
+        for first in range(0, len(pending), CONNECT_BATCH):
+            await asyncio.gather(*pending[first:first + CONNECT_BATCH])
+        return setup
+
+    @staticmethod
+    async def _discard(ws):
+        try:
+            async for _ in ws:
+                pass
+        except websockets.ConnectionClosed:
+            pass
+
+    def expected_hz(self) -> float:
+        """ Messages per second each app should get if nothing is lost """
+        if self.mode == ECHO:
+            return self.args.rate
+        per_drone = self.controllers / max(len(self.apps), 1)
+        if per_drone < 1:
+            return self.args.rate * per_drone  # Some drones have no controller
+        # The hub coalesces stick state to at most MAX_RATE_HZ per client
+        return min(self.args.rate * per_drone, MAX_RATE_HZ)
+
+    # Steps
+
+    async def measure(self) -> Dict:
+        for stats in self.apps:
+            stats.reset()
+        sent = self.sent
+        server_cpu, _ = process_usage(self.server.pid)
+        own_cpu = time.process_time()
+        started = time.perf_counter()
+        await asyncio.sleep(self.args.duration)
+        elapsed = time.perf_counter() - started
+        own_cpu = time.process_time() - own_cpu
+        server_cpu_end, rss = process_usage(self.server.pid)
+
+        latency = Histogram(LATENCY_BOUNDS_US)
+        for stats in self.apps:
+            latency.merge(stats.latency)
+        per_app_p99 = sorted(s.latency.percentile(99) for s in self.apps if s.latency.count)
+        received = sum(s.received for s in self.apps)
+        rate = received / elapsed / len(self.apps) if self.apps else 0.0
+        return {
+            "apps": len(self.apps),
+            "controllers": self.controllers,
+            "sent_hz": (self.sent - sent) / elapsed,
+            "received_hz_per_app": rate,
+            "expected_hz_per_app": self.expected_hz(),
+            "latency": latency.as_dict(),
+            "per_app_p99_s": {
+                "median": per_app_p99[len(per_app_p99) // 2] if per_app_p99 else 0.0,
+                "worst": per_app_p99[-1] if per_app_p99 else 0.0,
+            },
+            "apps_closed": sum(s.closed for s in self.apps),
+            "out_of_range": sum(s.out_of_range for s in self.apps),
+            "failed_connects": self.failed_connects,
+            "server_cpu_percent": 100.0 * (server_cpu_end - server_cpu) / elapsed if server_cpu is not None else None,
+            "server_rss_mb": rss / 2 ** 20 if rss is not None else None,
+            "client_cpu_percent": 100.0 * own_cpu / elapsed,
+        }
+
+    def degraded(self, step: Dict) -> Optional[str]:
+        p99 = step["latency"]["p99_s"]
+        if p99 * 1e3 > self.args.limit_ms:
+            return f"p99 latency {p99 * 1e3:.1f}ms > {self.args.limit_ms:g}ms"
+        expected = step["expected_hz_per_app"]
+        if expected and step["received_hz_per_app"] < DELIVERY_THRESHOLD * expected:
+            return f"apps get {step['received_hz_per_app']:.1f} of {expected:.1f} messages/s"
+        if step["out_of_range"]:
+            return f"{step['out_of_range']} app messages with sticks beyond full deflection"
+        if step["failed_connects"] or step["apps_closed"]:
+            return f"{step['failed_connects']} connections failed, {step['apps_closed']} closed"
+        return None
+
+    async def run(self) -> List[Dict]:
+        args = self.args
+        steps = []
+        with tempfile.TemporaryDirectory() as tmp:
+            await self.start_server(tmp)
+            try:
+                if self.mode == ECHO:
+                    self.tasks.append(asyncio.create_task(self._operator()))
+                for k in range(1, args.steps + 1):
+                    apps = math.ceil(args.apps * k / args.steps)
+                    controllers = math.ceil(args.controllers * k / args.steps)
+                    setup = await self.add_clients(apps, controllers)
+                    await asyncio.sleep(WARMUP_S)
+                    step = {"step": k, "setup": setup.as_dict(), **(await self.measure())}
+                    step["degraded"] = self.degraded(step)
+                    print(_line(step))
+                    steps.append(step)
+            finally:
+                for task in self.tasks:
+                    task.cancel()
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+                await asyncio.gather(*(ws.close() for ws in self.sockets), return_exceptions=True)
+                self.stop_server()
+        return steps
+
+
+def _line(step: Dict) -> str:
+    lat = step["latency"]
+    cpu = step["server_cpu_percent"]
+    rss = step["server_rss_mb"]
+    return (f"step {step['step']:>2}: {step['apps']:>5} apps {step['controllers']:>5} controllers  "
+            f"setup p99={step['setup']['p99_s'] * 1e3:6.1f}ms  "
+            f"{step['received_hz_per_app']:6.1f}/{step['expected_hz_per_app']:.1f} msg/s per app  "
+            f"p50={lat['p50_s'] * 1e3:6.2f}ms p99={lat['p99_s'] * 1e3:6.2f}ms "
+            f"worst app p99={step['per_app_p99_s']['worst'] * 1e3:6.2f}ms  "
+            f"server cpu={cpu if cpu is not None else float('nan'):5.1f}% "
+            f"rss={rss if rss is not None else float('nan'):6.1f}MB  "
+            f"client cpu={step['client_cpu_percent']:5.1f}%"
+            + (f"  DEGRADED: {step['degraded']}" if step["degraded"] else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test WSServer.py with simulated apps and controllers")
+    parser.add_argument("-m", "--mode", choices=[FLEET, ECHO], default=FLEET, help="How the server is run")
+    parser.add_argument("-a", "--apps", type=int, default=100, help="Simulated drone apps (or bridges)")
+    parser.add_argument("-c", "--controllers", type=int, default=100, help="Simulated controllers")
+    parser.add_argument("-r", "--rate", type=float, default=20, help="moveDrone messages per second per controller")
+    parser.add_argument("-s", "--steps", type=int, default=1, help="Add the clients in this many steps")
+    parser.add_argument("-d", "--duration", type=float, default=5.0, help="Seconds each step is measured")
+    parser.add_argument("--limit-ms", type=float, default=50.0, help="p99 latency above which a step is degraded")
+    parser.add_argument("--text", action="store_true", help="Text moveDrone messages instead of binary frames")
+    parser.add_argument("--bridges", action="store_true",
+                        help="The drones connect like ws_to_bluetooth (with a subprotocol) rather than the app")
+    parser.add_argument("--uvloop", action="store_true", help="Run the server on uvloop")
+    parser.add_argument("-o", "--output", help="Write the results to this file (JSON)")
+    args = parser.parse_args()
+    if args.apps < 1 or args.steps < 1 or args.rate <= 0:
+        parser.error("--apps and --steps must be at least 1 and --rate positive")
+
+    _raise_file_limit()
+    steps = asyncio.run(LoadTest(args).run())
+
+    degraded = next((s for s in steps if s["degraded"]), None)
+    if degraded is None:
+        print(f"No degradation up to {steps[-1]['apps']} apps and {steps[-1]['controllers']} controllers")
+    else:
+        print(f"Latency degrades at step {degraded['step']} ({degraded['apps']} apps, "
+              f"{degraded['controllers']} controllers): {degraded['degraded']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "steps": steps}, f, indent=2)
+        print(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
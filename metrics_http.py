@@ -0,0 +1,399 @@
+""" Prometheus-style metrics and an on-demand profiler over HTTP, served from the
+event loop of the program it instruments:
+
+    GET /metrics                  Metrics in the Prometheus text format
+    GET /profile?seconds=5        Samples the event loop thread's stack for a while and
+                                  returns the hottest stacks (and collapsed stacks for flame graphs)
+    GET /profile/start            Starts sampling in the background ...
+    GET /profile/stop             ... and stops it, returning the same report
+
+Bind it to localhost (the default) unless the network in between is trusted.
+"""
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import stick_log
+from scheduler import Histogram
+
+DEFAULT_HOST = "127.0.0.1"
+PROFILE_INTERVAL = 0.005  # Seconds between stack samples
+MAX_PROFILE_SECONDS = 60
+
+
+class Exposition:
+    """ Collects metrics and formats them in the Prometheus text format, keeping the
+    samples of each metric together whatever order they were added in """
+
+    def __init__(self, prefix: str = "drone_"):
+        self.prefix = prefix
+        self._families: Dict[str, List[str]] = {}
+
+    def _describe(self, name: str, kind: str, help: str) -> List[str]:
+        lines = self._families.get(name)
+        if lines is None:
+            lines = self._families[name] = [f"# HELP {name} {help}"] if help else []
+            lines.append(f"# TYPE {name} {kind}")
+        return lines
+
+    @staticmethod
+    def _labels(labels: Optional[Dict]) -> str:
+        if not labels:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in labels.values())
+        return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+    def add(self, name: str, value, labels: Optional[Dict] = None, kind: str = "gauge", help: str = ""):
+        name = self.prefix + name
+        self._describe(name, kind, help).append(f"{name}{self._labels(labels)} {float(value):g}")
+
+    def counter(self, name: str, value, labels: Optional[Dict] = None, help: str = ""):
+        self.add(name, value, labels, "counter", help)
+
+    def histogram(self, name: str, histogram: Histogram, labels: Optional[Dict] = None, help: str = ""):
+        """ Exports a scheduler.Histogram (bounds in microseconds) in seconds """
+        name = self.prefix + name
+        lines = self._describe(name, "histogram", help)
+        labels = dict(labels or {})
+        seen = 0
+        for bound, n in zip(histogram.bounds_us, histogram.counts):
+            seen += n
+            lines.append(f"{name}_bucket{self._labels({**labels, 'le': f'{bound / 1e6:g}'})} {seen}")
+        lines.append(f"{name}_bucket{self._labels({**labels, 'le': '+Inf'})} {histogram.count}")
+        lines.append(f"{name}_sum{self._labels(labels)} {histogram.total:g}")
+        lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+
+    def text(self) -> str:
+        return "".join(line + "\n" for lines in self._families.values() for line in lines)
+
+
+class LoopLag:
+    """ How late the event loop wakes up a task that asked to sleep `interval` seconds;
+    anything that blocks the loop shows up here """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.lag = Histogram()
+        self.last = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.last = max(time.perf_counter() - started - self.interval, 0.0)
+            self.lag.add(self.last)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def collect(self, out: Exposition):
+        out.histogram("loop_lag_seconds", self.lag, help="Event loop wake-up delay")
+        out.add("loop_lag_last_seconds", self.last)
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+
+
+class StackSampler:
+    """ Sampling profiler for one thread: another thread copies its stack every
+    `interval` seconds, so the profiled code runs at full speed in between """
+
+    def __init__(self, thread_id: Optional[int] = None, interval: float = PROFILE_INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.started = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        if self.running:
+            return
+        self.stacks.clear()
+        self.samples = 0
+        self.started = time.perf_counter()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self.report()
+
+    def report(self, top: int = 20) -> str:
+        """ The hottest leaf functions and stacks, then every stack in collapsed format """
+        total = self.samples or 1
+        leaves = collections.Counter()
+        for stack, n in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += n
+        # An event loop with nothing to do waits in its selector
+        idle = sum(n for leaf, n in leaves.items() if leaf.startswith("selectors.py:"))
+        lines = [f"{self.samples} samples over {time.perf_counter() - self.started:.1f}s, "
+                 f"{100 * idle / total:.1f}% idle", "", "Hottest functions:"]
+        lines += [f"{100 * n / total:6.1f}%  {leaf}" for leaf, n in leaves.most_common(top)]
+        lines += ["", "Hottest stacks:"]
+        for stack, n in self.stacks.most_common(top):
+            lines.append(f"{100 * n / total:6.1f}%  " + "\n         <- ".join(reversed(stack.split(";")[-8:])))
+        lines += ["", "Collapsed stacks:"]
+        lines += [f"{stack} {n}" for stack, n in self.stacks.most_common()]
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """ Minimal HTTP server for /metrics and /profile on the running event loop.
+
+    Each collector is a function that adds the current values to an Exposition;
+    they are called on every scrape, so they should only read existing counters. """
+
+    def __init__(self, port: int, host: str = DEFAULT_HOST, prefix: str = "drone_"):
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.collectors: List[Callable[[Exposition], None]] = []
+        self.loop_lag = LoopLag()
+        self.sampler: Optional[StackSampler] = None
+        self.scrapes = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def add_collector(self, collector: Callable[[Exposition], None]):
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        out = Exposition(self.prefix)
+        self.loop_lag.collect(out)
+        for collector in self.collectors:
+            try:
+                collector(out)
+            except Exception as e:  # One broken collector must not hide the others
+                print(f"Metrics collector {getattr(collector, '__name__', collector)} failed: {e}")
+        out.counter("metrics_scrapes_total", self.scrapes)
+        return out.text()
+
+    async def _profile(self, query: Dict) -> str:
+        seconds = min(float(query.get("seconds", ["5"])[0]), MAX_PROFILE_SECONDS)
+        if self.sampler is not None and self.sampler.running:
+            return "A profile is already running; GET /profile/stop ends it\n"
+        self.sampler = StackSampler(threading.get_ident())
+        self.sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            report = self.sampler.stop()
+        return report
+
+    async def _route(self, path: str, query: Dict):
+        if path == "/metrics":
+            self.scrapes += 1
+            return 200, "text/plain; version=0.0.4", self.render()
+        if path == "/profile":
+            return 200, "text/plain", await self._profile(query)
+        if path == "/profile/start":
+            if self.sampler is None or not self.sampler.running:
+                interval = float(query.get("interval_ms", [PROFILE_INTERVAL * 1e3])[0]) / 1e3
+                self.sampler = StackSampler(threading.get_ident(), interval)
+                self.sampler.start()
+            return 200, "text/plain", "Profiling; GET /profile/stop for the report\n"
+        if path == "/profile/stop":
+            if self.sampler is None:
+                return 409, "text/plain", "Not profiling\n"
+            return 200, "text/plain", self.sampler.stop()
+        return 404, "text/plain", "Try /metrics or /profile?seconds=5\n"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # Headers are not needed
+            parts = request.decode(errors="replace").split()
+            if len(parts) < 2 or parts[0] not in ("GET", "HEAD"):
+                status, kind, body = 405, "text/plain", "Only GET\n"
+            else:
+                url = urlsplit(parts[1])
+                try:
+                    status, kind, body = await self._route(url.path, parse_qs(url.query))
+                except ValueError as e:
+                    status, kind, body = 400, "text/plain", f"{e}\n"
+            data = body.encode()
+            reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 409: "Conflict"}
+            writer.write(f"HTTP/1.1 {status} {reason.get(status, '')}\r\nContent-Type: {kind}\r\n"
+                         f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode())
+            if parts and parts[0] != "HEAD":
+                writer.write(data)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self.loop_lag.start()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        print(f"Metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        self.loop_lag.stop()
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+def parse_metrics_address(address: str):
+    """ (host, port) from "port" or "host:port" """
+    host, _, port = address.rpartition(":")
+    return host or DEFAULT_HOST, int(port)
+
+
+async def start_metrics(address: Optional[str], *collectors) -> Optional[MetricsServer]:
+    """ Starts a MetricsServer on `address` ("port" or "host:port") with the given
+    collectors; does nothing and returns None if `address` is empty """
+    if not address:
+        return None
+    host, port = parse_metrics_address(address)
+    server = MetricsServer(port, host)
+    for collector in collectors:
+        server.add_collector(collector)
+    await server.start()
+    return server
+
+
+def hub_collector(hub) -> Callable[[Exposition], None]:
+    """ Connections, and per client: messages sent, coalesced and dropped, queue depth,
+    send rate and send latency """
+    def collect(out: Exposition):
+        out.add("clients", len(hub), help="Connected WebSocket clients")
+        out.counter("connections_total", hub.connections, help="WebSocket connections accepted")
+        for s in hub.select():
+            labels = {"client": s.name}
+            mailbox = s.mailbox
+            out.counter("client_messages_sent_total", mailbox.delivered, labels, help="Messages sent to the client")
+            out.counter("client_sticks_coalesced_total", mailbox.merged, labels,
+                        help="Stick states replaced by a newer one before being sent")
+            out.counter("client_sticks_dropped_total", mailbox.dropped, labels,
+                        help="Stick states discarded before a stop command")
+            out.counter("client_commands_dropped_total", s.dropped_commands, labels,
+                        help="Commands refused because the client's backlog was full")
+            out.add("client_queue_depth", mailbox.qsize(), labels, help="Messages waiting to be sent")
+            out.add("client_send_rate_hz", s.rate.rate_hz, labels, help="Adaptive stick send rate")
+            out.add("client_send_latency_seconds", s.rate.latency_s, labels, help="Smoothed websocket send time")
+            for lane, histogram in mailbox.latency.items():
+                out.histogram("client_queue_seconds", histogram, {**labels, "lane": lane},
+                              help="Time from queueing to sent, per lane")
+    return collect
+
+
+def fleet_collector(fleet) -> Callable[[Exposition], None]:
+    """ Drone sessions and, per source, messages forwarded or dropped; the clients of
+    every drone are covered by hub_collector(fleet) """
+    def collect(out: Exposition):
+        out.add("fleet_drones", len(fleet.hubs), help="Drones with a connected bridge or app")
+        out.add("fleet_sources", len(fleet.sources), help="Connected controllers and scripted sources")
+        for name, source in fleet.sources.items():
+            labels = {"source": name}
+            out.counter("fleet_source_messages_total", source.messages, labels, help="Messages from a source")
+            out.counter("fleet_source_unrouted_total", source.unrouted, labels,
+                        help="Messages from a source whose drone was not connected")
+            out.counter("fleet_source_invalid_total", source.invalid, labels, help="Undecodable binary messages")
+    return collect
+
+
+def scheduler_collector(scheduler, name: str) -> Callable[[Exposition], None]:
+    """ Ticks, missed ticks and wake-up lateness of a RateScheduler loop """
+    def collect(out: Exposition):
+        labels = {"loop": name}
+        out.counter("loop_ticks_total", scheduler.stats.ticks, labels, help="Iterations of a fixed-rate loop")
+        out.counter("loop_missed_ticks_total", scheduler.stats.missed, labels, help="Deadlines a loop skipped")
+        out.histogram("loop_lateness_seconds", scheduler.stats.lateness, labels,
+                      help="How late a fixed-rate loop woke up")
+    return collect
+
+
+def link_collector(link, rate=None, batcher=None) -> Callable[[Exposition], None]:
+    """ BLE link state, write time and errors, plus the optional AdaptiveRate and PacketBatcher """
+    def collect(out: Exposition):
+        out.add("ble_connected", int(link.connected), help="1 while the BLE link is up")
+        out.counter("ble_connects_total", link.connects, help="Successful BLE connections")
+        out.counter("ble_reconnects_total", link.reconnects)
+        out.counter("ble_connect_failures_total", link.failures)
+        out.counter("ble_write_errors_total", link.write_errors, help="BLE writes that failed")
+        out.histogram("ble_write_seconds", link.write_time, help="Time a successful BLE write took")
+        if rate is not None:
+            out.add("ble_send_rate_hz", rate.rate_hz, help="Adaptive BLE write rate")
+            out.add("ble_send_latency_seconds", rate.latency_s, help="Smoothed BLE write time")
+            out.add("ble_congested", int(rate.congested))
+            out.counter("ble_rate_decreases_total", rate.decreases)
+            out.counter("ble_rate_increases_total", rate.increases)
+        if batcher is not None:
+            out.counter("ble_samples_total", batcher.samples, help="Stick samples queued for the BLE device")
+            out.counter("ble_packets_total", batcher.packets, help="Stick packets written")
+            out.counter("ble_samples_skipped_total", batcher.skipped, help="Samples that never fit in a packet")
+            out.counter("ble_samples_rejected_total", batcher.rejected, help="Samples with a stick out of range")
+    return collect
+
+
+def mailbox_collector(mailbox, name: str) -> Callable[[Exposition], None]:
+    """ Depth and delivery counters of a StickMailbox """
+    def collect(out: Exposition):
+        labels = {"queue": name}
+        out.add("queue_depth", mailbox.qsize(), labels, help="Messages waiting in a queue")
+        out.counter("queue_delivered_total", mailbox.delivered, labels, help="Messages taken from a queue")
+        out.counter("queue_coalesced_total", mailbox.merged, labels,
+                    help="Stick states replaced by a newer one before being taken")
+        for lane, histogram in mailbox.latency.items():
+            out.histogram("queue_seconds", histogram, {**labels, "lane": lane}, help="Time from queueing to sent")
+    return collect
+
+
+def tracer_collector(tracer) -> Callable[[Exposition], None]:
+    """ The hop latencies of a latency_trace.LatencyTracer """
+    def collect(out: Exposition):
+        for hop, histogram in tracer.hops.items():
+            out.histogram("hop_latency_seconds", histogram, {"hop": hop, "tracer": tracer.name},
+                          help="Latency between two points of the stick pipeline")
+        out.counter("frames_lost_total", tracer.lost, {"tracer": tracer.name},
+                    help="Frames missing from the sequence numbers seen")
+    return collect
+
+
+def log_collector(out: Exposition):
+    """ The background log writer's queue, and the frames seen by each FrameLog """
+    stats = stick_log.stats()
+    out.add("log_queue_depth", stats["queued"], help="Log records waiting for the writer thread")
+    out.counter("log_dropped_total", stats["dropped"], help="Log records dropped while the writer was behind")
+    for name, frames in stats["frames"].items():
+        out.counter("log_frames_total", frames, {"log": name}, help="Frames seen by a per-frame log")
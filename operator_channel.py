@@ -0,0 +1,207 @@
+""" Operator commands for a running server, over a local socket instead of its console.
+
+Every line sent to the socket is one command, answered by one line starting with
+"ok" or "error":
+
+    clients                      List the connected clients (JSON)
+    takeoff|land|exit [TARGET]   Send takeoff/land to, or disconnect ("exit"), the clients
+    send TARGET MESSAGE...       Send any message
+    stats                        Hub statistics (JSON)
+    help
+
+TARGET is "all" (the default), a client number ("2" or "#2") or a client name. Any
+other line is sent to all clients as it is, like typing it at the old prompt.
+
+The socket is a Unix domain socket where the platform has them, a localhost TCP port
+otherwise; either way only local users can reach it. This file is also a client:
+
+    python operator_channel.py takeoff
+    python operator_channel.py send 2 moveDrone:0,0,0.2,0
+    python operator_channel.py < mission.txt   # One command per line
+"""
+import argparse
+import asyncio
+import errno
+import json
+import os
+import socket
+import stat
+import sys
+import tempfile
+from typing import Optional, Tuple
+
+if hasattr(socket, "AF_UNIX"):
+    DEFAULT_ADDRESS = os.path.join(tempfile.gettempdir(), "drone_operator.sock")
+else:
+    DEFAULT_ADDRESS = "127.0.0.1:5001"
+
+FLIGHT_COMMANDS = ("takeoff", "land")
+HELP = "clients | takeoff|land|exit [TARGET] | send TARGET MESSAGE | stats | help; TARGET: all, number or name"
+
+
+def parse_address(address: str) -> Tuple[Optional[str], Optional[int]]:
+    """ ("host", port) for "host:port", (path, None) for a Unix socket path """
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit() and os.sep not in address:
+        return host, int(port)
+    return address, None
+
+
+async def remove_stale_socket(path: str):
+    """ Removes the Unix socket at `path` if it was left behind by a server that did not
+    shut down cleanly; raises OSError if a server still answers on it, or if it is not a socket """
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError(errno.EEXIST, f"{path} exists and is not a socket")
+    try:
+        _, writer = await asyncio.open_unix_connection(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.unlink(path)
+        return
+    writer.close()
+    raise OSError(errno.EADDRINUSE, f"Another server takes operator commands on {path}; "
+                                    "stop it or choose another socket with --operator")
+
+
+class OperatorChannel:
+    """ Serves operator commands for a StickHub from the server's own event loop """
+
+    def __init__(self, hub, address: str = DEFAULT_ADDRESS):
+        self.hub = hub
+        self.address = address
+        self.commands = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def execute(self, line: str) -> str:
+        """ Runs one command line and returns the reply """
+        words = line.split()
+        if not words:
+            return "error empty command"
+        verb = words[0].lower()
+        self.commands += 1
+        if verb == "help":
+            return "ok " + HELP
+        if verb == "clients":
+            return "ok " + json.dumps([{
+                "number": s.number,
+                "name": s.name,
+                "address": str(getattr(s.websocket, "remote_address", "")),
+                "binary": s.binary,
+                "rate_hz": round(s.rate.rate_hz, 1),
+                "depth": s.mailbox.qsize(),
+            } for s in self.hub.select()])
+        if verb == "stats":
+            return "ok " + json.dumps(self.hub.stats(), default=str)
+        if verb in FLIGHT_COMMANDS or verb == "exit":
+            if len(words) > 2:
+                return f"error usage: {verb} [TARGET]"
+            target = words[1] if len(words) > 1 else None
+            return self._publish(None if verb == "exit" else verb, target)
+        if verb == "send":
+            parts = line.split(None, 2)
+            if len(parts) < 3:
+                return "error usage: send TARGET MESSAGE"
+            return self._publish(parts[2], parts[1])
+        return self._publish(line.strip(), None)
+
+    def _publish(self, message, target) -> str:
+        if target is not None and not self.hub.select(target):
+            return f"error no client {target}"
+        reached = self.hub.publish_command(message, target)
+        what = "disconnect" if message is None else message
+        print(f"Operator: {what} -> {target or 'all'} ({reached} clients)")
+        return f"ok {what} sent to {reached} clients"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode(errors="replace").strip()
+                if not line or line.startswith("#"):  # Blank lines and comments in scripts
+                    continue
+                writer.write((self.execute(line) + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        host, port = parse_address(self.address)
+        if port is None:
+            await remove_stale_socket(host)
+            self._server = await asyncio.start_unix_server(self._handle, host)
+        else:
+            self._server = await asyncio.start_server(self._handle, host, port)
+        print(f"Operator commands on {self.address}")
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            host, port = parse_address(self.address)
+            if port is None and os.path.exists(host):
+                os.unlink(host)
+
+
+async def console(channel: OperatorChannel):
+    """ The old interactive prompt, for when the server runs in a terminal """
+    while True:
+        try:
+            line = await asyncio.to_thread(input, "Enter a command for the clients (or 'exit' to disconnect them): ")
+        except EOFError:
+            return  # stdin closed; the operator socket still works
+        if line.strip():
+            print(channel.execute(line))
+
+
+def console_wanted(requested: Optional[bool] = None) -> bool:
+    """ The console runs when asked for, or by default when there is a terminal to read from """
+    return requested if requested is not None else sys.stdin.isatty()
+
+
+async def open_channel(address: str):
+    """ (reader, writer) of a connection to the operator socket at `address` """
+    host, port = parse_address(address)
+    if port is None:
+        return await asyncio.open_unix_connection(host)
+    return await asyncio.open_connection(host, port)
+
+
+async def run_commands(address: str, lines) -> bool:
+    """ Sends each command line and prints the replies; False if any of them failed """
+    reader, writer = await open_channel(address)
+    ok = True
+    try:
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            writer.write((line + "\n").encode())
+            await writer.drain()
+            reply = (await reader.readline()).decode().rstrip("\n")
+            print(reply)
+            ok = ok and reply.startswith("ok")
+    finally:
+        writer.close()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send operator commands to a running server")
+    parser.add_argument("command", nargs="*", help="Command to send (default: one per line from stdin)")
+    parser.add_argument("-a", "--address", default=DEFAULT_ADDRESS, help="Operator socket of the server")
+    args = parser.parse_args()
+
+    lines = [" ".join(args.command)] if args.command else sys.stdin
+    sys.exit(0 if asyncio.run(run_commands(args.address, lines)) else 1)
+
+
+if __name__ == "__main__":
+    main()
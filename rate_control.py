@@ -0,0 +1,150 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
+DECISION_INTERVAL = 0.1  # Seconds between rate decisions
+BASE_WINDOW = 10.0  # Seconds over which the uncongested write time is the minimum seen
+
+INCREASE = "increase"
+DECREASE = "decrease"
+HOLD = "hold"
+
+
+class AdaptiveRate:
+    """ Send rate for one link that follows how long its writes take to complete.
+
+    The write time of an idle link (its base) is the shortest one seen lately. When the
+    smoothed write time climbs past `max(target_s, 2 * base)` the link is congested and
+    the rate is cut multiplicatively (from the rate actually achieved, not the nominal
+    one); once it is back under 3/4 of that the rate grows additively towards `max_hz`.
+    A cut never goes below the rate that keeps the link half busy: sending less often
+    cannot make a single write faster, so a link that is just slow (rather than backed
+    up) settles there, until its base catches up (after BASE_WINDOW) and it ramps up.
+    Whatever is sampled while a send waits is coalesced by the caller, so a slow link
+    gets fewer, fresher updates instead of a backlog.
+
+        rate = AdaptiveRate(50, name="ble")
+        await rate.wait()
+        started = time.perf_counter()
+        await link.write(data)
+        rate.observe(time.perf_counter() - started)
+    """
+
+    def __init__(self, max_hz: float, min_hz: float = 1.0, target_s: float = 0.005, name: str = "",
+                 decrease: float = 0.7, increase_hz: Optional[float] = None, smoothing: float = 0.2):
+        if max_hz <= 0 or min_hz <= 0:
+            raise ValueError("Rates must be positive")
+        self.name = name
+        self.max_hz = max_hz
+        self.min_hz = min(min_hz, max_hz)
+        self.target_s = target_s
+        self.decrease = decrease
+        self.increase_hz = increase_hz or max(max_hz / 20, 0.5)
+        self.smoothing = smoothing
+        self.rate_hz = max_hz
+
+        self.latency_s = 0.0  # Smoothed write time
+        self.interval_s = 0.0  # Smoothed time between sends
+        self.writes = 0
+        self.increases = 0
+        self.decreases = 0
+        self.decision = HOLD
+        self.congested = False
+        self._base = float("inf")
+        self._previous_base = float("inf")
+        self._base_since = time.perf_counter()
+        self._last_send: Optional[float] = None
+        self._due: Optional[float] = None  # When the send budget runs out
+        self._last_decision = self._base_since
+        self._writes_at_decision = 0
+
+    @property
+    def base_s(self) -> float:
+        base = min(self._base, self._previous_base)
+        return base if base != float("inf") else 0.0
+
+    @property
+    def threshold_s(self) -> float:
+        return max(self.target_s, 2 * self.base_s)
+
+    def delay(self, now: Optional[float] = None) -> float:
+        """ Seconds until the next send is due """
+        if self._due is None:
+            return 0.0
+        if now is None:
+            now = time.perf_counter()
+        return self._due - 1.0 / self.rate_hz - now
+
+    async def wait(self):
+        delay = self.delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def observe(self, latency: float, now: Optional[float] = None):
+        """ Records a completed write that took `latency` seconds, and adjusts the rate """
+        if now is None:
+            now = time.perf_counter()
+        started = now - latency
+        a = self.smoothing
+        if self.writes == 0:
+            self.latency_s = latency
+        else:
+            self.latency_s += a * (latency - self.latency_s)
+            interval = started - self._last_send
+            # Gaps where there was nothing to send say nothing about the link
+            if interval <= 2.0 / self.rate_hz:
+                self.interval_s = interval if self.interval_s == 0.0 else self.interval_s + a * (interval - self.interval_s)
+        self.writes += 1
+        self._last_send = started
+        # A token bucket holding two sends: traffic at the rate itself never waits for
+        # a little jitter (or for its phase), and a late send may be followed right away
+        self._due = max(self._due or started, started) + 1.0 / self.rate_hz
+
+        # The base is the minimum of the current and the previous window, so it can rise again
+        if now - self._base_since > BASE_WINDOW:
+            self._previous_base, self._base, self._base_since = self._base, float("inf"), now
+        self._base = min(self._base, latency)
+
+        # Decides on fresh writes only; at a low rate that can take longer than DECISION_INTERVAL
+        if now - self._last_decision >= DECISION_INTERVAL and self.writes > self._writes_at_decision:
+            self._last_decision = now
+            self._writes_at_decision = self.writes
+            self._decide()
+
+    def _decide(self):
+        threshold = self.threshold_s
+        if self.latency_s > threshold:
+            achieved = 1.0 / self.interval_s if self.interval_s > 0 else self.rate_hz
+            floor = max(self.min_hz, min(self.max_hz, 0.5 / self.latency_s))
+            rate = max(floor, min(self.rate_hz, achieved) * self.decrease)
+            self.decision = DECREASE
+            self.decreases += 1
+            if not self.congested:
+                print(f"{self.name or 'link'}: congested, writes take {self.latency_s * 1e3:.1f}ms "
+                      f"(> {threshold * 1e3:.1f}ms), {self.rate_hz:.1f} -> {rate:.1f} Hz")
+            self.congested = True
+        elif self.latency_s < 0.75 * threshold and self.rate_hz < self.max_hz:
+            rate = min(self.max_hz, self.rate_hz + self.increase_hz)
+            self.decision = INCREASE
+            self.increases += 1
+            if self.congested:
+                print(f"{self.name or 'link'}: recovered, writes take {self.latency_s * 1e3:.1f}ms, ramping up")
+            self.congested = False
+        else:
+            rate = self.rate_hz
+            self.decision = HOLD
+        self.rate_hz = rate
+
+    def stats(self) -> Dict:
+        return {
+            "rate_hz": self.rate_hz,
+            "max_hz": self.max_hz,
+            "latency_s": self.latency_s,
+            "base_s": self.base_s,
+            "threshold_s": self.threshold_s,
+            "writes": self.writes,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "decision": self.decision,
+            "congested": self.congested,
+        }
@@ -1,229 +1,217 @@
+import argparse
 import asyncio
+import logging
 import websockets
-import ctypes
-from dataclasses import dataclass
-from typing import Dict, List, Optional
-import time
 
-try:
-    winmmdll = ctypes.WinDLL('winmm.dll')
-
-    _joyGetNumDevs_proto = ctypes.WINFUNCTYPE(ctypes.c_uint)
-    _joyGetNumDevs_func = _joyGetNumDevs_proto(("joyGetNumDevs", winmmdll))
-
-    _joyGetDevCaps_proto = ctypes.WINFUNCTYPE(ctypes.c_uint, ctypes.c_uint, ctypes.c_void_p, ctypes.c_uint)
-    _joyGetDevCaps_param = (1, "uJoyID", 0), (1, "pjc", None), (1, "cbjc", 0)
-    _joyGetDevCaps_func = _joyGetDevCaps_proto(("joyGetDevCapsW", winmmdll), _joyGetDevCaps_param)
-
-    _joyGetPosEx_proto = ctypes.WINFUNCTYPE(ctypes.c_uint, ctypes.c_uint, ctypes.c_void_p)
-    _joyGetPosEx_param = (1, "uJoyID", 0), (1, "pji", None)
-    _joyGetPosEx_func = _joyGetPosEx_proto(("joyGetPosEx", winmmdll), _joyGetPosEx_param)
-except:
-    winmmdll = None
-
-JOYERR_NOERROR = 0
-JOY_RETURNY = 0x00000002
-_CAPS_SIZE_W = 728
-_CAPS_OFFSET_V = 4 + 32 * 2
-
-def _joyGetNumDevs():
-    try:
-        num = _joyGetNumDevs_func()
-    except:
-        num = 0
-    return num
-
-def _joyGetDevCaps(uJoyID):
-    try:
-        buffer = (ctypes.c_ubyte * _CAPS_SIZE_W)()
-        p1 = ctypes.c_uint(uJoyID)
-        p2 = ctypes.cast(buffer, ctypes.c_void_p)
-        p3 = ctypes.c_uint(_CAPS_SIZE_W)
-        ret_val = _joyGetDevCaps_func(p1, p2, p3)
-        ret = None if ret_val != JOYERR_NOERROR else buffer
-    except:
-        ret = None
-    return ret
-
-def _joyGetPosEx(uJoyID):
-    try:
-        buffer = (ctypes.c_uint32 * (_JOYINFO_SIZE // 4))()
-        buffer[0] = _JOYINFO_SIZE
-        buffer[1] = JOY_RETURNY
-        p1 = ctypes.c_uint(uJoyID)
-        p2 = ctypes.cast(buffer, ctypes.c_void_p)
-        ret_val = _joyGetPosEx_func(p1, p2)
-        ret = None if ret_val != JOYERR_NOERROR else buffer
-    except:
-        ret = None
-    return ret
-
-@dataclass
-class ChannelCaps:
-    min: int
-    max: int
-
-@dataclass
-class Joystick:
-    id: int
-    axes: Dict[str, ChannelCaps]
-    buttons: int
-
-    def __init__(self, uJoyID):
-        self.id = uJoyID
-        self.loaded = False
-
-    def _load(self, buffer):
-        ushort_array = (ctypes.c_uint16 * 2).from_buffer(buffer)
-        self.wMid, self.wPid = ushort_array
-
-        wchar_array = (ctypes.c_wchar * 32).from_buffer(buffer, 4)
-        self.szPname = ctypes.cast(wchar_array, ctypes.c_wchar_p).value
-
-        uint_array = (ctypes.c_uint32 * 19).from_buffer(buffer, _CAPS_OFFSET_V)
-        self.wXmin, self.wXmax, self.wYmin, self.wYmax, self.wZmin, self.wZmax, \
-            self.wNumButtons, self.wPeriodMin, self.wPeriodMax, \
-            self.wRmin, self.wRmax, self.wUmin, self.wUmax, self.wVmin, self.wVmax, \
-            self.wCaps, self.wMaxAxes, self.wNumAxes, self.wMaxButtons = uint_array
-
-        self.axes = {
-            "X": ChannelCaps(self.wXmin, self.wXmax),
-            "Y": ChannelCaps(self.wYmin, self.wYmax),
-            "Z": ChannelCaps(self.wZmin, self.wZmax),
-            "RX": ChannelCaps(self.wRmin, self.wRmax),
-            "RY": ChannelCaps(self.wUmin, self.wUmax),
-            "RZ": ChannelCaps(self.wVmin, self.wVmax),
-        }
-        self.buttons = self.wNumButtons
-
-    def get(self) -> Optional["JoyValues"]:
-        if not self.loaded:
-            self._load(_joyGetDevCaps(self.id))
-        buf = _joyGetPosEx(self.id)
-        if buf is None:
-            return None
-        return JoyValues(buf, self.buttons)
-
-_JOYINFO_SIZE = 52
-
-@dataclass
-class JoyValues:
-    axes: Dict[str, int]
-    buttons: List[int]
-
-    def __init__(self, buffer, n_buttons):
-        uint_array = (ctypes.c_uint32 * (_JOYINFO_SIZE // 4)).from_buffer(buffer)
-        self.dwSize, self.dwFlags, \
-            self.dwXpos, self.dwYpos, self.dwZpos, self.dwRpos, self.dwUpos, self.dwVpos, \
-            self.dwButtons, self.dwButtonNumber, self.dwPOV, self.dwReserved1, self.dwReserved2 = uint_array
-
-        self.axes = {
-            "X": self.dwXpos,
-            "Y": self.dwYpos,
-            "Z": self.dwZpos,
-            "RX": self.dwRpos,
-            "RY": self.dwUpos,
-            "RZ": self.dwVpos,
-        }
-        self.buttons = [self.dwButtons & 2 ** b != 0 for b in range(n_buttons)]
-
-def get_joysticks() -> List[Joystick]:
-    ret = []
-    for i in range(_joyGetNumDevs()):
-        caps_buf = _joyGetDevCaps(i)
-        if caps_buf is not None:
-            joy = Joystick(i)
-            joy._load(caps_buf)
-            ret.append(joy)
-    return ret
+from RCreadSticks import JoyValues, get_joysticks, wait_sample
+from calibration import load_profile
+from scheduler import RateScheduler
+from flight_recorder import FlightRecorder
+from metrics_http import hub_collector, log_collector, scheduler_collector, start_metrics
+from operator_channel import DEFAULT_ADDRESS, OperatorChannel, console, console_wanted
+from stick_frames import (SUBPROTOCOLS, decode_frame, encode_app_text, encode_frame, select_subprotocol,
+                          timestamp_us)
+from stick_hub import WRITE_LIMIT, StickHub
+from stick_log import FrameLog, add_logging_arguments, setup_logging
+from stick_sampler import start_sampler
+from stick_stream import StickStreamer
+
+JOYSTICK_RATE_HZ = 10  # Joystick samples per second
+
+HOST = "192.168.8.122"
+PORT = 5000
+
+# Written by `python calibration.py calibration.json`; the caps ranges are used if missing
+CALIBRATION_FILE = "calibration.json"
+
+STREAM = "stream"  # All four axes as one proportional moveDrone frame (binary for binary clients)
+WORDS = "words"  # The old left/right/forward/backward messages from the raw X/Y axes
+
+# Joystick axis behind each virtual stick; X and Y are the axes that used to send left/right and forward/backward
+STICK_AXES = ("X", "Y", "Z", "RZ")  # roll, pitch, yaw, throttle
+
+# One joystick loop and the operator commands feed every connected client. Each client
+# has its own send buffer: stick state is coalesced per axis so a stalled link never
+# replays stale movement, commands are delivered exactly once and takeoff/land/stop
+# skip ahead of everything else
+hub = StickHub()
+
+# What the joystick loop has done so far, for the metrics endpoint
+sampling = {"samples": 0, "failed_reads": 0, "scheduler": None}
+
+# What the clients send, logged as one summary per second (every message with --log-level debug)
+RECEIVED = FrameLog("server", "Received from client", ("client", "message"))
+INVALID = FrameLog("server", "Invalid binary message from client", ("client", "payload"), level=logging.WARNING)
+
+# Task to handle receiving messages from a client
+async def receive_messages(websocket, client):
+    async for message in websocket:
+        client.received(message)
+        if isinstance(message, bytes):
+            try:
+                message = decode_frame(message)
+            except ValueError:
+                # Not a stick frame; logged rather than letting it end the connection
+                INVALID.add(client.name, message)
+                continue
+        RECEIVED.add(client.name, message)
 
 # WebSocket server code
-async def echo(websocket, path):
+async def echo(websocket, path=None):  # Newer websockets call handlers without the path
     print("Client connected")
-    
-    # Queue for messages to send to the client
-    message_queue = asyncio.Queue()
-
-    # Background task to handle sending messages to the client
-    async def send_messages():
-        while True:
-            server_message = await message_queue.get()
-            if server_message is None:  # Exit signal
-                print("Closing connection...")
-                await websocket.close()
-                break
-            await websocket.send(server_message)
-
-    # Task to get user input asynchronously
-    async def get_user_input():
-        while True:
-            user_input = await asyncio.to_thread(input, "Enter a message to send to the client (or 'exit' to quit): ")
-            if user_input.lower() == "exit":
-                await message_queue.put(None)  # Signal to stop
-                break
-            if user_input.lower() == "takeoff":
-                # Send takeoff command to the client
-                command_message = "takeoff"
-                await message_queue.put(command_message)
+    await hub.serve(websocket, receive_messages)
+
+# Task to handle joystick inputs and send them to the WebSocket clients
+async def joystick_input(mode=STREAM, deadband=2, keepalive=0.25, sampler_rate=0):
+    joysticks = get_joysticks()
+    if len(joysticks) == 0:
+        print("No joysticks detected!")
+        return
+
+    joystick = joysticks[0]
+    print(f"Joystick connected: ID {joystick.id}, Name {joystick.szPname}")
+
+    # With a sampler the device is polled in its own process, so slow sends cannot delay
+    # sampling; this loop then just picks up the latest sample
+    sampler = await asyncio.to_thread(start_sampler, joystick, sampler_rate) if sampler_rate > 0 else None
+    if sampler is not None:
+        joystick = sampler.joystick()
+    joystick.set_calibration(load_profile(CALIBRATION_FILE))
+
+    values = JoyValues(n_buttons=joystick.buttons)
+    scheduler = RateScheduler(JOYSTICK_RATE_HZ, "joystick_input")
+    sampling["scheduler"] = scheduler
+    try:
+        if mode == STREAM:
+            await stream_sticks(joystick, values, scheduler, StickStreamer(deadband, keepalive))
+        else:
+            await send_directions(joystick, values, scheduler)
+    finally:
+        if sampler is not None:
+            sampler.stop()
+
+# Sends the calibrated sticks as one proportional frame per tick, when they moved or as a keepalive
+async def stream_sticks(joystick, values, scheduler, streamer):
+    seq = 0
+    while True:
+        if joystick.get(values):
+            sampled_at = timestamp_us()
+            sampling["samples"] += 1
+            if hub.recorder is not None:
+                hub.recorder.stick(values.raw)
+            axes = tuple(values.axis(name) for name in STICK_AXES)
+            if streamer.should_send(axes):
+                roll, pitch, yaw, throttle = axes
+                seq += 1
+                # Encoded once per format and shared by every client; a client that connects later starts from it
+                hub.publish_stick(encode_app_text(roll, pitch, yaw, throttle),
+                                  binary=encode_frame(roll, pitch, yaw, throttle, seq=seq, stamp=sampled_at),
+                                  retain=True)
+        else:
+            sampling["failed_reads"] += 1
+
+        # At most once per tick; a Linux (evdev) joystick also waits for the sticks to move, or
+        # for the keepalive, so a change goes out as soon as it is reported
+        await wait_sample(joystick, scheduler, streamer.keepalive or scheduler.period)
+
+# Sends left/right and forward/backward words from the raw left stick
+async def send_directions(joystick, values, scheduler):
+    neutral_range = (32000, 33500)  # Neutral range for X and Y axes
+    tolerance = 0  # Allow a small tolerance for minor movements
+
+    while True:
+        if joystick.get(values):
+            sampling["samples"] += 1
+            if hub.recorder is not None:
+                hub.recorder.stick(values.raw)
+
+            # Read the raw left stick (X and Y axis)
+            x_axis_value = values.dwXpos
+            y_axis_value = values.dwYpos
+
+            # print(f"Joystick values - X: {x_axis_value}, Y: {y_axis_value}")  # Log values
+
+            # Check if the joystick is in the neutral zone
+            if neutral_range[0] - tolerance <= x_axis_value <= neutral_range[1] + tolerance and \
+            neutral_range[0] - tolerance <= y_axis_value <= neutral_range[1] + tolerance:
+                # hub.publish_command("s")
+                pass
             else:
-                await message_queue.put(user_input)
-
-    # Task to handle receiving messages from the client
-    async def receive_messages():
-        async for message in websocket:
-            print(f"Received from client: {message}")
-
-    # Task to handle joystick inputs and send them to the WebSocket client
-    async def joystick_input():
-        joysticks = get_joysticks()
-        if len(joysticks) == 0:
-            print("No joysticks detected!")
-            return
-
-        joystick = joysticks[0]
-        print(f"Joystick connected: ID {joystick.id}, Name {joystick.szPname}")
-
-        neutral_range = (32000, 33500)  # Neutral range for X and Y axes
-        tolerance = 0  # Allow a small tolerance for minor movements
-
-        while True:
-            values = joystick.get()
-            if values:
-                # Read the left stick (X and Y axis)
-                x_axis_value = values.axes["X"]
-                y_axis_value = values.axes["Y"]
-
-                # print(f"Joystick values - X: {x_axis_value}, Y: {y_axis_value}")  # Log values
-
-                # Check if the joystick is in the neutral zone
-                if neutral_range[0] - tolerance <= x_axis_value <= neutral_range[1] + tolerance and \
-                neutral_range[0] - tolerance <= y_axis_value <= neutral_range[1] + tolerance:
-                    # await message_queue.put("s")
-                    pass
-                else:
-                    # Left stick movement logic
-                    if x_axis_value < neutral_range[0] - tolerance:  # Threshold for left movement
-                        await message_queue.put("left")  # Send Left
-                    elif x_axis_value > neutral_range[1] + tolerance:  # Threshold for right movement
-                        await message_queue.put("right")  # Send Right
-
-                    if y_axis_value < neutral_range[0] - tolerance:  # Threshold for down movement
-                        await message_queue.put("backward")  # Send Down
-                    elif y_axis_value > neutral_range[1] + tolerance:  # Threshold for up movement
-                        await message_queue.put("forward")  # Send Up
-
-            await asyncio.sleep(0.1)
-
-
-
-    # Run all tasks concurrently
-    await asyncio.gather(send_messages(), get_user_input(), receive_messages(), joystick_input())
+                # Left stick movement logic
+                if x_axis_value < neutral_range[0] - tolerance:  # Threshold for left movement
+                    hub.publish_stick("left", key="X")  # Send Left
+                elif x_axis_value > neutral_range[1] + tolerance:  # Threshold for right movement
+                    hub.publish_stick("right", key="X")  # Send Right
+
+                if y_axis_value < neutral_range[0] - tolerance:  # Threshold for down movement
+                    hub.publish_stick("backward", key="Y")  # Send Down
+                elif y_axis_value > neutral_range[1] + tolerance:  # Threshold for up movement
+                    hub.publish_stick("forward", key="Y")  # Send Up
+        else:
+            sampling["failed_reads"] += 1
+
+        await scheduler.wait_async()
+
+# Joystick loop counters for the metrics endpoint
+def collect_sampling(out):
+    out.counter("joystick_samples_total", sampling["samples"], help="Joystick samples read")
+    out.counter("joystick_failed_reads_total", sampling["failed_reads"], help="Joystick reads that returned nothing")
+    if sampling["scheduler"] is not None:
+        scheduler_collector(sampling["scheduler"], "joystick_input")(out)
 
 # Start the server
-async def main():
-    async with websockets.serve(echo, "192.168.8.122", 5000):
-        print("WebSocket server listening on ws://192.168.8.122:5000")
-        await asyncio.Future()  # Run forever
+async def main(mode=STREAM, deadband=2, keepalive=0.25, sampler_rate=0, operator_address=DEFAULT_ADDRESS,
+               use_console=None, metrics_address=None, host=HOST, port=PORT):
+    # No client is sent sticks faster than they are sampled; slow clients are sent fewer
+    hub.max_rate_hz = JOYSTICK_RATE_HZ
+    # Operator commands for one or all clients come in over a local socket (and the console, if any)
+    operator = OperatorChannel(hub, operator_address)
+    await operator.start()
+    metrics = await start_metrics(metrics_address, hub_collector(hub), collect_sampling, log_collector)
+    tasks = [joystick_input(mode, deadband, keepalive, sampler_rate)]
+    if console_wanted(use_console):
+        tasks.append(console(operator))
+    try:
+        # Clients that offer no subprotocol (the Android app) get text messages
+        async with websockets.serve(echo, host, port, subprotocols=SUBPROTOCOLS,
+                                    select_subprotocol=select_subprotocol, write_limit=WRITE_LIMIT):
+            print(f"WebSocket server listening on ws://{host}:{port}")
+            # Run all tasks concurrently, forever
+            await asyncio.gather(*tasks)
+            await asyncio.Future()  # Keeps serving operator commands without a joystick
+    finally:
+        await operator.close()
+        if metrics is not None:
+            await metrics.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Joystick WebSocket server")
+    parser.add_argument("-m", "--mode", choices=[STREAM, WORDS], default=STREAM, help="How stick movement is sent")
+    parser.add_argument("-r", "--rate", type=float, default=JOYSTICK_RATE_HZ, help="Joystick samples per second")
+    parser.add_argument("-d", "--deadband", type=int, default=2,
+                        help="Smallest change of an axis (-127..127) that is sent right away")
+    parser.add_argument("-k", "--keepalive", type=float, default=0.25,
+                        help="Seconds after which an unchanged state is sent again")
+    parser.add_argument("-s", "--sampler-rate", type=float, default=0,
+                        help="Poll the joystick at this rate in a separate process (0 polls in the server loop)")
+    parser.add_argument("--record", help="Record stick samples and all traffic into this flight recording file")
+    parser.add_argument("-o", "--operator", default=DEFAULT_ADDRESS,
+                        help="Socket for operator commands: a Unix socket path or host:port")
+    parser.add_argument("--console", action=argparse.BooleanOptionalAction, default=None,
+                        help="Read operator commands from the terminal too (default: when there is one)")
+    parser.add_argument("--metrics", metavar="[HOST:]PORT", help="Serve /metrics and /profile over HTTP")
+    parser.add_argument("--host", default=HOST, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=PORT, help="Port to listen on")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    setup_logging(args.log_level, args.log_json)
+    JOYSTICK_RATE_HZ = args.rate
+    if args.record:
+        hub.recorder = FlightRecorder(args.record)
+
+    try:
+        asyncio.run(main(args.mode, args.deadband, args.keepalive, args.sampler_rate, args.operator, args.console,
+                         args.metrics, args.host, args.port))
+    finally:
+        if hub.recorder is not None:
+            hub.recorder.close()
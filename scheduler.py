@@ -0,0 +1,165 @@
+import asyncio
+import time
+from bisect import bisect_left
+from typing import Dict, Optional
+
+# Upper bounds (in microseconds) of the lateness / overrun histogram buckets
+HISTOGRAM_BOUNDS_US = (50, 100, 250, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+
+SKIP = "skip"  # Merge all missed ticks into the next one and stay on the original grid
+CATCH_UP = "catch_up"  # Run missed ticks back to back until the loop is on schedule again
+
+
+class Histogram:
+    def __init__(self, bounds_us=HISTOGRAM_BOUNDS_US):
+        self.bounds_us = tuple(bounds_us)
+        self.counts = [0] * (len(self.bounds_us) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        us = seconds * 1e6
+        self.counts[bisect_left(self.bounds_us, us)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other: "Histogram"):
+        """ Adds the samples of a histogram with the same bounds """
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p: float) -> float:
+        """ Upper bound (seconds) of the bucket holding the p-th percentile, capped at
+        the largest value seen """
+        if self.count == 0:
+            return 0.0
+        target = p / 100.0 * self.count
+        seen = 0
+        for bound, n in zip(self.bounds_us, self.counts):
+            seen += n
+            if seen >= target:
+                return min(bound / 1e6, self.max)
+        return self.max
+
+    def as_dict(self) -> Dict:
+        labels = [f"<={b}us" for b in self.bounds_us] + [f">{self.bounds_us[-1]}us"]
+        return {
+            "count": self.count,
+            "mean_s": self.total / self.count if self.count else 0.0,
+            "p50_s": self.percentile(50),
+            "p99_s": self.percentile(99),
+            "max_s": self.max,
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class JitterStats:
+    def __init__(self):
+        self.ticks = 0
+        self.missed = 0  # Deadlines that were skipped or merged
+        self.lateness = Histogram()  # Wake-up time minus deadline
+        self.overruns = Histogram()  # Time past the next deadline when the work finished
+
+    def as_dict(self) -> Dict:
+        return {
+            "ticks": self.ticks,
+            "missed": self.missed,
+            "lateness": self.lateness.as_dict(),
+            "overruns": self.overruns.as_dict(),
+        }
+
+    def summary(self, name: str = "") -> str:
+        late = self.lateness
+        return (f"{name or 'loop'}: {self.ticks} ticks, {self.missed} missed, "
+                f"{self.overruns.count} overruns, jitter p50={late.percentile(50) * 1e3:.2f}ms "
+                f"p99={late.percentile(99) * 1e3:.2f}ms max={late.max * 1e3:.2f}ms")
+
+
+class RateScheduler:
+    """ Deadline-based pacing for a fixed-rate loop.
+
+    Deadlines are laid on a fixed grid (start + n * period), so the time spent
+    working in an iteration does not accumulate as drift. Call `wait()` (or
+    `await wait_async()`) once per iteration; both return the number of ticks
+    that were missed since the previous call. """
+
+    def __init__(self, rate_hz: float, name: str = "", policy: str = SKIP, spin: float = 0.0):
+        if rate_hz <= 0:
+            raise ValueError("rate_hz must be positive")
+        if policy not in (SKIP, CATCH_UP):
+            raise ValueError(f"Unknown policy: {policy}")
+        self.name = name
+        self.policy = policy
+        self.spin = spin  # Busy-wait the last `spin` seconds for sub-millisecond accuracy
+        self.stats = JitterStats()
+        self.period = 1.0 / rate_hz
+        self._deadline: Optional[float] = None
+        self._last_missed = 0
+
+    @property
+    def rate_hz(self) -> float:
+        return 1.0 / self.period
+
+    def set_rate(self, rate_hz: float):
+        """ Changes the rate from the next tick on, without resetting the stats; the
+        grid is laid from now, so the next tick is one new period away """
+        self.period = 1.0 / rate_hz
+        if self._deadline is not None:
+            self.restart()
+
+    def reset(self):
+        self._deadline = None
+
+    def restart(self):
+        """ Lays the grid from now on, as if a tick had just happened; for loops that also wait on other things """
+        self._deadline = time.perf_counter()
+
+    def _advance(self, now: float) -> float:
+        """ Accounts for the work just finished and returns the next deadline """
+        missed = 0
+        if self._deadline is None:
+            self._deadline = now
+            self._last_missed = missed
+            return now
+        deadline = self._deadline + self.period
+        if now > deadline:
+            self.stats.overruns.add(now - deadline)
+            if self.policy == SKIP:
+                missed = int((now - deadline) // self.period) + 1
+                deadline += missed * self.period
+        self.stats.missed += missed
+        self._last_missed = missed
+        self._deadline = deadline
+        return deadline
+
+    def _woke(self, deadline: float) -> int:
+        now = time.perf_counter()
+        self.stats.ticks += 1
+        if now > deadline:
+            self.stats.lateness.add(now - deadline)
+        else:
+            self.stats.lateness.add(0.0)
+        return self._last_missed
+
+    def wait(self) -> int:
+        deadline = self._advance(time.perf_counter())
+        remaining = deadline - time.perf_counter() - self.spin
+        if remaining > 0:
+            time.sleep(remaining)
+        while time.perf_counter() < deadline:
+            pass
+        return self._woke(deadline)
+
+    async def wait_async(self) -> int:
+        deadline = self._advance(time.perf_counter())
+        remaining = deadline - time.perf_counter()
+        # Always yield, so a loop that is behind schedule cannot starve the event loop
+        await asyncio.sleep(remaining if remaining > 0 else 0)
+        return self._woke(deadline)
+
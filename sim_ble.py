@@ -0,0 +1,93 @@
+import asyncio
+import json
+import time
+from typing import List, Optional, Tuple
+
+
+class SimCharacteristic:
+    def __init__(self, uuid: str, handle: int = 1, properties=("write", "write-without-response")):
+        self.uuid = uuid
+        self.handle = handle
+        self.properties = list(properties)
+
+
+class SimServices:
+    def __init__(self, characteristic: SimCharacteristic):
+        self._char = characteristic
+
+    def get_characteristic(self, specifier) -> Optional[SimCharacteristic]:
+        if specifier == self._char.handle or str(specifier).lower() == self._char.uuid.lower():
+            return self._char
+        return None
+
+
+class SimBleClient:
+    """ Stand-in for BleakClient, created by SimPeripheral.client() """
+
+    def __init__(self, peripheral: "SimPeripheral", address: str, disconnected_callback=None):
+        self.peripheral = peripheral
+        self.address = address
+        self.services = SimServices(peripheral.characteristic)
+        self.is_connected = False
+        self.mtu_size = peripheral.mtu
+        self._disconnected_callback = disconnected_callback
+
+    async def connect(self):
+        await asyncio.sleep(self.peripheral.connect_delay)
+        if not self.peripheral.available:
+            raise OSError(f"Device {self.address} not available")
+        self.is_connected = True
+        self.peripheral.clients.append(self)
+
+    async def disconnect(self):
+        self.is_connected = False
+
+    async def write_gatt_char(self, char, data, response: bool = False):
+        if not self.is_connected:
+            raise OSError("Not connected")
+        if len(data) > self.mtu_size - 3:
+            raise ValueError(f"Write of {len(data)} bytes does not fit the {self.mtu_size} byte MTU")
+        # A write with response waits a full connection interval for the ack
+        await asyncio.sleep(self.peripheral.response_delay if response else self.peripheral.write_delay)
+        self.peripheral.writes.append((time.perf_counter(), bytes(data), response))
+
+    def drop(self):
+        """ Simulates the peripheral going out of range """
+        self.is_connected = False
+        if self._disconnected_callback is not None:
+            self._disconnected_callback(self)
+
+
+class SimPeripheral:
+    """ In-process BLE peripheral for running the bridges without hardware.
+
+    Pass `client` as BleLink's client_factory. Every accepted write is recorded in
+    `writes` as (perf_counter time, payload, with response). `write_delay` and
+    `response_delay` stand in for the airtime of a write without and with response,
+    and `mtu` is the ATT MTU the connection negotiates. """
+
+    def __init__(self, char_uuid: str, address: str = "SIM:00:00:00:00:01", handle: int = 1,
+                 write_delay: float = 0.0, response_delay: float = 0.0075, connect_delay: float = 0.0,
+                 mtu: int = 23):
+        self.address = address
+        self.characteristic = SimCharacteristic(char_uuid, handle)
+        self.write_delay = write_delay
+        self.response_delay = response_delay
+        self.connect_delay = connect_delay
+        self.mtu = mtu
+        self.available = True
+        self.clients: List[SimBleClient] = []
+        self.writes: List[Tuple[float, bytes, bool]] = []
+
+    def client(self, address: str, disconnected_callback=None) -> SimBleClient:
+        return SimBleClient(self, address, disconnected_callback)
+
+    def write_cache(self, path: str, name: str):
+        """ Writes a BleLink cache entry pointing at this peripheral, so no scan is needed """
+        with open(path, "w") as f:
+            json.dump({name: {"address": self.address, "handle": self.characteristic.handle}}, f)
+
+    def drop(self):
+        for client in self.clients:
+            if client.is_connected:
+                client.drop()
@@ -0,0 +1,155 @@
+import json
+import math
+import time
+from bisect import bisect_right
+from typing import Callable, Dict, List, Optional, Tuple
+
+from RCreadSticks import _AXIS_INDEX, ChannelCaps, Joystick, JoystickRegistry, JoyValues, set_registry
+
+RAW_MAX = 65535
+RAW_CENTER = 32767
+
+# A trace maps the seconds since the first read to (raw axis positions, button bitmask)
+Trace = Callable[[float], Tuple[Dict[str, int], int]]
+
+
+def centered_trace() -> Trace:
+    """ Both sticks released """
+    axes = {name: RAW_CENTER for name in _AXIS_INDEX}
+    return lambda t: (axes, 0)
+
+
+def sine_trace(period: float = 2.0, amplitude: int = 30000) -> Trace:
+    """ Every axis sweeps around the center, each with its own phase """
+    phases = {name: i * math.pi / 3 for i, name in enumerate(_AXIS_INDEX)}
+
+    def trace(t):
+        angle = 2 * math.pi * t / period
+        return {name: RAW_CENTER + int(amplitude * math.sin(angle + phase)) for name, phase in phases.items()}, 0
+    return trace
+
+
+def square_trace(period: float, amplitude: int = 30000, axis: str = "X", offset: float = 0.0) -> Trace:
+    """ Flips one axis between the two sides every half period; the others stay centered """
+    axes = {name: RAW_CENTER for name in _AXIS_INDEX}
+
+    def trace(t):
+        high = ((t + offset) % period) < period / 2
+        axes[axis] = RAW_CENTER + amplitude if high else RAW_CENTER - amplitude
+        return axes, 0
+    return trace
+
+
+def recorded_trace(samples: List[Tuple[float, Dict[str, int], int]], loop: bool = True) -> Trace:
+    """ Replays (t, raw_axes, buttons) samples, holding each one until the next """
+    if not samples:
+        raise ValueError("Empty trace")
+    times = [t for t, _, _ in samples]
+    length = times[-1]
+
+    def trace(t):
+        if loop and length > 0:
+            t %= length
+        i = max(bisect_right(times, t) - 1, 0)
+        return samples[i][1], samples[i][2]
+    return trace
+
+
+def load_trace(path: str, loop: bool = True) -> Trace:
+    """ Reads a trace written by `python sim_joystick.py <path>` (one JSON sample per line) """
+    samples = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                sample = json.loads(line)
+                samples.append((sample["t"], sample["axes"], sample.get("buttons", 0)))
+    return recorded_trace(samples, loop)
+
+
+class SimJoystick(Joystick):
+    """ Joystick that plays a trace instead of calling winmm. It fills the same
+    JOYINFOEX buffer as a real read, so JoyValues, calibration and every caller
+    behave exactly as with a device. `on_sample(now, buffer)` is called after each read. """
+
+    def __init__(self, uJoyID: int = 0, trace: Optional[Trace] = None, name: str = "Simulated joystick",
+                 n_buttons: int = 4, on_sample=None):
+        super().__init__(uJoyID)
+        self.trace = trace or centered_trace()
+        self.on_sample = on_sample
+        self.szPname = name
+        self.wMid = self.wPid = 0
+        self.axes = {axis: ChannelCaps(0, RAW_MAX) for axis in _AXIS_INDEX}
+        self.buttons = n_buttons
+        self.loaded = True
+        self.samples = 0
+        self._start: Optional[float] = None
+
+    def get(self, out=None):
+        now = time.perf_counter()
+        if self._start is None:
+            self._start = now
+        axes, buttons = self.trace(now - self._start)
+        buf = self._pos_buffer
+        for axis, raw in axes.items():
+            buf[_AXIS_INDEX[axis]] = raw
+        buf[8] = buttons
+        self.samples += 1
+        if self.on_sample is not None:
+            self.on_sample(now, buf)
+        if out is None:
+            return JoyValues(buf, self.buttons, self.tables)
+        return out.fill(buf, self.buttons, self.tables)
+
+
+class SimRegistry(JoystickRegistry):
+    """ Registry that lists a fixed set of simulated joysticks """
+
+    def __init__(self, joysticks: List[Joystick]):
+        super().__init__(rescan_interval=math.inf)
+        self._sim = list(joysticks)
+
+    def refresh(self, now: Optional[float] = None) -> bool:
+        self._stale = False
+        devices = {joy.id: joy for joy in self._sim}
+        for joy in devices.values():
+            joy.registry = self
+        changed = devices.keys() != self._devices.keys()
+        self._devices = devices
+        if changed:
+            self.generation += 1
+        return changed
+
+
+def install(*joysticks: Joystick) -> JoystickRegistry:
+    """ Makes get_joysticks() return `joysticks`; returns the previous registry """
+    return set_registry(SimRegistry(list(joysticks)))
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    from RCreadSticks import get_joysticks
+
+    parser = argparse.ArgumentParser(description="Record a raw stick trace for the simulated joystick")
+    parser.add_argument("output", help="Trace file to write (JSON lines)")
+    parser.add_argument("-t", "--time", type=float, default=10.0, help="Seconds to record")
+    parser.add_argument("-r", "--rate", type=float, default=100.0, help="Samples per second")
+    args = parser.parse_args()
+
+    joysticks = get_joysticks()
+    if len(joysticks) == 0:
+        print("No joysticks")
+        sys.exit(1)
+    joystick = joysticks[0]
+    values = JoyValues(n_buttons=joystick.buttons)
+
+    print(f"Recording {joystick.szPname} for {args.time:.0f} seconds...")
+    start = time.perf_counter()
+    with open(args.output, "w") as f:
+        while (now := time.perf_counter()) - start < args.time:
+            if joystick.get(values):
+                f.write(json.dumps({"t": round(now - start, 6), "axes": values.raw_axes,
+                                    "buttons": values.dwButtons}) + "\n")
+            time.sleep(1.0 / args.rate)
+    print(f"Saved trace to {args.output}")
@@ -0,0 +1,138 @@
+import struct
+import time
+from typing import NamedTuple, Optional
+
+# WebSocket subprotocols, in order of preference. A peer that offers none of
+# them (like the Android app) keeps getting "moveDrone:" text messages.
+SUBPROTOCOL_BINARY = "stick.bin.v1"
+SUBPROTOCOL_TEXT = "stick.text"
+SUBPROTOCOLS = [SUBPROTOCOL_BINARY, SUBPROTOCOL_TEXT]
+
+FRAME_VERSION = 1
+
+COMMAND_NONE = 0
+COMMAND_TAKEOFF = 1
+COMMAND_LAND = 2
+
+# The command words text clients (and the operator) use for the command field
+COMMAND_NAMES = {COMMAND_TAKEOFF: "takeoff", COMMAND_LAND: "land"}
+
+# Stick values in frames and stick text are signed, -STICK_MAX..STICK_MAX with 0
+# centred, like RCreadSticks.JoyValues.axis() (not the 0..255 of a BLE packet)
+STICK_MAX = 127
+STICK_RANGE = (-STICK_MAX, STICK_MAX)
+
+# One wire format per direction:
+#   controller -> server -> bridge  Binary frames (SUBPROTOCOL_BINARY), or stick text:
+#                                   "moveDrone:roll,pitch,yaw,throttle,camera,command", six
+#                                   numbers in STICK_RANGE. FrameEncoder writes it, decode_text reads it.
+#   server -> Android app           App text: "moveDrone:roll,throttle,yaw,pitch", four fractions
+#                                   of full deflection in -1..1. encode_app_text writes it; it is
+#                                   only ever parsed by the app, and decode_text rejects it.
+STICK_TEXT_FIELDS = 6
+
+# version, command, seq, timestamp_us, roll, pitch, yaw, throttle, camera, buttons
+FRAME = struct.Struct("<BBHI5hI")
+FRAME_SIZE = FRAME.size  # 22 bytes
+
+
+class StickFrame(NamedTuple):
+    """ One stick sample; the sticks and camera are in STICK_RANGE """
+    roll: int
+    pitch: int
+    yaw: int
+    throttle: int
+    camera: int = 0
+    command: int = COMMAND_NONE
+    buttons: int = 0
+    seq: int = 0
+    timestamp_us: int = 0
+
+
+def select_subprotocol(connection, offered) -> Optional[str]:
+    """ For websockets.serve(select_subprotocol=...): the first of SUBPROTOCOLS the
+    client offers, or None for a client that offers none of them. Servers need it
+    because websockets rejects those clients when only `subprotocols` is given. """
+    for subprotocol in SUBPROTOCOLS:
+        if subprotocol in offered:
+            return subprotocol
+    return None
+
+
+def timestamp_us() -> int:
+    """ Monotonic microseconds, wrapped to the 32 bits carried in a frame """
+    return (time.perf_counter_ns() // 1000) & 0xFFFFFFFF
+
+
+def encode_frame(roll, pitch, yaw, throttle, camera=0, command=COMMAND_NONE, buttons=0,
+                 seq=0, stamp: Optional[int] = None) -> bytes:
+    if stamp is None:
+        stamp = timestamp_us()
+    return FRAME.pack(FRAME_VERSION, command, seq & 0xFFFF, stamp,
+                      int(roll), int(pitch), int(yaw), int(throttle), int(camera), buttons)
+
+
+def _fraction(value, scale) -> float:
+    return min(max(value / scale, -1.0), 1.0)
+
+
+def encode_app_text(roll, pitch, yaw, throttle, scale: int = STICK_MAX) -> str:
+    """ "moveDrone:" text for VirtualStickFragment, which takes roll, throttle, yaw,
+    pitch (in that order) as fractions of full stick deflection, clamped to -1..1 """
+    return (f"moveDrone:{_fraction(roll, scale):.3f},{_fraction(throttle, scale):.3f},"
+            f"{_fraction(yaw, scale):.3f},{_fraction(pitch, scale):.3f}")
+
+
+def sticks_in_range(frame: "StickFrame") -> bool:
+    """ Whether the four sticks of `frame` are within STICK_RANGE """
+    return all(-STICK_MAX <= value <= STICK_MAX for value in frame[:4])
+
+
+def decode_frame(data) -> StickFrame:
+    """ Decodes a binary frame without copying it; raises ValueError if it is not one """
+    view = memoryview(data)
+    if len(view) < FRAME_SIZE or view[0] != FRAME_VERSION:
+        raise ValueError("Invalid stick frame")
+    version, command, seq, stamp, roll, pitch, yaw, throttle, camera, buttons = FRAME.unpack_from(view)
+    return StickFrame(roll, pitch, yaw, throttle, camera, command, buttons, seq, stamp)
+
+
+def decode_text(message: str) -> StickFrame:
+    """ Parses stick text, "moveDrone:r,p,y,t,camera,command"; raises ValueError for
+    anything else, including the 4-field app text, whose fractions it cannot read """
+    if message.startswith("moveDrone:"):
+        message = message[len("moveDrone:"):]
+    values = message.split(',')
+    if len(values) == 4:
+        raise ValueError("4-field moveDrone text is app text (fractions), not stick values")
+    if len(values) != STICK_TEXT_FIELDS:
+        raise ValueError("Invalid message format")
+    try:
+        roll, pitch, yaw, throttle, camera, command = (round(float(value)) for value in values)
+    except OverflowError:
+        raise ValueError("Invalid message format")
+    return StickFrame(roll, pitch, yaw, throttle, camera, command)
+
+
+def decode(message) -> StickFrame:
+    """ Decodes either a binary frame or a text message """
+    if isinstance(message, str):
+        return decode_text(message)
+    return decode_frame(message)
+
+
+class FrameEncoder:
+    """ Numbers outgoing frames and encodes them for the negotiated subprotocol """
+
+    def __init__(self, subprotocol: Optional[str] = None):
+        self.binary = subprotocol == SUBPROTOCOL_BINARY
+        self.seq = 0
+
+    def encode(self, roll, pitch, yaw, throttle, camera=0, command=COMMAND_NONE, buttons=0,
+               stamp: Optional[int] = None):
+        """ `stamp` should be the timestamp_us() taken when the sample was read """
+        self.seq = (self.seq + 1) & 0xFFFF
+        if self.binary:
+            return encode_frame(roll, pitch, yaw, throttle, camera, command, buttons, self.seq, stamp)
+        # Stick text; the buttons are not carried
+        return f"moveDrone:{roll},{pitch},{yaw},{throttle},{camera},{command}"
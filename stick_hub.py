@@ -0,0 +1,182 @@
+import asyncio
+import time
+from typing import Dict, Iterator, List, Optional, Set
+
+from rate_control import AdaptiveRate
+from stick_frames import SUBPROTOCOL_BINARY
+from stick_mailbox import STICK, STICK_KEY, StickMailbox, command_name
+
+# What to do with a subscriber whose command backlog is full
+DROP = "drop"  # Drop the command for that subscriber only
+DISCONNECT = "disconnect"  # Close the connection; the client can reconnect and resync
+
+MAX_RATE_HZ = 100  # Stick messages per second to one client while its connection keeps up
+
+# Bytes a connection may buffer before send() waits for them to drain. Kept small so
+# a congested client shows up as slow sends (and a lower rate) after a few hundred
+# frames, instead of thousands of stale frames queued in the socket.
+WRITE_LIMIT = 4096
+
+
+class Subscriber:
+    """ One connected client: its own send buffer, fed by the hub """
+
+    def __init__(self, websocket, number: int = 0, name: str = "", max_commands: int = 64, policy: str = DROP,
+                 recorder=None, max_rate_hz: float = MAX_RATE_HZ):
+        self.websocket = websocket
+        self.number = number
+        self.name = name
+        self.binary = getattr(websocket, "subprotocol", None) == SUBPROTOCOL_BINARY
+        self.policy = policy
+        self.mailbox = StickMailbox(max_commands)
+        self.dropped_commands = 0
+        self.closed = False
+        self.recorder = recorder  # Optional FlightRecorder
+        # Stick messages are paced by how fast this connection takes them; the mailbox coalesces meanwhile
+        self.rate = AdaptiveRate(max_rate_hz, name=f"client {name}")
+
+    def put_stick(self, text, binary=None, key=STICK_KEY):
+        self.mailbox.put_stick(binary if self.binary and binary is not None else text, key)
+
+    def put_command(self, message, binary=None) -> bool:
+        """ Returns False if the subscriber is too slow and was dropped from the command.
+        Binary clients are sent `binary` instead of the command word, if given. """
+        try:
+            if self.binary and binary is not None:
+                self.mailbox.put_command(binary, command_name(message))
+            else:
+                self.mailbox.put_command(message)
+            return True
+        except asyncio.QueueFull:
+            self.dropped_commands += 1
+            if self.policy == DISCONNECT:
+                self.close()
+            return False
+
+    def close(self):
+        """ Makes the send loop close the connection """
+        if not self.closed:
+            self.closed = True
+            self.mailbox.put_priority(None, stop=True)
+
+    async def send_loop(self):
+        while True:
+            delay = self.rate.delay()
+            if delay > 0 and not self.mailbox.has_priority():
+                await self.mailbox.wait_priority(delay)
+            message = await self.mailbox.get()
+            if message is None:  # Exit signal
+                print(f"Closing connection {self.name}... {self.mailbox.stats()}")
+                await self.websocket.close()
+                break
+            started = time.perf_counter()
+            await self.websocket.send(message)
+            if self.mailbox.in_flight_lane == STICK:
+                done = time.perf_counter()
+                self.rate.observe(done - started, done)
+            self.mailbox.task_done()
+            if self.recorder is not None:
+                self.recorder.outbound(message, self.number)
+
+    def received(self, message):
+        """ To be called with every message from the client, so it is recorded """
+        if self.recorder is not None:
+            self.recorder.inbound(message, self.number)
+
+    def stats(self) -> Dict:
+        return {**self.mailbox.stats(), "dropped_commands": self.dropped_commands, "rate": self.rate.stats()}
+
+
+def publish_to(subscribers, message, binary: Optional[bytes] = None) -> int:
+    """ StickHub.publish_command() for a given list of subscribers """
+    reached = 0
+    for subscriber in subscribers:
+        if message is None:
+            subscriber.close()
+            reached += 1
+        elif subscriber.put_command(message, binary):
+            reached += 1
+    return reached
+
+
+class StickHub:
+    """ Fans one stick producer and one command source out to every connected client.
+
+    Each message is encoded once by the producer and the same object is queued for
+    every subscriber (binary subscribers get the binary encoding if one is given).
+    Every subscriber has its own StickMailbox, so a slow client only ever holds the
+    latest stick state plus a bounded command backlog, and never delays the others. """
+
+    def __init__(self, max_commands: int = 64, policy: str = DROP, recorder=None, max_rate_hz: float = MAX_RATE_HZ,
+                 numbers: Optional[Iterator[int]] = None, prefix: str = ""):
+        if policy not in (DROP, DISCONNECT):
+            raise ValueError(f"Unknown policy: {policy}")
+        self.max_commands = max_commands
+        self.policy = policy
+        self.recorder = recorder  # Optional FlightRecorder for all traffic
+        self.max_rate_hz = max_rate_hz  # Per client; each one backs off on its own while congested
+        self.subscribers: Set[Subscriber] = set()
+        self.connections = 0
+        self._numbers = numbers  # Client numbers, if shared with other hubs; else 1, 2, ...
+        self.prefix = prefix  # Of the default client names, "#1", "#2", ...
+        self._retained: Dict = {}  # Stick state per key that a new client starts from
+
+    def __len__(self) -> int:
+        return len(self.subscribers)
+
+    def subscribe(self, websocket, name: str = "") -> Subscriber:
+        self.connections += 1
+        number = next(self._numbers) if self._numbers is not None else self.connections
+        subscriber = Subscriber(websocket, number, name or f"{self.prefix}#{number}", self.max_commands,
+                                self.policy, self.recorder, self.max_rate_hz)
+        for key, (text, binary) in self._retained.items():
+            subscriber.put_stick(text, binary, key)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish_stick(self, text, binary: Optional[bytes] = None, key=STICK_KEY, retain: bool = False):
+        """ With `retain`, clients that connect later are sent this state right away.
+        Only meant for absolute state: a retained "left" would move the aircraft on connect. """
+        if retain:
+            self._retained[key] = (text, binary)
+        for subscriber in self.subscribers:
+            subscriber.put_stick(text, binary, key)
+
+    def select(self, target=None) -> List[Subscriber]:
+        """ Subscribers matching `target`: None or "all" for every one, else a client
+        number ("2" or "#2") or name """
+        if target is None or str(target).lower() == "all":
+            return sorted(self.subscribers, key=lambda s: s.number)
+        target = str(target)
+        return [s for s in self.subscribers if s.name == target or str(s.number) == target.lstrip("#")]
+
+    def publish_command(self, message, target=None, binary: Optional[bytes] = None) -> int:
+        """ Sends a command to the `target` clients (see select()); `None` closes their
+        connections, like 'exit' on a single connection used to. Binary clients get
+        `binary` (a frame carrying the command) if given. Returns how many it reached. """
+        return publish_to(self.select(target), message, binary)
+
+    async def serve(self, websocket, receive, name: str = ""):
+        """ Runs one client until it disconnects: the hub feeds its send loop and
+        `receive(websocket, subscriber)` handles what it sends """
+        subscriber = self.subscribe(websocket, name)
+        tasks = [asyncio.create_task(subscriber.send_loop()), asyncio.create_task(receive(websocket, subscriber))]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            self.unsubscribe(subscriber)
+            for task in tasks:
+                task.cancel()
+            # A closed connection ends either task with ConnectionClosed; that is the normal way out
+            await asyncio.gather(*tasks, return_exceptions=True)
+            print(f"Client {subscriber.name} disconnected: {subscriber.stats()}")
+
+    def stats(self) -> Dict:
+        return {
+            "clients": len(self.subscribers),
+            "connections": self.connections,
+            "per_client": {s.name: s.stats() for s in self.subscribers},
+        }
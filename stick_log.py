@@ -0,0 +1,235 @@
+""" Logging that stays off the hot path.
+
+Per-frame messages (every stick sample, every frame received or written) go through
+a FrameLog, which folds them into one summary record per interval: how many frames
+there were, their rate and the fields of the last one.
+
+    RECEIVED = FrameLog("bridge", "Received", ("roll", "pitch", "yaw", "throttle"))
+    ...
+    RECEIVED.add(roll, pitch, yaw, throttle)
+
+Records are queued unformatted and formatted and written by a background thread, so
+a slow terminal never stalls the event loop; if the writer falls behind, records are
+dropped and counted rather than queued without limit. The writer also logs the
+summaries that are due when frames stop coming, so the last second of a stream is
+not held back until the next frame. At --log-level debug every
+frame is logged as well as the summaries. At --log-level off, and in code that never
+calls setup_logging(), FrameLog.add is a no-op and nothing is formatted or queued.
+"""
+import argparse
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+ROOT = "drone"  # Every logger of these scripts is under this one
+LEVELS = {"debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING, "off": logging.CRITICAL + 1}
+QUEUE_SIZE = 10000  # Records waiting for the writer before new ones are dropped
+SUMMARY_INTERVAL = 1.0  # Seconds between the summaries of a FrameLog
+FLUSH_PERIOD = 0.25  # Seconds the writer waits for a record before logging due summaries
+
+_frame_logs: List["FrameLog"] = []
+_frame_logs_lock = threading.Lock()
+_handler: Optional["DroppingQueueHandler"] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+
+# Off until setup_logging(), and never passed up to the root logger, whose last resort
+# handler would format and write warnings to stderr on the caller's thread
+logging.getLogger(ROOT).setLevel(LEVELS["off"])
+logging.getLogger(ROOT).propagate = False
+logging.getLogger(ROOT).addHandler(logging.NullHandler())
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+class FieldsFormatter(logging.Formatter):
+    """ "time level logger message key=value ..." """
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per record, with the fields as keys """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"t": round(record.created, 6), "level": record.levelname, "logger": record.name,
+                 "msg": record.getMessage()}
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ Hands records to the writer thread as they are; drops them while its queue is full """
+
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting is left to the writer thread, so log arguments must not be
+        # mutated after the call (FrameLog passes plain values)
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Writer(logging.handlers.QueueListener):
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        while True:
+            try:
+                return self.queue.get(timeout=FLUSH_PERIOD)
+            except queue.Empty:
+                now = time.monotonic()
+                for frame_log in frame_logs():
+                    frame_log.flush_due(now)
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)  # Waits for room, unlike the records
+
+
+def frame_logs() -> List["FrameLog"]:
+    with _frame_logs_lock:
+        return list(_frame_logs)
+
+
+def _ignore(*values):
+    pass
+
+
+class FrameLog:
+    """ A message logged for every frame, written as one summary per `interval` seconds
+    (at `level`), and also once per frame at DEBUG level.
+
+    `fields` names the values passed to add(). Whether it is enabled is worked out
+    when the logging is set up, so a disabled FrameLog costs one call to a no-op.
+    add() may be called from any thread. """
+
+    def __init__(self, name: str, message: str, fields: Sequence[str], interval: float = SUMMARY_INTERVAL,
+                 level: int = logging.INFO):
+        self.logger = get_logger(name)
+        self.message = message
+        self.fields = tuple(fields)
+        self.interval = interval
+        self.level = level
+        self.enabled = False
+        self.count = 0  # Frames since the last summary
+        self.total = 0
+        self.last = ()
+        self._every = False
+        self._since = 0.0  # When the last summary was logged
+        self._due = 0.0
+        self._lock = threading.Lock()  # The writer thread logs due summaries too
+        self.add = _ignore
+        with _frame_logs_lock:
+            _frame_logs.append(self)
+        self.refresh()
+
+    def refresh(self):
+        """ Picks up the logger's level; setup_logging() does this for every FrameLog """
+        self.enabled = self.logger.isEnabledFor(self.level)
+        self._every = self.logger.isEnabledFor(logging.DEBUG)
+        self.add = self._add if self.enabled else _ignore
+
+    def _add(self, *values):
+        now = time.monotonic()
+        with self._lock:
+            self.count += 1
+            self.total += 1
+            self.last = values
+            if now >= self._due:
+                self._summary(now)
+        if self._every:
+            self.logger.debug(self.message, extra={"fields": dict(zip(self.fields, values))})
+
+    def flush(self, now: Optional[float] = None):
+        """ Logs the summary of the frames since the last one, if there were any """
+        with self._lock:
+            self._summary(time.monotonic() if now is None else now)
+
+    def flush_due(self, now: float):
+        """ Logs the summary if its interval is over, although no frame came to log it """
+        if self.enabled and self.count and now >= self._due:
+            with self._lock:
+                if now >= self._due:
+                    self._summary(now)
+
+    def _summary(self, now: float):
+        if not self.count:
+            return
+        fields = dict(zip(self.fields, self.last))
+        fields["frames"] = self.count
+        if self._since:
+            fields["per_s"] = round(self.count / max(now - self._since, 1e-9), 1)
+        self.logger.log(self.level, self.message, extra={"fields": fields})
+        self.count = 0
+        self._since = now
+        self._due = now + self.interval
+
+
+def setup_logging(level: str = "info", json_lines: bool = False, stream=None, queue_size: int = QUEUE_SIZE):
+    """ Sets the level ("debug", "info", "warning" or "off") of every logger under ROOT
+    and starts the writer thread, which writes to `stream` (stderr by default) """
+    global _handler, _listener
+    root = logging.getLogger(ROOT)
+    root.setLevel(LEVELS[level])
+    root.propagate = False
+    if _listener is None and level != "off":
+        output = logging.StreamHandler(stream or sys.stderr)
+        output.setFormatter(JsonFormatter() if json_lines else FieldsFormatter())
+        _handler = DroppingQueueHandler(queue.Queue(queue_size))
+        _listener = _Writer(_handler.queue, output)
+        _listener.start()
+        root.addHandler(_handler)
+        atexit.register(shutdown_logging)
+    for frame_log in frame_logs():
+        frame_log.refresh()
+
+
+def shutdown_logging():
+    """ Logs the pending summaries and waits for the writer to write everything queued """
+    global _handler, _listener
+    for frame_log in frame_logs():
+        if frame_log.enabled:
+            frame_log.flush()
+    if _listener is None:
+        return
+    _listener.stop()
+    logging.getLogger(ROOT).removeHandler(_handler)
+    if _handler.dropped:
+        print(f"Logging: {_handler.dropped} records dropped", file=sys.stderr)
+    _handler = _listener = None
+
+
+def stats() -> Dict:
+    return {
+        "queued": _handler.queue.qsize() if _handler is not None else 0,
+        "dropped": _handler.dropped if _handler is not None else 0,
+        "frames": {f"{f.logger.name}:{f.message}": f.total for f in frame_logs()},
+    }
+
+
+def add_logging_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--log-level", choices=list(LEVELS), default="info",
+                        help="debug logs every frame, info one summary per second, off nothing at all")
+    parser.add_argument("--log-json", action="store_true", help="Write log records as JSON lines")
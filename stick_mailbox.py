@@ -0,0 +1,168 @@
+import asyncio
+import time
+from collections import deque
+from typing import Dict, Hashable, Optional
+
+from scheduler import Histogram
+
+STICK_KEY = "stick"
+
+# Flight commands that skip ahead of everything else queued for a client
+PRIORITY_COMMANDS = frozenset({"takeoff", "land", "s"})
+# Priority commands after which no previously queued movement may be sent
+STOP_COMMANDS = frozenset({"land", "s"})
+
+PRIORITY = "priority"
+COMMAND = "command"
+STICK = "stick"
+
+
+def command_name(message) -> str:
+    return message.strip().lower() if isinstance(message, str) else ""
+
+
+class _Entry:
+    __slots__ = ("message", "key", "lane", "queued_at")
+
+    def __init__(self, message, key=None, lane=COMMAND):
+        self.message = message
+        self.key = key  # None for discrete commands
+        self.lane = lane
+        self.queued_at = time.perf_counter()
+
+
+class StickMailbox:
+    """ Outbound message queue for one client that never lets stick state go stale.
+
+    Stick state is coalesced per key: a newer state replaces the unsent one in place
+    (it keeps its position, so it is not starved by later traffic), so at most one
+    state per key is ever pending. Discrete commands are queued in order and
+    delivered exactly once; at most `max_commands` may be pending. `None` can be put
+    as a command to signal the consumer to stop, like with the asyncio.Queue it replaces.
+
+    PRIORITY_COMMANDS go through a separate lane that is always served first, and
+    STOP_COMMANDS also discard any movement still queued. Call `task_done()` after
+    sending each message to record its queue-to-wire latency per lane. """
+
+    def __init__(self, max_commands: int = 64):
+        self.max_commands = max_commands
+        self.merged = 0  # Stick states replaced by a newer one before being sent
+        self.dropped = 0  # Stick states discarded by clear_sticks()
+        self.delivered = 0
+        self._entries = deque()
+        self._priority = deque()
+        self._pending: Dict[Hashable, _Entry] = {}
+        self._ready = asyncio.Event()
+        self._priority_ready = asyncio.Event()
+        self._in_flight = None
+        self.latency: Dict[str, Histogram] = {PRIORITY: Histogram(), COMMAND: Histogram(), STICK: Histogram()}
+
+    def qsize(self) -> int:
+        return len(self._entries) + len(self._priority)
+
+    def empty(self) -> bool:
+        return not self._entries and not self._priority
+
+    def put_stick(self, message, key: Hashable = STICK_KEY):
+        entry = self._pending.get(key)
+        if entry is not None:
+            entry.message = message
+            entry.queued_at = time.perf_counter()
+            self.merged += 1
+            return
+        entry = _Entry(message, key, STICK)
+        self._pending[key] = entry
+        self._entries.append(entry)
+        self._ready.set()
+
+    def put_command(self, message, name: Optional[str] = None):
+        """ Raises asyncio.QueueFull rather than dropping a command (priority commands are never refused).
+        `name` is the command a message stands for if it is not the command word itself (a binary frame) """
+        if name is None:
+            name = command_name(message)
+        if name in PRIORITY_COMMANDS:
+            self.put_priority(message, stop=name in STOP_COMMANDS)
+            return
+        if len(self._entries) - len(self._pending) >= self.max_commands:
+            raise asyncio.QueueFull
+        self._entries.append(_Entry(message))
+        self._ready.set()
+
+    def put_priority(self, message, stop: bool = False):
+        if stop:
+            self.clear_sticks()
+        self._priority.append(_Entry(message, lane=PRIORITY))
+        self._ready.set()
+        self._priority_ready.set()
+
+    def has_priority(self) -> bool:
+        return bool(self._priority)
+
+    async def wait_priority(self, timeout: float) -> bool:
+        """ Waits up to `timeout` seconds for a priority message; used by rate-limited consumers """
+        try:
+            await asyncio.wait_for(self._priority_ready.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def clear_sticks(self):
+        """ Discards all unsent stick state, e.g. before stopping the aircraft """
+        if not self._pending:
+            return
+        self.dropped += len(self._pending)
+        self._pending.clear()
+        self._entries = deque(entry for entry in self._entries if entry.key is None)
+        if self.empty():
+            self._ready.clear()
+
+    def get_nowait(self):
+        if self._priority:
+            entry = self._priority.popleft()
+            if not self._priority:
+                self._priority_ready.clear()
+        elif self._entries:
+            entry = self._entries.popleft()
+            if entry.key is not None:
+                del self._pending[entry.key]
+        else:
+            raise asyncio.QueueEmpty
+        if self.empty():
+            self._ready.clear()
+        self.delivered += 1
+        self._in_flight = entry
+        return entry.message
+
+    async def get(self):
+        while self.empty():
+            await self._ready.wait()
+        return self.get_nowait()
+
+    @property
+    def in_flight_lane(self) -> str:
+        """ Lane of the last message returned by get() that is not marked done yet """
+        return self._in_flight.lane if self._in_flight is not None else ""
+
+    @property
+    def in_flight_age(self) -> float:
+        """ Seconds since the message being sent was queued """
+        return time.perf_counter() - self._in_flight.queued_at if self._in_flight is not None else 0.0
+
+    def task_done(self):
+        """ Marks the last message returned by get() as sent """
+        entry = self._in_flight
+        if entry is not None:
+            self.latency[entry.lane].add(time.perf_counter() - entry.queued_at)
+            self._in_flight = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "depth": self.qsize(),
+            "priority_depth": len(self._priority),
+            "delivered": self.delivered,
+            "merged": self.merged,
+            "dropped": self.dropped,
+            "priority_p99_s": self.latency[PRIORITY].percentile(99),
+            "priority_max_s": self.latency[PRIORITY].max,
+            "stick_p99_s": self.latency[STICK].percentile(99),
+        }
@@ -0,0 +1,244 @@
+import ctypes
+import multiprocessing
+import struct
+import time
+from multiprocessing import shared_memory
+from typing import List, Optional, Tuple
+
+from RCreadSticks import _AXIS_INDEX, _JOYINFO_SIZE, ChannelCaps, Joystick, JoyValues, get_joysticks
+from scheduler import RateScheduler
+
+# Shared memory layout: header, device caps, latest sample, then a ring of recent samples.
+# Every field after the sequence counter is protected by it (a seqlock): the sampler
+# makes it odd before writing and even again after, and a reader retries whenever the
+# counter was odd or changed while it was copying.
+HEADER = struct.Struct("<IIIId")  # seq, samples written, ring size, sampler pid, rate_hz
+CAPS = struct.Struct("<12II64s")  # min/max of X, Y, Z, RX, RY, RZ, buttons, name (utf-8)
+SAMPLE = struct.Struct(f"<QI{_JOYINFO_SIZE}s")  # timestamp (perf_counter us), sample number, JOYINFOEX
+_CAPS_OFFSET = HEADER.size
+_LATEST_OFFSET = _CAPS_OFFSET + CAPS.size
+_RING_OFFSET = _LATEST_OFFSET + SAMPLE.size
+
+RING_SIZE = 256
+_MAX_RETRIES = 1000
+
+
+def _size(ring_size: int) -> int:
+    return _RING_OFFSET + ring_size * SAMPLE.size
+
+
+def now_us() -> int:
+    """ perf_counter is system-wide, so sampler and readers share this clock """
+    return time.perf_counter_ns() // 1000
+
+
+class SharedSticksWriter:
+    """ The sampler's side of the shared memory; there must only be one writer """
+
+    def __init__(self, shm: shared_memory.SharedMemory, ring_size: int, rate_hz: float):
+        self.shm = shm
+        self.ring_size = ring_size
+        self.count = 0
+        self._seq = 0
+        HEADER.pack_into(shm.buf, 0, self._seq, 0, ring_size, multiprocessing.current_process().pid or 0, rate_hz)
+
+    def _begin(self):
+        self._seq += 1
+        struct.pack_into("<I", self.shm.buf, 0, self._seq)
+
+    def _end(self):
+        self._seq += 1
+        struct.pack_into("<I", self.shm.buf, 0, self._seq)
+
+    def publish_caps(self, joystick: Joystick):
+        limits = []
+        for name in _AXIS_INDEX:
+            limits += [joystick.axes[name].min, joystick.axes[name].max]
+        self._begin()
+        CAPS.pack_into(self.shm.buf, _CAPS_OFFSET, *limits, joystick.buttons,
+                       str(getattr(joystick, "szPname", "")).encode()[:64])
+        self._end()
+
+    def publish(self, raw, stamp_us: int):
+        self.count += 1
+        record = (stamp_us, self.count & 0xFFFFFFFF, bytes(raw))
+        buf = self.shm.buf
+        self._begin()
+        SAMPLE.pack_into(buf, _LATEST_OFFSET, *record)
+        SAMPLE.pack_into(buf, _RING_OFFSET + (self.count % self.ring_size) * SAMPLE.size, *record)
+        struct.pack_into("<I", buf, 4, self.count & 0xFFFFFFFF)
+        self._end()
+
+
+class SharedSticks:
+    """ Lock-free reader of the sampler's shared memory, usable from any process """
+
+    def __init__(self, name: str):
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.retries = 0
+        _, _, self.ring_size, self.sampler_pid, self.rate_hz = HEADER.unpack_from(self.shm.buf, 0)
+
+    def _read(self, offset: int, size: int) -> bytes:
+        buf = self.shm.buf
+        for _ in range(_MAX_RETRIES):
+            before = struct.unpack_from("<I", buf, 0)[0]
+            if before & 1:
+                self.retries += 1
+                continue
+            data = bytes(buf[offset:offset + size])
+            if struct.unpack_from("<I", buf, 0)[0] == before:
+                return data
+            self.retries += 1
+        raise TimeoutError("Shared stick memory is not settling; is the sampler stuck mid-write?")
+
+    @property
+    def count(self) -> int:
+        return struct.unpack_from("<I", self.shm.buf, 4)[0]
+
+    def caps(self) -> Tuple[dict, int, str]:
+        values = CAPS.unpack(self._read(_CAPS_OFFSET, CAPS.size))
+        axes = {name: ChannelCaps(values[2 * i], values[2 * i + 1]) for i, name in enumerate(_AXIS_INDEX)}
+        return axes, values[12], values[13].rstrip(b"\0").decode(errors="replace")
+
+    def latest(self) -> Tuple[int, int, bytes]:
+        """ (timestamp_us, sample number, JOYINFOEX bytes) of the newest sample """
+        return SAMPLE.unpack(self._read(_LATEST_OFFSET, SAMPLE.size))
+
+    def recent(self, n: Optional[int] = None) -> List[Tuple[int, int, bytes]]:
+        """ Up to `n` of the most recent samples, oldest first """
+        data = self._read(4, _size(self.ring_size) - 4)
+        count = struct.unpack_from("<I", data, 0)[0]
+        n = min(n or self.ring_size, self.ring_size, count)
+        ring = _RING_OFFSET - 4
+        return [SAMPLE.unpack_from(data, ring + (i % self.ring_size) * SAMPLE.size)
+                for i in range(count - n + 1, count + 1)]
+
+    def close(self):
+        self.shm.close()
+
+
+class SharedJoystick(Joystick):
+    """ Joystick whose reads return the sampler's latest sample instead of polling the
+    device, so a slow network loop never delays sampling. A read fails (returns None)
+    when the sampler has not produced anything for `max_age` seconds. """
+
+    def __init__(self, sticks: SharedSticks, uJoyID: int = 0, max_age: float = 0.5):
+        super().__init__(uJoyID)
+        self.sticks = sticks
+        self.max_age_us = int(max_age * 1e6)
+        self.axes, self.buttons, self.szPname = sticks.caps()
+        self.wMid = self.wPid = 0
+        self.loaded = True
+        self.last_sample = 0
+        self.stamp_us = 0
+
+    def get(self, out: Optional[JoyValues] = None) -> Optional[JoyValues]:
+        try:
+            stamp_us, sample, raw = self.sticks.latest()
+        except TimeoutError:
+            return None
+        if sample == 0 or now_us() - stamp_us > self.max_age_us:
+            return None
+        self.stamp_us = stamp_us
+        self.last_sample = sample
+        buf = self._pos_buffer
+        ctypes.memmove(buf, raw, _JOYINFO_SIZE)
+        if out is None:
+            return JoyValues(buf, self.buttons, self.tables)
+        return out.fill(buf, self.buttons, self.tables)
+
+
+def _default_joystick(uJoyID: int) -> Optional[Joystick]:
+    for joystick in get_joysticks():
+        if joystick.id == uJoyID:
+            return joystick
+    return None
+
+
+def run_sampler(name: str, uJoyID: int, rate_hz: float, ring_size: int, joystick_factory=None):
+    """ Body of the sampler process: polls the joystick at `rate_hz` into shared memory """
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        joystick = (joystick_factory or _default_joystick)(uJoyID)
+        if joystick is None:
+            print(f"Sampler: no joystick {uJoyID}")
+            return
+        writer = SharedSticksWriter(shm, ring_size, rate_hz)
+        writer.publish_caps(joystick)
+        values = JoyValues(n_buttons=joystick.buttons)
+        # Spinning the last half millisecond keeps the sampling grid tight; it owns a core anyway
+        scheduler = RateScheduler(rate_hz, "sampler", spin=0.0005)
+        while True:
+            if joystick.get(values):
+                writer.publish(values.raw, now_us())
+            scheduler.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shm.close()
+
+
+class JoystickSampler:
+    """ Runs run_sampler() in its own process and hands out SharedJoysticks reading from it.
+
+        sampler = JoystickSampler(joystick.id, 500)
+        sampler.start()
+        joystick = sampler.joystick()  # Drop-in for the polled joystick
+        ...
+        sampler.stop()
+
+    `joystick_factory(uJoyID)` must be a picklable top-level function; it defaults to
+    the device from get_joysticks(). """
+
+    def __init__(self, uJoyID: int = 0, rate_hz: float = 500, ring_size: int = RING_SIZE, joystick_factory=None):
+        self.uJoyID = uJoyID
+        self.rate_hz = rate_hz
+        self.ring_size = ring_size
+        self.joystick_factory = joystick_factory
+        self.shm: Optional[shared_memory.SharedMemory] = None
+        self.process: Optional[multiprocessing.Process] = None
+        self.sticks: Optional[SharedSticks] = None
+
+    def start(self, timeout: float = 5.0) -> bool:
+        """ Starts the process and waits for its first sample; False if none came """
+        self.shm = shared_memory.SharedMemory(create=True, size=_size(self.ring_size))
+        self.shm.buf[:HEADER.size] = bytes(HEADER.size)
+        self.process = multiprocessing.Process(
+            target=run_sampler, name="joystick-sampler", daemon=True,
+            args=(self.shm.name, self.uJoyID, self.rate_hz, self.ring_size, self.joystick_factory))
+        self.process.start()
+        deadline = time.monotonic() + timeout
+        while struct.unpack_from("<I", self.shm.buf, 4)[0] == 0:
+            if not self.process.is_alive() or time.monotonic() > deadline:
+                self.stop()
+                return False
+            time.sleep(0.01)
+        # The header and caps are final once the first sample is out
+        self.sticks = SharedSticks(self.shm.name)
+        return True
+
+    def joystick(self, max_age: float = 0.5) -> SharedJoystick:
+        return SharedJoystick(self.sticks, self.uJoyID, max_age)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join(1.0)
+            self.process = None
+        if self.sticks is not None:
+            self.sticks.close()
+            self.sticks = None
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+def start_sampler(joystick: Joystick, rate_hz: float) -> Optional[JoystickSampler]:
+    """ Starts sampling `joystick` in its own process; None if that failed (the caller keeps polling) """
+    sampler = JoystickSampler(joystick.id, rate_hz)
+    if not sampler.start():
+        print(f"Joystick sampler did not start; polling {joystick.szPname} in this process")
+        return None
+    print(f"Sampling {joystick.szPname} at {rate_hz:g} Hz in process {sampler.process.pid}")
+    return sampler
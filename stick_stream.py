@@ -0,0 +1,39 @@
+import time
+from typing import Dict, Optional, Tuple
+
+
+class StickStreamer:
+    """ Decides which stick samples are worth sending.
+
+    A sample goes out when any axis moved more than `deadband` since the last one
+    sent, when the sticks return to neutral, or as a keepalive once `keepalive`
+    seconds passed without sending (the aircraft drops virtual stick control if it
+    stops hearing from us). Everything else is suppressed. """
+
+    def __init__(self, deadband: int = 2, keepalive: float = 0.25):
+        self.deadband = deadband
+        self.keepalive = keepalive
+        self.sent = 0
+        self.keepalives = 0
+        self.suppressed = 0
+        self._last: Optional[Tuple[int, ...]] = None
+        self._last_time = 0.0
+
+    def should_send(self, axes: Tuple[int, ...], now: Optional[float] = None) -> bool:
+        if now is None:
+            now = time.monotonic()
+        last = self._last
+        changed = last is None or (any(last) and not any(axes)) or \
+            any(abs(value - previous) > self.deadband for value, previous in zip(axes, last))
+        if not changed:
+            if now - self._last_time < self.keepalive:
+                self.suppressed += 1
+                return False
+            self.keepalives += 1
+        self._last = axes
+        self._last_time = now
+        self.sent += 1
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        return {"sent": self.sent, "keepalives": self.keepalives, "suppressed": self.suppressed}
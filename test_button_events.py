@@ -0,0 +1,39 @@
+""" Edge detection on dwButtons bitmasks """
+from button_events import HELD, PRESSED, RELEASED, ButtonEdges, ButtonEvent, button_mask
+
+TAKEOFF, LAND = 0, 1
+
+
+def test_two_bindings_fire_on_the_same_sample():
+    edges = ButtonEdges()
+    edges.update(0b11, now=1.0)
+    # Reads do not consume the edge: both bindings see theirs, as often as they look
+    assert edges.pressed(TAKEOFF) and edges.pressed(LAND)
+    assert edges.pressed(TAKEOFF) and edges.pressed(LAND)
+
+    edges.update(0b11, now=1.1)  # Held down: no new press
+    assert not edges.pressed(TAKEOFF) and not edges.pressed(LAND)
+
+    edges.update(0b01, now=1.2)
+    assert edges.released(LAND) and not edges.released(TAKEOFF) and not edges.pressed(TAKEOFF)
+
+
+def test_events_in_button_order():
+    edges = ButtonEdges()
+    assert edges.update(0b101, now=1.0) == [ButtonEvent(0, PRESSED, 1.0), ButtonEvent(2, PRESSED, 1.0)]
+    assert edges.update(0b001, now=1.5) == [ButtonEvent(2, RELEASED, 1.5, 0.5)]
+    assert edges.update(0b001, now=2.0) == []
+    assert edges.events == 3
+
+
+def test_held_once_per_press():
+    edges = ButtonEdges(hold_after=1.0, hold_times={1: 0.2})
+    edges.update(0b10, now=0.0)
+    assert edges.update(0b10, now=0.1) == []
+    assert edges.update(0b10, now=0.3) == [ButtonEvent(1, HELD, 0.3, 0.3)]
+    assert edges.update(0b10, now=5.0) == []
+
+
+def test_button_mask():
+    assert button_mask([True, False, True]) == 0b101
+    assert list(ButtonEdges().feed([0b1, 0b0]))[1].kind == RELEASED
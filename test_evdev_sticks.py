@@ -0,0 +1,184 @@
+""" The evdev backend against a fake device, and its uinput self-check where this machine allows it """
+import asyncio
+import os
+import sys
+import types
+from collections import namedtuple
+
+import pytest
+
+try:
+    import evdev
+    FAKE_EVDEV = False
+except ImportError:
+    # Just enough of python-evdev for the backend's logic; the codes are the kernel's
+    evdev = types.ModuleType("evdev")
+    evdev.ecodes = types.SimpleNamespace(
+        EV_SYN=0, EV_KEY=1, EV_ABS=3, SYN_REPORT=0, SYN_DROPPED=3,
+        ABS_X=0, ABS_Y=1, ABS_Z=2, ABS_RX=3, ABS_RY=4, ABS_RZ=5,
+        KEY_A=30, BTN_MISC=256, BTN_1=257, BTN_TRIGGER=288, BTN_THUMB=289, BTN_A=304, BTN_DIGI=320, BTN_TOUCH=330)
+    evdev.AbsInfo = namedtuple("AbsInfo", "value min max fuzz flat resolution")
+    evdev.InputEvent = namedtuple("InputEvent", "sec usec type code value")
+    evdev.InputDevice = None
+    evdev.list_devices = lambda: []
+    sys.modules["evdev"] = evdev
+    sys.modules["evdev.ecodes"] = evdev.ecodes
+    FAKE_EVDEV = True
+
+import evdev_sticks
+from RCreadSticks import JoyValues
+from evdev_sticks import EvdevJoystick, check_virtual
+
+e = evdev.ecodes
+PATH = "/dev/input/event5"
+
+
+class FakeDevice:
+    """ An input device whose events are pushed by the test; X and Y span -1000..1000, RZ 0..1000 """
+
+    info = namedtuple("DeviceInfo", "vendor product")(0x1234, 0x5678)
+    name = "Fake RC"
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {e.ABS_X: 0, e.ABS_Y: 0, e.ABS_RZ: 500}
+        self.minimum = {e.ABS_X: -1000, e.ABS_Y: -1000, e.ABS_RZ: 0}
+        self.keys = []  # Held down, for active_keys()
+        self.pending = []
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        self.fd = self.read_fd
+
+    def absinfo(self, code):
+        return evdev.AbsInfo(self.state[code], self.minimum[code], 1000, 0, 0, 0)
+
+    def capabilities(self, absinfo=True):
+        codes = sorted(self.state)
+        return {e.EV_ABS: [(code, self.absinfo(code)) for code in codes] if absinfo else codes,
+                e.EV_KEY: [e.KEY_A, e.BTN_TRIGGER, e.BTN_THUMB]}
+
+    def active_keys(self):
+        return list(self.keys)
+
+    def push(self, *events):
+        self.pending += [evdev.InputEvent(0, 0, kind, code, value) for kind, code, value in events]
+        os.write(self.write_fd, b"x")
+
+    def read(self):
+        try:
+            os.read(self.read_fd, 1024)
+        except BlockingIOError:
+            pass
+        if not self.pending:
+            raise BlockingIOError
+        events, self.pending = self.pending, []
+        return iter(events)
+
+    def close(self):
+        for fd in (self.read_fd, self.write_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+@pytest.fixture
+def device(monkeypatch):
+    devices = {}
+    monkeypatch.setattr(evdev_sticks.evdev, "InputDevice", lambda path: devices.setdefault(path, FakeDevice(path)))
+    yield lambda: devices[PATH]
+    for d in devices.values():
+        d.close()
+
+
+def test_axes_are_offset_by_their_minimum(device):
+    joystick = EvdevJoystick(PATH)
+    assert joystick.loaded and joystick.id == 5
+    assert joystick.axes["X"].max == 2000 and joystick.axes["RZ"].max == 1000
+    values = joystick.get()
+    assert values.raw_axes["X"] == 1000 and values.raw_axes["RZ"] == 500  # Centre of -1000..1000, 500 of 0..1000
+
+    device().push((e.EV_ABS, e.ABS_X, -1000), (e.EV_ABS, e.ABS_Y, 1000), (e.EV_SYN, e.SYN_REPORT, 0))
+    values = joystick.get()
+    assert values.raw_axes["X"] == 0 and values.raw_axes["Y"] == 2000
+
+
+def test_a_report_is_only_published_on_syn_report(device):
+    joystick = EvdevJoystick(PATH)
+    values = JoyValues(n_buttons=joystick.buttons)
+    reports = joystick.reports
+
+    device().push((e.EV_ABS, e.ABS_X, 500), (e.EV_KEY, e.BTN_THUMB, 1))
+    joystick.get(values)
+    assert values.raw_axes["X"] == 1000 and values.dwButtons == 0
+    assert joystick.reports == reports
+
+    device().push((e.EV_SYN, e.SYN_REPORT, 0))
+    joystick.get(values)
+    assert values.raw_axes["X"] == 1500 and values.dwButtons == 0b10
+    assert joystick.reports == reports + 1
+
+
+def test_syn_dropped_resyncs_from_the_device_state(device):
+    joystick = EvdevJoystick(PATH)
+    fake = device()
+    # The kernel lost events: what arrives until the next SYN_REPORT is incomplete and ignored
+    fake.state[e.ABS_Y] = 800
+    fake.keys = [e.BTN_TRIGGER]
+    fake.push((e.EV_SYN, e.SYN_DROPPED, 0), (e.EV_ABS, e.ABS_X, -1000), (e.EV_KEY, e.BTN_THUMB, 1),
+              (e.EV_SYN, e.SYN_REPORT, 0))
+    values = joystick.get()
+    assert joystick.dropped == 1
+    assert values.raw_axes["X"] == 1000  # From absinfo, not the event after SYN_DROPPED
+    assert values.raw_axes["Y"] == 1800
+    assert values.dwButtons == 0b01 and values.dwButtonNumber == 1
+
+    # Back in sync: events apply again
+    fake.push((e.EV_ABS, e.ABS_X, -1000), (e.EV_SYN, e.SYN_REPORT, 0))
+    assert joystick.get().raw_axes["X"] == 0
+
+
+def test_buttons_map_to_bits_in_key_code_order(device):
+    joystick = EvdevJoystick(PATH)
+    assert joystick.buttons == 2  # KEY_A is a keyboard key, not a button
+    fake = device()
+
+    def buttons_after(*events):
+        fake.push(*events, (e.EV_SYN, e.SYN_REPORT, 0))
+        return joystick.get().dwButtons
+
+    assert buttons_after((e.EV_KEY, e.BTN_THUMB, 1)) == 0b10
+    assert buttons_after((e.EV_KEY, e.BTN_THUMB, 2)) == 0b10  # Autorepeat keeps it down
+    assert buttons_after((e.EV_KEY, e.BTN_TRIGGER, 1), (e.EV_KEY, e.KEY_A, 1)) == 0b11
+    assert buttons_after((e.EV_KEY, e.BTN_THUMB, 0)) == 0b01
+    assert buttons_after((e.EV_KEY, e.BTN_TRIGGER, 0)) == 0
+
+
+def test_apply_stages_events_until_the_report(device):
+    joystick = EvdevJoystick(PATH)
+    joystick._apply(evdev.InputEvent(0, 0, e.EV_KEY, e.BTN_TRIGGER, 2))
+    joystick._apply(evdev.InputEvent(0, 0, e.EV_ABS, e.ABS_RZ, 1000))
+    assert joystick.get().dwButtons == 0
+    joystick._apply(evdev.InputEvent(0, 0, e.EV_SYN, e.SYN_REPORT, 0))
+    values = joystick.get()
+    assert values.dwButtons == 0b01 and values.raw_axes["RZ"] == 1000
+
+
+def test_wait_report_wakes_on_the_next_report(device):
+    joystick = EvdevJoystick(PATH)
+    joystick.get()  # Consumes the report made when the device was opened
+
+    async def wait():
+        assert not await joystick.wait_report(0.05)
+        asyncio.get_running_loop().call_later(0.01, device().push, (e.EV_ABS, e.ABS_X, 1000),
+                                              (e.EV_SYN, e.SYN_REPORT, 0))
+        return await joystick.wait_report(1.0)
+
+    assert asyncio.run(wait())
+    assert joystick.get().raw_axes["X"] == 2000
+
+
+@pytest.mark.skipif(FAKE_EVDEV or not os.access("/dev/uinput", os.W_OK),
+                    reason="needs python-evdev and a writable /dev/uinput")
+def test_virtual_joystick():
+    assert asyncio.run(check_virtual(20))
@@ -0,0 +1,103 @@
+""" Fleet routing with fake connections: paths, range checks and what each client gets """
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from fleet import CONTROL, DEFAULT_ID, DRONE, Fleet, Source, parse_path
+from stick_frames import (COMMAND_TAKEOFF, STICK_MAX, SUBPROTOCOL_BINARY, decode_frame, encode_app_text,
+                          encode_frame)
+
+
+class FakeConnection:
+    """ A WebSocket connection that sends `messages` and records what it is sent """
+
+    def __init__(self, path: str = "/", messages=(), subprotocol=None):
+        self.request = SimpleNamespace(path=path)
+        self.subprotocol = subprotocol
+        self.messages = list(messages)
+        self.closed = None
+
+    async def __aiter__(self):
+        for message in self.messages:
+            yield message
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        self.closed = (code, reason)
+
+
+def queued(subscriber) -> list:
+    """ What the subscriber's send loop would send next, in order """
+    messages = []
+    while not subscriber.mailbox.empty():
+        messages.append(subscriber.mailbox.get_nowait())
+    return messages
+
+
+@pytest.mark.parametrize("path, expected", [
+    ("/drone/7", (DRONE, "7", None)),
+    ("/", (DRONE, DEFAULT_ID, None)),
+    ("/drone", (DRONE, DEFAULT_ID, None)),
+    ("/drone?drone=3", (DRONE, "3", "3")),
+    ("/control/pad", (CONTROL, "pad", None)),
+    ("/control/pad?drone=7", (CONTROL, "pad", "7")),
+])
+def test_parse_path(path, expected):
+    assert parse_path(path) == expected
+
+
+@pytest.mark.parametrize("path", ["/video", "/drone/7/extra"])
+def test_unknown_paths_are_closed(path):
+    connection = FakeConnection(path)
+    asyncio.run(Fleet().handler(connection))
+    assert connection.closed[0] == 1008
+    with pytest.raises(ValueError):
+        parse_path(path)
+
+
+def test_sources_drive_the_drone_they_are_routed_to():
+    fleet = Fleet()
+    app = fleet.hub("7").subscribe(FakeConnection("/drone/7"))
+    bridge = fleet.hub("8").subscribe(FakeConnection("/drone/8", subprotocol=SUBPROTOCOL_BINARY))
+    frame = encode_frame(10, 20, 30, 40, seq=5)
+
+    asyncio.run(fleet.handler(FakeConnection("/control/pad?drone=7", [frame])))
+    assert queued(app) == [encode_app_text(10, 20, 30, 40)] and queued(bridge) == []
+
+    fleet.route("pad", "8")  # As the operator's "route pad 8"
+    asyncio.run(fleet.handler(FakeConnection("/control/pad", [frame])))
+    assert queued(bridge) == [frame] and queued(app) == []
+    assert fleet.sources == {}  # Forgotten once disconnected; the route stays
+    assert fleet.drone_for("pad") == "8"
+
+
+def test_out_of_range_and_undecodable_messages_are_rejected():
+    fleet = Fleet()
+    app = fleet.hub("7").subscribe(FakeConnection("/drone/7"))
+    source = Source("7")
+    fleet.forward(source, encode_frame(STICK_MAX + 1, 0, 0, 0))
+    fleet.forward(source, "moveDrone:0,0,0,255,0,0")  # 0..255 sticks of an old client
+    fleet.forward(source, b"\x09junk")
+    assert source.invalid == 3 and queued(app) == []
+
+    fleet.forward(Source("9"), encode_frame(0, 0, 0, 0))  # No drone 9 connected
+    assert queued(app) == []
+
+
+def test_text_clients_always_get_app_text():
+    fleet = Fleet()
+    app = fleet.hub("7").subscribe(FakeConnection("/drone/7"))
+    bridge = fleet.hub("7").subscribe(FakeConnection("/drone/7", subprotocol=SUBPROTOCOL_BINARY))
+    source = Source("7")
+
+    fleet.forward(source, f"moveDrone:{STICK_MAX},0,-{STICK_MAX},64,0,{COMMAND_TAKEOFF}")
+    assert queued(app) == ["takeoff", encode_app_text(STICK_MAX, 0, -STICK_MAX, 64)]
+    command, sticks = (decode_frame(m) for m in queued(bridge))
+    assert command.command == COMMAND_TAKEOFF and sticks.command == 0
+    assert sticks[:4] == (STICK_MAX, 0, -STICK_MAX, 64)
+
+    fleet.forward(source, encode_frame(-5, 5, 0, 0))
+    assert queued(app) == [encode_app_text(-5, 5, 0, 0)]
+
+    fleet.forward(source, "land")  # Command words are passed on as they are
+    assert queued(app) == ["land"] and source.commands == 2
@@ -0,0 +1,47 @@
+""" The operator socket only replaces a socket no server answers on """
+import asyncio
+import socket
+
+import pytest
+
+from operator_channel import OperatorChannel, remove_stale_socket
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs Unix sockets")
+
+
+def test_a_stale_socket_is_replaced(tmp_path):
+    path = str(tmp_path / "operator.sock")
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(path)  # Bound but never listening, like the socket of a server that was killed
+    stale.close()
+
+    async def start():
+        channel = OperatorChannel(hub=None, address=path)
+        await channel.start()
+        await channel.close()
+
+    asyncio.run(start())
+
+
+def test_a_live_server_is_not_taken_over(tmp_path):
+    path = str(tmp_path / "operator.sock")
+
+    async def start_twice():
+        first = OperatorChannel(hub=None, address=path)
+        await first.start()
+        try:
+            with pytest.raises(OSError, match="Another server"):
+                await OperatorChannel(hub=None, address=path).start()
+        finally:
+            await first.close()
+
+    asyncio.run(start_twice())
+
+
+def test_other_files_are_left_alone(tmp_path):
+    path = tmp_path / "operator.sock"
+    path.write_text("not a socket")
+    with pytest.raises(OSError, match="not a socket"):
+        asyncio.run(remove_stale_socket(str(path)))
+    assert path.read_text() == "not a socket"
+    asyncio.run(remove_stale_socket(str(tmp_path / "missing.sock")))  # Nothing to remove
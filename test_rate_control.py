@@ -0,0 +1,80 @@
+""" AdaptiveRate fed synthetic write times on a clock the tests move """
+import pytest
+
+import rate_control
+from rate_control import DECREASE, HOLD, INCREASE, AdaptiveRate
+
+
+class Link:
+    """ Starts one write every `period` seconds, each taking `latency` """
+
+    def __init__(self, monkeypatch, rate: AdaptiveRate = None, **kwargs):
+        self.now = 0.0
+        monkeypatch.setattr(rate_control, "time", self)
+        self.rate = rate or AdaptiveRate(50, smoothing=1.0, **kwargs)
+
+    def perf_counter(self) -> float:
+        return self.now
+
+    def run(self, latency: float, seconds: float, period: float = 0.02) -> AdaptiveRate:
+        end = self.now + seconds
+        while self.now < end - 1e-9:
+            self.now += period
+            self.rate.observe(latency, self.now + latency)
+        return self.rate
+
+
+def test_an_idle_link_holds_the_maximum_rate(monkeypatch):
+    rate = Link(monkeypatch).run(0.001, 1.0)
+    assert rate.rate_hz == 50 and rate.decision == HOLD
+    assert rate.base_s == 0.001 and rate.threshold_s == 0.005  # target_s beats twice the base
+
+
+def test_congestion_cuts_multiplicatively_and_recovery_adds(monkeypatch):
+    link = Link(monkeypatch)
+    link.run(0.001, 1.0)
+    rate = link.run(0.05, 0.15)  # Two decisions while writes take 50ms
+    assert rate.decision == DECREASE and rate.congested
+    assert rate.rate_hz == pytest.approx(50 * 0.7 * 0.7)
+    rate = link.run(0.001, 0.21)  # Two decisions back under the threshold
+    assert rate.decision == INCREASE and not rate.congested
+    assert rate.rate_hz == pytest.approx(50 * 0.7 * 0.7 + 2 * 2.5)  # increase_hz is max_hz / 20
+    assert (rate.decreases, rate.increases) == (2, 2)
+
+
+def test_a_cut_starts_from_the_achieved_rate(monkeypatch):
+    link = Link(monkeypatch)
+    link.run(0.001, 1.0, period=0.025)
+    rate = link.run(0.05, 0.1, period=0.025)  # Sends at 40 Hz, not the nominal 50
+    assert rate.decreases == 1
+    assert rate.rate_hz == pytest.approx(40 * 0.7)
+
+
+def test_a_slow_link_keeps_the_rate_that_keeps_it_half_busy(monkeypatch):
+    link = Link(monkeypatch)
+    link.run(0.001, 1.0)
+    rate = link.run(0.2, 3.0)
+    assert rate.rate_hz == pytest.approx(0.5 / 0.2)  # Cut no further, however long it stays slow
+    assert rate.congested and rate.decreases > 20
+
+
+def test_a_link_that_was_always_slow_is_not_congested(monkeypatch):
+    rate = Link(monkeypatch).run(0.2, 1.0)
+    assert rate.threshold_s == pytest.approx(0.4)  # Twice its base
+    assert rate.rate_hz == 50 and not rate.congested
+
+
+def test_the_token_bucket_holds_two_sends(monkeypatch):
+    link = Link(monkeypatch, AdaptiveRate(10))
+    rate = link.rate
+    assert rate.delay(0.0) == 0.0
+    rate.observe(0.0, 1.0)
+    assert rate.delay(1.0) == 0.0  # A second send right away
+    rate.observe(0.0, 1.0)
+    assert rate.delay(1.0) == pytest.approx(0.1)  # Then the rate applies
+    assert rate.delay(1.05) == pytest.approx(0.05)
+    # An idle link does not save up more than the two sends
+    rate.observe(0.0, 5.0)
+    assert rate.delay(5.0) == 0.0
+    rate.observe(0.0, 5.0)
+    assert rate.delay(5.0) == pytest.approx(0.1)
@@ -0,0 +1,93 @@
+""" RateScheduler against a clock the tests move, and the jitter histograms """
+import pytest
+
+import scheduler
+from scheduler import CATCH_UP, SKIP, Histogram, RateScheduler
+
+
+class FakeClock:
+    """ Stands in for the time module: sleep() moves the clock instead of waiting """
+
+    def __init__(self):
+        self.now = 100.0
+
+    def perf_counter(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(scheduler, "time", fake)
+    return fake
+
+
+def test_ticks_stay_on_the_grid(clock):
+    loop = RateScheduler(10)
+    assert loop.wait() == 0 and clock.now == 100.0
+    clock.now += 0.03  # Work
+    assert loop.wait() == 0
+    assert clock.now == pytest.approx(100.1)
+    assert loop.wait() == 0
+    assert clock.now == pytest.approx(100.2)
+    assert loop.stats.ticks == 3 and loop.stats.missed == 0
+
+
+def test_set_rate_takes_effect_one_new_period_after_now(clock):
+    loop = RateScheduler(10)
+    loop.wait()
+    loop.wait()
+    clock.now += 0.02
+    loop.set_rate(50)
+    started = clock.now
+    assert loop.wait() == 0
+    assert clock.now == pytest.approx(started + 0.02)
+    assert loop.wait() == 0
+    assert clock.now == pytest.approx(started + 0.04)
+    assert loop.rate_hz == pytest.approx(50) and loop.stats.ticks == 4
+
+
+def test_skip_merges_missed_ticks(clock):
+    loop = RateScheduler(10, policy=SKIP)
+    loop.wait()
+    clock.now += 0.35  # Past the deadlines at +0.1, +0.2 and +0.3
+    assert loop.wait() == 3
+    assert clock.now == pytest.approx(100.4)  # Still on the grid
+    assert loop.stats.missed == 3 and loop.stats.overruns.count == 1
+
+
+def test_catch_up_runs_missed_ticks_back_to_back(clock):
+    loop = RateScheduler(10, policy=CATCH_UP)
+    loop.wait()
+    clock.now += 0.35
+    woke = []
+    for _ in range(4):
+        assert loop.wait() == 0
+        woke.append(round(clock.now - 100.0, 6))
+    assert woke == [0.35, 0.35, 0.35, 0.4]  # Deadlines +0.1..+0.3 at once, then back on the grid
+    assert loop.stats.missed == 0
+    assert loop.stats.lateness.max == pytest.approx(0.25)
+
+
+def test_histogram_percentiles_are_bucket_bounds_capped_at_the_max():
+    histogram = Histogram((100, 1000, 10000))
+    for us in (10, 20, 30, 40, 500, 600, 700, 800, 900, 5000):
+        histogram.add(us / 1e6)
+    assert histogram.percentile(40) == pytest.approx(100e-6)
+    assert histogram.percentile(90) == pytest.approx(1000e-6)
+    assert histogram.percentile(100) == pytest.approx(5000e-6)  # Not the 10000us bound
+    assert Histogram().percentile(50) == 0.0
+
+
+def test_histogram_merge():
+    a, b = Histogram((100, 1000)), Histogram((100, 1000))
+    a.add(50e-6)
+    b.add(500e-6)
+    b.add(2.0)
+    a.merge(b)
+    assert a.counts == [1, 1, 1] and a.count == 3
+    assert a.max == 2.0 and a.total == pytest.approx(2.00055)
+    assert a.percentile(99) == 2.0
@@ -0,0 +1,53 @@
+""" Round trips of the two wire formats to the server, and the app text it sends on """
+import pytest
+
+from stick_frames import (COMMAND_LAND, COMMAND_TAKEOFF, FRAME_SIZE, STICK_MAX, SUBPROTOCOL_BINARY, FrameEncoder,
+                          StickFrame, decode, decode_frame, decode_text, encode_app_text, encode_frame)
+
+
+def test_binary_frame_round_trip():
+    data = encode_frame(-STICK_MAX, 12, -3, STICK_MAX, camera=-40, command=COMMAND_LAND, buttons=0b101,
+                        seq=0x10001, stamp=123456)
+    assert len(data) == FRAME_SIZE
+    assert decode_frame(data) == StickFrame(-STICK_MAX, 12, -3, STICK_MAX, -40, COMMAND_LAND, 0b101, 1, 123456)
+    assert decode(bytearray(data)) == decode_frame(data)
+
+
+def test_decode_frame_rejects_what_is_not_a_frame():
+    with pytest.raises(ValueError):
+        decode_frame(encode_frame(0, 0, 0, 0)[:-1])
+    with pytest.raises(ValueError):
+        decode_frame(b"\x02" + encode_frame(0, 0, 0, 0)[1:])
+
+
+@pytest.mark.parametrize("subprotocol", [SUBPROTOCOL_BINARY, None])
+def test_encoder_round_trip(subprotocol):
+    encoder = FrameEncoder(subprotocol)
+    frame = decode(encoder.encode(10, -20, 30, -STICK_MAX, 5, COMMAND_TAKEOFF, stamp=99))
+    assert frame[:6] == (10, -20, 30, -STICK_MAX, 5, COMMAND_TAKEOFF)
+    if subprotocol == SUBPROTOCOL_BINARY:
+        assert (frame.seq, frame.timestamp_us) == (1, 99)
+        assert decode(encoder.encode(0, 0, 0, 0)).seq == 2
+
+
+def test_stick_text():
+    assert decode_text("moveDrone:1,-2,3,-4,5,2") == StickFrame(1, -2, 3, -4, 5, COMMAND_LAND)
+    assert decode_text("1,2,3,4,0,0")[:4] == (1, 2, 3, 4)
+    assert decode_text("moveDrone:63.6,-0.4,0,0,0,0")[:2] == (64, 0)  # Normalized sticks may be floats
+
+
+@pytest.mark.parametrize("message", [
+    encode_app_text(60, 0, 0, 0),  # App fractions would be near-zero sticks
+    "moveDrone:1,2,3,4,5",
+    "moveDrone:1,2,3,4,nan,0",
+    "moveDrone:1,2,3,inf,0,0",
+    "takeoff",
+])
+def test_decode_text_rejects_other_text(message):
+    with pytest.raises(ValueError):
+        decode_text(message)
+
+
+def test_app_text_is_roll_throttle_yaw_pitch_fractions():
+    assert encode_app_text(STICK_MAX, 0, -STICK_MAX, STICK_MAX // 2) == "moveDrone:1.000,0.496,-1.000,0.000"
+    assert encode_app_text(3 * STICK_MAX, 0, 0, -255) == "moveDrone:1.000,-1.000,0.000,0.000"  # Clamped
@@ -0,0 +1,42 @@
+""" FrameLog summaries, and that they cost nothing until logging is set up """
+import io
+import json
+import logging
+
+import pytest
+
+import stick_log
+from stick_log import FrameLog, setup_logging, shutdown_logging
+
+
+@pytest.fixture
+def restore_level():
+    root = logging.getLogger(stick_log.ROOT)
+    level = root.level
+    yield
+    root.setLevel(level)
+    for frame_log in stick_log.frame_logs():
+        frame_log.refresh()
+
+
+def test_frame_logs_are_off_until_logging_is_set_up(capsys):
+    warnings = FrameLog("test", "Write failed", ("error",), level=logging.WARNING)
+    assert not warnings.enabled
+    warnings.add("timeout")
+    assert warnings.total == 0
+    assert capsys.readouterr().err == ""
+
+
+def test_summaries_are_written_by_the_writer(restore_level):
+    frames = FrameLog("test", "Sample", ("x",), interval=60)
+    output = io.StringIO()
+    setup_logging("info", json_lines=True, stream=output)
+    try:
+        assert frames.enabled
+        for x in range(5):
+            frames.add(x)
+    finally:
+        shutdown_logging()
+    records = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [(r["msg"], r["x"], r["frames"]) for r in records] == [("Sample", 0, 1), ("Sample", 4, 4)]
+    assert frames.total == 5
@@ -0,0 +1,109 @@
+""" StickMailbox: coalesced stick state, ordered commands and the priority lane """
+import asyncio
+
+import pytest
+
+import stick_mailbox
+from stick_mailbox import COMMAND, PRIORITY, STICK, StickMailbox
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 10.0
+
+    def perf_counter(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(stick_mailbox, "time", fake)
+    return fake
+
+
+def drain(mailbox: StickMailbox) -> list:
+    messages = []
+    while not mailbox.empty():
+        messages.append(mailbox.get_nowait())
+        mailbox.task_done()
+    return messages
+
+
+def test_stick_state_coalesces_per_key_in_place():
+    mailbox = StickMailbox()
+    mailbox.put_stick("roll 1", key="roll")
+    mailbox.put_command("hello")
+    mailbox.put_stick("yaw 1", key="yaw")
+    mailbox.put_stick("roll 2", key="roll")  # Replaces "roll 1" where it was queued
+    assert mailbox.qsize() == 3 and mailbox.merged == 1
+    assert drain(mailbox) == ["roll 2", "hello", "yaw 1"]
+
+
+def test_commands_are_kept_in_order_up_to_the_limit():
+    mailbox = StickMailbox(max_commands=2)
+    mailbox.put_command("a")
+    mailbox.put_stick("sticks")  # Stick state does not count against the limit
+    mailbox.put_command("b")
+    with pytest.raises(asyncio.QueueFull):
+        mailbox.put_command("c")
+    mailbox.put_command("takeoff")  # Priority commands are never refused
+    assert drain(mailbox) == ["takeoff", "a", "sticks", "b"]
+
+
+def test_priority_commands_go_first_and_stop_commands_clear_the_sticks():
+    mailbox = StickMailbox()
+    mailbox.put_stick("forward", key="pitch")
+    mailbox.put_stick("left", key="roll")
+    mailbox.put_command("status")
+    mailbox.put_command("takeoff")
+    assert mailbox.has_priority() and mailbox.stats()["priority_depth"] == 1
+    mailbox.put_command("Land ")  # A stop command: the queued movement must not follow it
+    assert mailbox.dropped == 2
+    assert mailbox.stats()["depth"] == 3
+    assert drain(mailbox) == ["takeoff", "Land ", "status"]
+
+    mailbox.put_stick("after", key="pitch")  # New state is queued again afterwards
+    assert drain(mailbox) == ["after"]
+
+
+def test_binary_commands_are_queued_by_name():
+    mailbox = StickMailbox()
+    mailbox.put_stick(b"sticks")
+    mailbox.put_command(b"land frame", name="land")
+    assert drain(mailbox) == [b"land frame"]
+
+
+def test_task_done_records_the_latency_of_each_lane(clock):
+    mailbox = StickMailbox()
+    mailbox.put_stick("sticks")
+    mailbox.put_command("hello")
+    clock.now += 0.002
+    mailbox.put_command("takeoff")
+    clock.now += 0.003
+
+    assert mailbox.get_nowait() == "takeoff" and mailbox.in_flight_lane == PRIORITY
+    assert mailbox.in_flight_age == pytest.approx(0.003)
+    mailbox.task_done()
+    assert mailbox.in_flight_lane == ""
+    for _ in range(2):
+        mailbox.get_nowait()
+        mailbox.task_done()
+
+    assert mailbox.latency[PRIORITY].max == pytest.approx(0.003)
+    assert mailbox.latency[STICK].max == pytest.approx(0.005)
+    assert mailbox.latency[COMMAND].count == 1
+    mailbox.task_done()  # Nothing in flight: no sample
+    assert mailbox.latency[COMMAND].count == 1 and mailbox.delivered == 3
+
+
+def test_get_waits_for_a_message():
+    async def run():
+        mailbox = StickMailbox()
+        getter = asyncio.ensure_future(mailbox.get())
+        await asyncio.sleep(0)
+        assert not getter.done()
+        mailbox.put_stick("sticks")
+        return await asyncio.wait_for(getter, 1.0)
+
+    assert asyncio.run(run()) == "sticks"
@@ -1,120 +1,166 @@
 import argparse
 import asyncio
-import threading
+import logging
+import time
 
-from bleak import BleakScanner, BleakClient
-import struct
-import websocket
+import websockets
+
+from ble_link import BleLink
+from ble_packet import PacketBatcher
+from latency_trace import LatencyTracer, install_dump_handler, is_local_host
+from metrics_http import link_collector, log_collector, mailbox_collector, start_metrics, tracer_collector
+from rate_control import AdaptiveRate
+from stick_frames import SUBPROTOCOLS, decode, decode_frame, decode_text
+from stick_log import FrameLog, add_logging_arguments, setup_logging
+from stick_mailbox import StickMailbox
 
 # Bluetooth-related constants
 DEVICE_NAME = "DJI_REMOTE_TRPY"  # The advertised BLE name
 SERVICE_UUID = "1fbcdfb1-8e73-4296-9057-a6ee3133902a"
 CHAR_UUID = "d97e4ec1-d3c4-4952-a421-884719fe35f7"
 
-# Define the format of the struct: 6 int16_t values
-STRUCT_FORMAT = "<4h"  # Little-endian (<), 6 short integers (h)
-
-
-def parse_message(message):
-    """ Returns roll, pitch, yaw, throttle, camera, command from the message """
-    try:
-        if message.startswith("moveDrone:"):
-            values = message[len("moveDrone:"):].split(',')
-        else:
-            values = message.split(',')
-        if len(values) == 4:
-            roll, pitch, yaw, throttle = map(float, values)
-            print(f'Received: {roll=}, {pitch=}, {yaw=}, {throttle=}')
-            return int(roll), int(pitch), int(yaw), int(throttle)
-        elif len(values) == 6:
-            roll, pitch, yaw, throttle, camera, command = map(float, values)
-            print(f'Received: {roll=}, {pitch=}, {yaw=}, {throttle=}, {camera=}, {command=}')
-            return int(roll), int(pitch), int(yaw), int(throttle)
-    except ValueError:
-        raise ValueError("Invalid message format")
-
-
-async def run(server_url):
-    print("Scanning for BLE devices...")
-    devices = await BleakScanner.discover(timeout=5.0)
-    target_device = None
-
-    for d in devices:
-        if d.name == DEVICE_NAME:
-            target_device = d
-            break
-
-    if not target_device:
-        print(f"Device '{DEVICE_NAME}' not found. Check your device is advertising.")
-        return
-    else:
-        print(f"Found {DEVICE_NAME} at address {target_device.address}. Connecting...")
-
-    async with BleakClient(target_device.address) as client:
-        if client.is_connected:
-            print(f"Connected to {DEVICE_NAME}!")
-        else:
-            print(f"Failed to connect to {DEVICE_NAME}.")
-            return
-
-        last_msg = ""
-
-        def set_last_msg(ws, msg):
-            nonlocal last_msg
-            last_msg = msg
-
-        ws = websocket.WebSocketApp(
-            server_url,
-            on_open=lambda ws: print("Connected to server"),
-            on_message=set_last_msg,
-            on_error=lambda ws, error: print(f"Error: {error}"),
-            on_close=lambda ws, status_code, msg: print(f"Disconnected from server: {status_code} {msg}"),
-        )
-
-        def run_ws_forever(ws):
-            ws.run_forever()
-        ws_thread = threading.Thread(target=run_ws_forever, args=(ws,))
-        ws_thread.start()
-
-        try:
-            while True:
-                if last_msg != "":
-                    roll, pitch, yaw, throttle = parse_message(last_msg)
-                    throttle = int(throttle) #2090
-                    roll = int(roll) #90
-                    pitch = int(pitch) #1065
-                    yaw = int(yaw)
-
-                    # Pack the data into a binary format using the struct module
-                    data = struct.pack(STRUCT_FORMAT, throttle, yaw, pitch, roll)#, extra1, extra2)
+# Hop latencies of binary frames, measured from the moment the sample was read. The
+# server is usually another machine, whose clock is unrelated to ours; main() sets
+# same_host when it is not
+TRACER = LatencyTracer("ws_to_bluetooth", same_host=False)
 
-                    print("Sending data:", [throttle, yaw, pitch, roll])#, extra1, extra2])
+# Per-frame messages, logged as one summary per second (every frame with --log-level debug)
+STICKS = ("roll", "pitch", "yaw", "throttle")
+RECEIVED = FrameLog("bridge", "Received", STICKS)
+SENT = FrameLog("bridge", "Sending data", STICKS)
+IGNORED = FrameLog("bridge", "Ignoring message", ("message",), level=logging.WARNING)
 
-                    # Write the 12-byte array to the specified characteristic
-                    await client.write_gatt_char(CHAR_UUID, data)
-                    last_msg = ""
 
-                await asyncio.sleep(0.05)
+def parse_message(message):
+    """ Returns roll, pitch, yaw, throttle from stick text; ValueError for anything else """
+    return decode_text(message)[:4]
 
-        except KeyboardInterrupt:
-            print("Stopping server...")
-            ws.close()
-            ws_thread.join()
-            print("Disconnected from server")
 
+async def receive_frames(server_url, mailbox, batcher=None):
+    """ Feeds every message from the server into the mailbox, reconnecting if the connection drops.
+    With a `batcher`, every frame's sticks are also added to it, so none are lost to coalescing.
+    Messages that are not stick frames are logged and skipped. """
+    async for ws in websockets.connect(server_url, subprotocols=SUBPROTOCOLS):
+        print("Connected to server")
+        try:
+            async for message in ws:
+                try:
+                    frame = decode(message)
+                    if batcher is not None:
+                        batcher.add(*frame[:4])
+                except ValueError:
+                    IGNORED.add(message)
+                    continue
+                if isinstance(message, bytes):
+                    TRACER.record_since("sample->receive", frame.timestamp_us)
+                    TRACER.observe_seq(frame.seq)
+                RECEIVED.add(*frame[:4])
+                # A BLE packet has no command field, so a frame carrying a takeoff or
+                # land is only its sticks to the device, and coalesces like any other
+                mailbox.put_stick(message)
+        except websockets.ConnectionClosed as e:
+            print(f"Disconnected from server: {e.code} {e.reason}")
+
+
+async def write_frames(link, mailbox, max_rate, batcher=None, rate=None):
+    """ Writes each frame to the BLE device as soon as it arrives, at most `max_rate`
+    stick writes per second, fewer while writes are slow (`rate` is an AdaptiveRate).
+    If receive_frames fills `batcher`, each write carries every sample received since
+    the last one (as many as fit); otherwise just the frame being written. """
+    own_batcher = batcher is None
+    if own_batcher:
+        batcher = PacketBatcher()
+    if rate is None:
+        rate = AdaptiveRate(max_rate, name="ble")
+    while True:
+        # While reconnecting, frames keep coalescing in the mailbox
+        await link.wait_connected()
+        delay = rate.delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        msg = await mailbox.get()
+        frame = None
+        try:
+            if isinstance(msg, str):
+                values = parse_message(msg)
+            else:
+                frame = decode_frame(msg)
+                values = frame[:4]
+            if values is not None and own_batcher:
+                batcher.add(*values)
+        except ValueError:
+            values = None
+        if values is None:
+            IGNORED.add(msg)
+            mailbox.task_done()
+            continue
+
+        # Packs the pending samples; none are left if an earlier write already carried this frame
+        data = batcher.take(link.max_write_size)
+        if data is None:
+            mailbox.task_done()
+            continue
+
+        SENT.add(*values)
+
+        started = time.perf_counter()
+        written = await link.write(data)
+        TRACER.record("receive->write", mailbox.in_flight_age)
+        if frame is not None:
+            TRACER.record_since("sample->write", frame.timestamp_us)
+        if written:
+            done = time.perf_counter()
+            rate.observe(done - started, done)
+        mailbox.task_done()
+
+
+async def run(server_url, rate_hz=20, metrics_address=None):
+    # Connects straight to the last known address, scanning only if needed, and
+    # reconnects in the background if the link drops
+    link = BleLink(DEVICE_NAME, CHAR_UUID, max_replay_age=2 / rate_hz)
+    if not await link.start():
+        print(f"Device '{DEVICE_NAME}' not found yet. Retrying in the background...")
+
+    # Stick frames coalesce to the latest one
+    mailbox = StickMailbox()
+    # Every received sample goes to the device, batched into the rate-limited writes
+    batcher = PacketBatcher()
+    # Backs off from rate_hz while BLE writes take longer than usual
+    rate = AdaptiveRate(rate_hz, name="ble")
+    metrics = await start_metrics(metrics_address, link_collector(link, rate, batcher),
+                                  mailbox_collector(mailbox, "bridge"), tracer_collector(TRACER), log_collector)
+    try:
+        await asyncio.gather(receive_frames(server_url, mailbox, batcher),
+                             write_frames(link, mailbox, rate_hz, batcher, rate))
+    finally:
+        print(f"Bridge stats: {mailbox.stats()}")
+        print(f"BLE packets: {batcher.stats()}")
+        print(f"Send rate: {rate.stats()}")
+        print(f"BLE link: {link.stats()}")
+        TRACER.dump("latency_ws_to_bluetooth.json")
+        if metrics is not None:
+            await metrics.close()
+        await link.close()
 
 
 def main():
     parser = argparse.ArgumentParser(description="WebSocket client")
     parser.add_argument("ip", nargs="?", default="82.81.197.132", help="Server IP address")
     parser.add_argument("-p", "--port", default="5000", help="Server port")
+    parser.add_argument("-r", "--rate", type=float, default=20, help="Maximum BLE stick writes per second (lowered while the link is congested)")
+    parser.add_argument("--metrics", metavar="[HOST:]PORT", help="Serve /metrics and /profile over HTTP")
+    add_logging_arguments(parser)
     args = parser.parse_args()
+    setup_logging(args.log_level, args.log_json)
 
     ip = args.ip
     port = args.port
     server_url = f"ws://{ip}:{port}/drone"
+    TRACER.same_host = is_local_host(ip)
+    install_dump_handler(TRACER, "latency_ws_to_bluetooth.json")
 
-    asyncio.run(run(server_url))
+    asyncio.run(run(server_url, args.rate, args.metrics))
 
 
 if __name__ == "__main__":